@@ -1,11 +1,279 @@
 # Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
 # SPDX-License-Identifier: MIT
+import io
+import os
 import struct
+import sys
+
+# Local modules
+import Compression
 from LocalUtil import *
 
+# Read size for decompressed streams; the decompressors work best on big
+# chunks.
+_decompress_chunk = 1 << 20
+
+def decode_7bit_encoded_int(buf, pos):
+    """
+    Decode a C# 7-bit encoded int (see BinReader._read_7bit_encoded_int)
+    from buf at pos using index arithmetic.
+
+    Returns a tuple of (value, next_pos). Raises IndexError if buf ends in
+    the middle of the value.
+    """
+    count = 0
+    shift = 0
+    while True:
+        if shift >= (5 * 7):
+            die("Too many bytes (> 5) present in disk string length.")
+        b = buf[pos]
+        pos += 1
+        count |= (b & 0x7f) << shift
+        shift += 7
+        if (b & 0x80) == 0:
+            return (count, pos)
+
+
+def decode_binstrs(buf, pos, count, encoding=None):
+    """
+    Decode up to count length prefixed strings from buf starting at pos.
+    If encoding is None the raw bytes are returned, otherwise each string is
+    decoded with it.
+
+    Decoding stops early at the first string that's not entirely within buf.
+    Returns a tuple of (strings, next_pos).
+    """
+    ret = []
+    append = ret.append
+    end = len(buf)
+    for i in range(count):
+        if pos >= end:
+            break
+        slen = buf[pos]
+        p = pos + 1
+        if slen & 0x80:
+            try:
+                (slen, p) = decode_7bit_encoded_int(buf, pos)
+            except IndexError:
+                break
+        e = p + slen
+        if e > end:
+            break
+        if encoding is None:
+            append(bytes(buf[p:e]))
+        else:
+            append(str(buf[p:e], encoding))
+        pos = e
+    return (ret, pos)
+
+
+class ForwardStream:
+    """
+    File-like wrapper making a non-seekable stream (stdin, a pipe, ...)
+    readable by BinReader.
+
+    Seeking forward reads and discards. The last KEEP bytes before the
+    current position are kept around, along with the last read, so seeking
+    back a little works too; anything further back raises
+    io.UnsupportedOperation.
+
+    While a hasher is set every byte is fed to it once. Bytes count as
+    consumed once the position has moved past them and a new read starts,
+    so data read ahead and then seeked back over isn't hashed early.
+    """
+    KEEP = 65536
+
+    def __init__(self, raw, close_raw=True, chunk_size=8192):
+        self.raw = raw
+        self.close_raw = close_raw
+        self.chunk_size = chunk_size
+        self.buf = bytearray()
+        self.buf_start = 0 # Stream offset of buf[0]
+        self.pos = 0
+        self.hasher = None
+        self.hash_pos = 0 # Everything before this has been hashed
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self.pos
+
+    def read(self, count=-1):
+        self._sync_hash()
+        # Drop what's too far back to be seeked to
+        drop = self.pos - self.KEEP - self.buf_start
+        if drop > 0:
+            del self.buf[:drop]
+            self.buf_start += drop
+        if (count is None) or (count < 0):
+            while self._fill(len(self.buf) + self.KEEP):
+                pass
+            count = self.buf_start + len(self.buf) - self.pos
+        else:
+            while (self.buf_start + len(self.buf) < self.pos + count) and \
+                    self._fill(self.pos + count - self.buf_start):
+                pass
+        off = self.pos - self.buf_start
+        ret = bytes(self.buf[off:off+count])
+        self.pos += len(ret)
+        return ret
+
+    def _sync_hash(self):
+        # Hash everything up to the current position
+        if (self.hasher is not None) and (self.pos > self.hash_pos):
+            self.hasher.update(self.buf[self.hash_pos - self.buf_start:
+                                        self.pos - self.buf_start])
+        self.hash_pos = max(self.hash_pos, self.pos)
+
+    def _fill(self, size):
+        # Read from the stream until buf holds size bytes, False at the end
+        chunk = self.raw.read(max(size - len(self.buf), self.chunk_size))
+        if not chunk:
+            return False
+        self.buf += chunk
+        return True
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            target = offset
+        elif whence == 1:
+            target = self.pos + offset
+        else:
+            raise io.UnsupportedOperation("Cannot seek from the end of a " +
+                                          "stream")
+        if target < self.buf_start:
+            raise io.UnsupportedOperation("Cannot seek that far back in a " +
+                                          "stream")
+        if target > self.pos:
+            self.read(target - self.pos)
+        else:
+            self.pos = target
+        return self.pos
+
+    def start_hash(self, hasher):
+        self.hasher = hasher
+        self.hash_pos = self.pos
+
+    def end_hash(self):
+        self._sync_hash()
+        ret = self.hasher
+        self.hasher = None
+        return ret
+
+    def close(self):
+        if self.close_raw:
+            self.raw.close()
+        self.raw = None
+
+
+class MemoryStream:
+    """
+    File-like reader over a memoryview, for BinReader's in-memory sources.
+
+    Nothing is copied up front: read() copies just the bytes asked for,
+    and read_view() hands out slices of the view itself.
+    """
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def read(self, count=-1):
+        return bytes(self.read_view(count))
+
+    def read_view(self, count=-1):
+        end = len(self.view)
+        if (count is not None) and (count >= 0):
+            end = min(end, self.pos + count)
+        ret = self.view[self.pos:end]
+        self.pos = max(self.pos, end)
+        return ret
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.pos = offset
+        elif whence == 1:
+            self.pos += offset
+        else:
+            self.pos = len(self.view) + offset
+        if self.pos < 0:
+            raise ValueError("Negative seek position {}".format(self.pos))
+        return self.pos
+
+    def close(self):
+        self.view = None
+
+
 class BinReader:
-    def __init__(self, filepath):
-        self.file_handle = open(filepath, mode='rb')
+    def __init__(self, source, str_pool=None):
+        """
+        source is either a path to open, '-' for stdin, an open binary file
+        object, or any object supporting the buffer protocol (bytes,
+        bytearray, memoryview, mmap, ...) to read from without copying it.
+        Non-seekable sources are read through a ForwardStream.
+
+        Paths and stdin holding gzip, bz2 or xz data (or lzma, going by the
+        extension) are decompressed on the fly, forward only.
+
+        If str_pool (a StrPool) is given, every string read is interned in
+        it so many loaded files share a single copy of each string.
+        """
+        self.str_pool = str_pool
+        # File objects given to us are left open
+        self.close_handle = True
+        # Set before opening anything, so close() works if opening fails
+        self.file_handle = None
+        # The compressed file under file_handle, if any
+        self.raw_handle = None
+        view = None
+        if not isinstance(source, str):
+            try:
+                view = memoryview(source).cast('B')
+            except TypeError:
+                pass
+        if view is not None:
+            self.file_handle = MemoryStream(view)
+        elif source == '-':
+            stdin = sys.stdin.buffer
+            fmt = Compression.detect(stdin.peek(Compression.MAGIC_SIZE))
+            if fmt is None:
+                self.file_handle = ForwardStream(stdin, close_raw=False)
+            else:
+                self.file_handle = ForwardStream(
+                        Compression.open_read(stdin, fmt),
+                        chunk_size=_decompress_chunk)
+        elif hasattr(source, 'read'):
+            self.file_handle = source
+            self.close_handle = False
+            if not source.seekable():
+                self.file_handle = ForwardStream(source, close_raw=False)
+                self.close_handle = True
+        else:
+            fh = open(source, mode='rb')
+            head = fh.peek(Compression.MAGIC_SIZE)[:Compression.MAGIC_SIZE]
+            size = None
+            if fh.seekable():
+                size = os.fstat(fh.fileno()).st_size
+            fmt = Compression.detect(head, size)
+            if (fmt is None) and \
+                    (Compression.format_for_path(source) == 'lzma'):
+                fmt = 'lzma'
+            if fmt is not None:
+                self.raw_handle = fh
+                self.file_handle = ForwardStream(
+                        Compression.open_read(fh, fmt),
+                        chunk_size=_decompress_chunk)
+            elif not fh.seekable():
+                # e.g. a named pipe
+                self.file_handle = ForwardStream(fh)
+            else:
+                self.file_handle = fh
         self.s_i32 = struct.Struct("<i")
         self.s_u32 = struct.Struct("<I")
         self.s_i64 = struct.Struct("<q")
@@ -24,9 +292,31 @@ class BinReader:
         self.close()
 
     def close(self):
-        if self.file_handle is not None:
+        if (self.file_handle is not None) and self.close_handle:
             self.file_handle.close()
         self.file_handle = None
+        if self.raw_handle is not None:
+            self.raw_handle.close()
+        self.raw_handle = None
+
+    def seekable(self):
+        """
+        If positions can be jumped to freely. Otherwise the source is read
+        forward only; skip() works, push_pos() only for recent positions.
+        """
+        return self.file_handle.seekable()
+
+    def start_hash(self, hasher):
+        """
+        Feed everything read from here on to hasher (e.g. a hashlib object)
+        until end_hash(). Only for sources that aren't seekable().
+        """
+        if not isinstance(self.file_handle, ForwardStream):
+            raise RuntimeError("Hashing is only supported on streams")
+        self.file_handle.start_hash(hasher)
+
+    def end_hash(self):
+        return self.file_handle.end_hash()
 
     def skip(self, count):
         self.file_handle.seek(count, 1)
@@ -53,6 +343,15 @@ class BinReader:
         self.pop_pos()
         return ret
 
+    def read_view(self, count):
+        """
+        Like read(), but for in-memory sources the result is a memoryview
+        into the source rather than a copy.
+        """
+        if isinstance(self.file_handle, MemoryStream):
+            return self.file_handle.read_view(count)
+        return self.file_handle.read(count)
+
     def _multi_read(self, fn, count, pos):
         if pos is not None:
             self.push_pos(pos)
@@ -143,12 +442,15 @@ class BinReader:
         # value.
         #
         # These values are encoded with a max of 5 bytes.
-        count = 0
-        shift = 0
+        b = self.file_handle.read(1)[0]
+        if (b & 0x80) == 0:
+            return b
+        count = b & 0x7f
+        shift = 7
         while True:
             if shift >= (5 * 7):
                 die("Too many bytes (> 5) present in disk string length.")
-            b = self.read_u8()
+            b = self.file_handle.read(1)[0]
             count |= (b & 0x7f) << shift
             shift += 7
             if (b & 0x80) == 0:
@@ -167,17 +469,47 @@ class BinReader:
             self.pop_pos()
         return ret
 
+    def _binstr_list(self, count, pos, encoding):
+        # Rather than reading each length and string separately, read a
+        # chunk and decode every string that fits in it. Whatever wasn't
+        # consumed is seeked back over before reading the next chunk.
+        if pos is not None:
+            self.push_pos(pos)
+        ret = []
+        chunk = (32 * count) + 16
+        while len(ret) < count:
+            start = self.tell()
+            buf = self.file_handle.read(chunk)
+            (got, used) = decode_binstrs(buf, 0, count - len(ret), encoding)
+            ret.extend(got)
+            if used != len(buf):
+                self.file_handle.seek(start + used)
+            if len(got) == 0:
+                if len(buf) < chunk:
+                    die("Unexpected end of data while reading strings.")
+                # The next string is bigger than our chunk
+                chunk *= 2
+        if pos is not None:
+            self.pop_pos()
+        return ret
+
     def read_binstr(self, count=None, pos=None):
         if count is None:
             return self._binstr_single(pos=pos)
-        return self._multi_read(self._binstr_single, count, pos)
+        return self._binstr_list(count, pos, None)
 
     def _str_single(self, pos=None):
-        return self._binstr_single(pos=pos).decode('ascii')
+        s = self._binstr_single(pos=pos).decode('ascii')
+        if self.str_pool is not None:
+            return self.str_pool.intern(s)
+        return s
 
     def read_str(self, count=None, pos=None):
         if count is None:
             return self._str_single(pos=pos)
-        return self._multi_read(self._str_single, count, pos)
+        ret = self._binstr_list(count, pos, 'ascii')
+        if self.str_pool is not None:
+            return self.str_pool.intern_list(ret)
+        return ret
 
 # vim:ts=4:sw=4:et
@@ -1,14 +1,110 @@
 # Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
 # SPDX-License-Identifier: MIT
+import io
+import os
+import shutil
 import struct
+import sys
+import BinReader
+import Compression
 from LocalUtil import BinIFace
 
+# Single byte encodings are by far the most common, so cache them.
+_7bit_small = [bytes((i,)) for i in range(0x80)]
+
+def encode_7bit_encoded_int(val):
+    """
+    Encode val as a C# 7-bit encoded int (see
+    BinWriter._write_7bit_encoded_int) and return the bytes.
+    """
+    if val < 0x80:
+        if val < 0:
+            raise ValueError('Cannot encode a negative string length!')
+        return _7bit_small[val]
+    ret = bytearray()
+    while val >= 0x80:
+        ret.append((val | 0x80) & 0xff)
+        val >>= 7
+    ret.append(val)
+    return bytes(ret)
+
+
+def encode_binstrs(l):
+    """
+    Encode a list of byte strings as a series of length prefixed strings.
+    """
+    enc = encode_7bit_encoded_int
+    return b''.join([enc(len(b)) + b for b in l])
+
+
+def replace_file(path, data, compress='auto', level=None):
+    """
+    Write data to path through a temporary file in the same directory, so
+    path holds either its old contents or all of data, never a mix. See
+    BinWriter for compress and level; 'auto' goes by path's extension.
+    """
+    if compress == 'auto':
+        compress = Compression.format_for_path(path) or 'none'
+    tmp = os.path.join(os.path.dirname(path) or '.',
+                       '.{}.{}.tmp'.format(os.path.basename(path),
+                                           os.getpid()))
+    try:
+        with BinWriter(tmp, overwrite=True, compress=compress,
+                       level=level) as wr:
+            wr.write_raw(data)
+        if os.path.exists(path):
+            shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
 class BinWriter:
-    def __init__(self, filepath, overwrite = False):
-        mode = 'xb'
-        if overwrite:
-            mode = 'wb'
-        self.file_handle = open(filepath, mode)
+    def __init__(self, filepath=None, overwrite = False, compress='auto',
+                 level=None):
+        """
+        Write to filepath, or to an in-memory buffer if filepath is None.
+        The in-memory contents are available through getvalue().
+
+        filepath can also be '-' for stdout or an open binary file object,
+        which is left open. If it isn't seekable, writing to previous
+        positions isn't possible and write_sized() buffers instead.
+
+        compress is one of Compression.FORMATS, 'none', or 'auto' to go by
+        the extension of filepath. level is the compression level.
+        Compressed output is written forward only.
+        """
+        # File objects given to us are left open
+        self.close_handle = True
+        if filepath is None:
+            self.file_handle = io.BytesIO()
+        elif filepath == '-':
+            self.file_handle = sys.stdout.buffer
+            self.close_handle = False
+        elif hasattr(filepath, 'write'):
+            self.file_handle = filepath
+            self.close_handle = False
+        else:
+            mode = 'xb'
+            if overwrite:
+                mode = 'wb'
+            self.file_handle = open(filepath, mode)
+        fmt = None
+        if compress == 'auto':
+            if isinstance(filepath, str) and (filepath != '-'):
+                fmt = Compression.format_for_path(filepath)
+        elif compress != 'none':
+            fmt = compress
+        # The compressed output under file_handle, if any
+        self.raw_handle = None
+        self.close_raw = False
+        if fmt is not None:
+            self.raw_handle = self.file_handle
+            self.close_raw = self.close_handle
+            self.file_handle = Compression.open_write(self.raw_handle, fmt,
+                                                      level)
+            self.close_handle = True
         self.s_u8 = struct.Struct("<B")
         self.s_i32 = struct.Struct("<i")
         self.s_u32 = struct.Struct("<I")
@@ -17,6 +113,9 @@ class BinWriter:
         self.s_float = struct.Struct("<f")
         self.s_double = struct.Struct("<d")
         self.pos_stack = []
+        self.hasher = None
+        self.can_seek = (fmt is None) and self.file_handle.seekable()
+        self.offset = 0 # Bytes written, for tell() when not seekable
 
     def __del__(self):
         self.close()
@@ -28,17 +127,47 @@ class BinWriter:
         self.close()
 
     def get_path(self):
-        return self.file_handle.name
+        # In-memory writers don't have a path
+        if self.raw_handle is not None:
+            return getattr(self.raw_handle, 'name', None)
+        return getattr(self.file_handle, 'name', None)
+
+    def getvalue(self):
+        return self.file_handle.getvalue()
+
+    def open_reader(self):
+        """
+        Get a BinReader over everything written so far.
+        """
+        self.flush()
+        path = self.get_path()
+        if path is None:
+            return BinReader.BinReader(self.getvalue())
+        return BinReader.BinReader(path)
 
     def flush(self):
         self.file_handle.flush()
 
     def close(self):
         if self.file_handle is not None:
-            self.file_handle.close()
+            if self.close_handle:
+                self.file_handle.close()
+            else:
+                self.file_handle.flush()
         self.file_handle = None
+        if self.raw_handle is not None:
+            if self.close_raw:
+                self.raw_handle.close()
+            else:
+                self.raw_handle.flush()
+        self.raw_handle = None
+
+    def seekable(self):
+        return self.can_seek
 
     def tell(self):
+        if not self.can_seek:
+            return self.offset
         return self.file_handle.tell()
 
     def push_pos(self, pos):
@@ -52,13 +181,62 @@ class BinWriter:
         n = self.pos_stack.pop()
         self.file_handle.seek(n)
 
+    def start_hash(self, hasher):
+        """
+        Feed everything written from here on to hasher (e.g. a hashlib
+        object) until end_hash(). Seeking back isn't possible meanwhile, see
+        write_sized() for writing size prefixed data.
+        """
+        self.hasher = hasher
+
+    def end_hash(self):
+        ret = self.hasher
+        self.hasher = None
+        return ret
+
     def write_raw(self, bstr, pos=None):
         if pos is not None:
+            if self.hasher is not None:
+                raise RuntimeError("Cannot write to a previous position " +
+                                   "while hashing")
             self.push_pos(pos)
         self.file_handle.write(bstr)
+        if not self.can_seek:
+            self.offset += len(bstr)
+        if self.hasher is not None:
+            self.hasher.update(bstr)
         if pos is not None:
             self.pop_pos()
 
+    def write_sized(self, fn, size=None):
+        """
+        Write an i32 byte count followed by whatever fn(binwr) writes.
+
+        If the size is known up front it's written directly, and checked
+        afterwards. Otherwise the count is fixed up once fn() is done, or
+        while hashing or writing to a stream (where that's not possible),
+        fn() writes to an in-memory buffer that's copied over afterwards.
+        """
+        if size is not None:
+            self.write_i32(size)
+            start = self.tell()
+            fn(self)
+            if self.tell() - start != size:
+                raise RuntimeError("Expected to write {} bytes, wrote {}"
+                                   .format(size, self.tell() - start))
+        elif (self.hasher is not None) or (not self.can_seek):
+            sub = BinWriter()
+            fn(sub)
+            data = sub.getvalue()
+            self.write_i32(len(data))
+            self.write_raw(data)
+        else:
+            size_pos = self.tell()
+            self.write_i32(0)
+            start = self.tell()
+            fn(self)
+            self.write_i32(self.tell() - start, pos=size_pos)
+
     def write(self, data, pos=None):
         # Have to test bool before int since bool is also an int
         if isinstance(data, bool):
@@ -117,26 +295,44 @@ class BinWriter:
         # value.
         #
         # These values are encoded with a max of 5 bytes.
-        if val < 0:
-            raise ValueError('Cannot encode a negative string length!')
-        while val >= 0x80:
-            self.write_u8((val | 0x80) & 0xff)
-            val >>= 7
-        self.write_u8(val & 0xff)
+        self.write_raw(encode_7bit_encoded_int(val))
 
     def write_binstr(self, b, pos=None):
-        if pos is not None:
-            self.push_pos(pos)
-        self._write_7bit_encoded_int(len(b))
-        self.write_raw(b)
-        if pos is not None:
-            self.pop_pos()
+        self.write_raw(encode_7bit_encoded_int(len(b)) + b, pos=pos)
 
     def write_str(self, s, pos=None):
         # XXX: We're really just guessing that this is ASCII.
         self.write_binstr(s.encode('ascii'), pos=pos)
 
-    def write_list(self, l, pos=None):
+    def write_binstr_list(self, l, pos=None):
+        self.write_raw(encode_binstrs(l), pos=pos)
+
+    def write_str_list(self, l, pos=None):
+        self.write_binstr_list([s.encode('ascii') for s in l], pos=pos)
+
+    def write_bool_list(self, l, pos=None):
+        self.write_raw(struct.pack("<{}B".format(len(l)), *l), pos=pos)
+
+    def write_i32_list(self, l, pos=None):
+        self.write_raw(struct.pack("<{}i".format(len(l)), *l), pos=pos)
+
+    def write_float_list(self, l, pos=None):
+        self.write_raw(struct.pack("<{}f".format(len(l)), *l), pos=pos)
+
+    def write_list(self, l, pos=None, type_=None):
+        """
+        Write each member of l. If type_ is given (or every member has the
+        same basic type) the whole list is packed in a single write,
+        otherwise each member goes through write().
+        """
+        if type_ is None and len(l) != 0:
+            types = set(map(type, l))
+            if len(types) == 1:
+                type_ = types.pop()
+        fn = self._list_writers.get(type_)
+        if fn is not None:
+            fn(self, l, pos=pos)
+            return
         if pos is not None:
             self.push_pos(pos)
         for i in l:
@@ -149,6 +345,14 @@ class BinWriter:
             self.push_pos(pos)
         bif.toBinary(self)
         if pos is not None:
-            self.pop_pos(pos)
+            self.pop_pos()
+
+    # Bulk writers used by write_list(), by member type.
+    _list_writers = {
+        bool: write_bool_list,
+        int: write_i32_list,
+        float: write_float_list,
+        str: write_str_list,
+    }
 
 # vim:ts=4:sw=4:et
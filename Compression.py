@@ -0,0 +1,83 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+import bz2
+import gzip
+import lzma
+import os
+
+FORMATS = ['gzip', 'bz2', 'xz', 'lzma']
+
+_extensions = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+    '.lzma': 'lzma',
+}
+
+# lzma's own format has no reliable magic, so it's only known by extension
+_magic = [
+    (b'\x1f\x8b\x08', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+]
+
+# Bytes to look at for detect()
+MAGIC_SIZE = 6
+
+def format_for_path(path):
+    """
+    Get the compression format implied by path's extension, or None.
+    """
+    return _extensions.get(os.path.splitext(path)[1].lower())
+
+def detect(head, size=None):
+    """
+    Get the compression format of data starting with head, or None if it
+    doesn't look compressed.
+
+    If the total size is known, data that's laid out as an FCH file
+    (byte count, data, checksum size, 64 byte checksum) is never taken as
+    compressed, however its first bytes look.
+    """
+    if (size is not None) and (len(head) >= 4):
+        byte_count = int.from_bytes(head[0:4], 'little', signed=True)
+        if 4 + byte_count + 4 + 64 == size:
+            return None
+    for (magic, fmt) in _magic:
+        if head.startswith(magic):
+            return fmt
+    return None
+
+def open_read(fileobj, fmt):
+    """
+    Get a file object decompressing fileobj, which is left open.
+    """
+    if fmt == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    elif fmt == 'bz2':
+        return bz2.BZ2File(fileobj, mode='rb')
+    elif fmt in ('xz', 'lzma'):
+        return lzma.LZMAFile(fileobj, mode='rb')
+    raise ValueError("Unknown compression format: {}".format(fmt))
+
+def open_write(fileobj, fmt, level=None):
+    """
+    Get a file object compressing into fileobj, which is left open. level
+    is the format's compression level (or preset), None for its default.
+    """
+    if fmt == 'gzip':
+        # No timestamp, so the same data compresses to the same bytes
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', mtime=0,
+                             compresslevel=(9 if level is None else level))
+    elif fmt == 'bz2':
+        return bz2.BZ2File(fileobj, mode='wb',
+                           compresslevel=(9 if level is None else level))
+    elif fmt == 'xz':
+        return lzma.LZMAFile(fileobj, mode='wb', format=lzma.FORMAT_XZ,
+                             preset=level)
+    elif fmt == 'lzma':
+        return lzma.LZMAFile(fileobj, mode='wb', format=lzma.FORMAT_ALONE,
+                             preset=level)
+    raise ValueError("Unknown compression format: {}".format(fmt))
+
+# vim:ts=4:sw=4:et
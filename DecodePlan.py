@@ -0,0 +1,122 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+import struct
+
+# Plans compiled so far, by (class, version)
+_plans = {}
+
+def get_plan(cls, version):
+    """
+    Get the DecodePlan for cls.BIN_FIELDS at version, compiling it on first
+    use.
+    """
+    key = (cls, version)
+    plan = _plans.get(key)
+    if plan is None:
+        plan = DecodePlan(cls.BIN_FIELDS, version)
+        _plans[key] = plan
+    return plan
+
+
+class DecodePlan:
+    """
+    A record layout specialized for one version: runs of fixed size fields
+    are fused into a single struct read, and fields the version doesn't
+    have are left out altogether.
+
+    The layout is a list of (attr, code, since[, conv]) tuples in file
+    order:
+      attr:  attribute to set on the record.
+      code:  a struct code ('i', 'q', 'f', '?'), optionally with a count
+             ('3f') to read a list, or 'str'/'binstr' for a length
+             prefixed string (see BinReader.read_str()/read_binstr()).
+      since: the first version with the field, None if it's always there.
+      conv:  optional function applied to the value read.
+
+    Records keep their clear() defaults for the fields left out, so support
+    for older versions is a matter of describing their fields.
+    """
+    def __init__(self, fields, version):
+        # ('struct', Struct, [(attr, count, conv), ...]) or
+        # ('str'/'binstr', attr, conv)
+        self.steps = []
+        fmt = ''
+        group = []
+        for field in fields:
+            (attr, code, since) = field[:3]
+            conv = field[3] if len(field) > 3 else None
+            if (since is not None) and (version < since):
+                continue
+            if code in ('str', 'binstr'):
+                self._add_struct(fmt, group)
+                (fmt, group) = ('', [])
+                self.steps.append((code, attr, conv))
+            else:
+                count = int(code[:-1]) if len(code) > 1 else None
+                fmt += code
+                group.append((attr, count, conv))
+        self._add_struct(fmt, group)
+
+    def _add_struct(self, fmt, group):
+        if len(group) != 0:
+            self.steps.append(('struct', struct.Struct('<' + fmt), group))
+
+    def fixed_size(self):
+        """
+        The size of every record if it has no strings, otherwise None.
+        """
+        if (len(self.steps) == 1) and (self.steps[0][0] == 'struct'):
+            return self.steps[0][1].size
+        return None
+
+    def _assign(self, obj, vals, group):
+        i = 0
+        for (attr, count, conv) in group:
+            if count is None:
+                v = vals[i]
+                i += 1
+            else:
+                v = list(vals[i:i+count])
+                i += count
+            if conv is not None:
+                v = conv(v)
+            setattr(obj, attr, v)
+
+    def read(self, binrdr, obj):
+        """
+        Read one record from binrdr into obj.
+        """
+        for (kind, arg, extra) in self.steps:
+            if kind == 'struct':
+                self._assign(obj, arg.unpack(binrdr.read(arg.size)), extra)
+            else:
+                if kind == 'str':
+                    v = binrdr.read_str()
+                else:
+                    v = binrdr.read_binstr()
+                if extra is not None:
+                    v = extra(v)
+                setattr(obj, arg, v)
+        return obj
+
+    def read_list(self, binrdr, cls, count):
+        """
+        Read count records of class cls from binrdr. Records without strings
+        are read in one go.
+        """
+        size = self.fixed_size()
+        if size is None:
+            return [self.read(binrdr, cls()) for i in range(count)]
+        (kind, st, group) = self.steps[0]
+        data = binrdr.read(size * count)
+        if len(data) != size * count:
+            raise struct.error("unpack requires a buffer of {} bytes".format(
+                size * count))
+        ret = []
+        for vals in st.iter_unpack(data):
+            obj = cls()
+            self._assign(obj, vals, group)
+            ret.append(obj)
+        return ret
+
+# vim:ts=4:sw=4:et
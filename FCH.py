@@ -14,6 +14,8 @@ except:
 # Local modules
 import BinReader
 import BinWriter
+import DecodePlan
+import MarkerIndex
 import PBMImage
 import Valheim
 import WBitMatrix
@@ -22,7 +24,46 @@ from LocalUtil import *
 from JDataAdaptor import JDataAdaptor
 from PrettyPrinter import PrettyPrinter, PPWrap
 
+_s_float = struct.Struct("<f")
+
+def _json_diff(a, b, path, diffs):
+    """
+    Recursively compare two toJSON() trees, appending the paths that differ
+    to diffs. Floats are compared after rounding to 32-bit.
+    """
+    if isinstance(a, float) and isinstance(b, float):
+        if _s_float.pack(a) != _s_float.pack(b):
+            diffs.append("{}: {} != {}".format(path, a, b))
+    elif isinstance(a, dict) and isinstance(b, dict):
+        for k in sorted(set(a) | set(b)):
+            if (k not in a) or (k not in b):
+                diffs.append("{}.{}: only present on one side".format(path, k))
+            else:
+                _json_diff(a[k], b[k], "{}.{}".format(path, k), diffs)
+    elif isinstance(a, list) and isinstance(b, list):
+        if len(a) != len(b):
+            diffs.append("{}: length {} != {}".format(path, len(a), len(b)))
+        for i in range(min(len(a), len(b))):
+            _json_diff(a[i], b[i], "{}[{}]".format(path, i), diffs)
+    elif a != b:
+        diffs.append("{}: {} != {}".format(path, a, b))
+    return
+
+
 class FCH_InvItem(BinIFace, JSONIFace):
+    # Binary layout, see DecodePlan
+    BIN_FIELDS = [
+        ('name', 'str', None),
+        ('count', 'i', None),
+        ('durability', 'f', None),
+        ('slot', '2i', None),
+        ('equipped', '?', None),
+        ('level', 'i', 101),
+        ('style', 'i', 102),
+        ('crafter_id', 'q', 103),
+        ('crafter_name', 'str', 103),
+    ]
+
     def __init__(self):
         self.clear()
 
@@ -39,18 +80,7 @@ class FCH_InvItem(BinIFace, JSONIFace):
 
     def fromBinary(self, binrdr, inv_version):
         self.clear()
-        self.name = binrdr.read_str()
-        self.count = binrdr.read_i32()
-        self.durability = binrdr.read_float()
-        self.slot = binrdr.read_i32(count=2)
-        self.equipped = binrdr.read_bool()
-        if inv_version >= 101:
-            self.level = binrdr.read_i32()
-        if inv_version >= 102:
-            self.style = binrdr.read_i32()
-        if inv_version >= 103:
-            self.crafter_id = binrdr.read_i64()
-            self.crafter_name = binrdr.read_str()
+        DecodePlan.get_plan(FCH_InvItem, inv_version).read(binrdr, self)
         return
 
     def fromJSON(self, data):
@@ -124,10 +154,8 @@ class FCH_Inventory(BinIFace, JSONIFace):
         info("Inventory Version:", self.version)
 
         count = binrdr.read_i32()
-        for i in range(count):
-            v = FCH_InvItem()
-            v.fromBinary(binrdr, self.version)
-            self.items.append(v)
+        plan = DecodePlan.get_plan(FCH_InvItem, self.version)
+        self.items = plan.read_list(binrdr, FCH_InvItem, count)
         return
 
     def fromJSON(self, data):
@@ -349,6 +377,13 @@ class FCH_ActiveFood(BinIFace, JSONIFace):
 
 
 class FCH_Skill(BinIFace, JSONIFace):
+    # Binary layout, see DecodePlan
+    BIN_FIELDS = [
+        ('skill', 'i', None, Valheim.SkillType_i2a),
+        ('level', 'f', None),
+        ('exp', 'f', 2),
+    ]
+
     def __init__(self):
        self.clear()
 
@@ -359,11 +394,7 @@ class FCH_Skill(BinIFace, JSONIFace):
 
     def fromBinary(self, binrdr, skill_version):
         self.clear()
-        skill_int = binrdr.read_i32()
-        self.skill = Valheim.SkillType_i2a(skill_int)
-        self.level = binrdr.read_float()
-        if skill_version >= 2:
-            self.exp = binrdr.read_float()
+        DecodePlan.get_plan(FCH_Skill, skill_version).read(binrdr, self)
         return
 
     def fromJSON(self, data):
@@ -412,10 +443,8 @@ class FCH_SkillList(BinIFace, JSONIFace):
             die("Unknown Skills Version:", self.version)
         info("Skills Version:", self.version)
         count = binrdr.read_i32()
-        for i in range(count):
-            v = FCH_Skill()
-            v.fromBinary(binrdr, self.version)
-            self.skills.append(v)
+        plan = DecodePlan.get_plan(FCH_Skill, self.version)
+        self.skills = plan.read_list(binrdr, FCH_Skill, count)
         return
 
     def fromJSON(self, data):
@@ -484,6 +513,16 @@ class FCH_Biome(BinIFace, JSONIFace):
 
 class FCH_PlayerData(JSONIFace):
     CURRENT_VERSION = 24
+    # Binary layout of the header following the version, see DecodePlan
+    BIN_FIELDS = [
+        ('health_max', 'f', None),
+        ('health', 'f', None),
+        ('stamina_max', 'f', None),
+        ('first_spawn', '?', None),
+        ('time_since_death', 'f', None),
+        ('gp_name', 'str', 23),
+        ('gp_cooldown', 'f', 24),
+    ]
 
     def __init__(self):
         self.clear()
@@ -534,34 +573,26 @@ class FCH_PlayerData(JSONIFace):
             die("Unhandled player version:", self.version)
         info("PlayerData Version:", self.version)
 
-        self.health_max = binrdr.read_float()
-        self.health = binrdr.read_float()
-        self.stamina_max = binrdr.read_float()
-        self.first_spawn = binrdr.read_bool()
-        self.time_since_death = binrdr.read_float()
-        if self.version >= 23:
-            self.gp_name = binrdr.read_str()
-        if self.version >= 24:
-            self.gp_cooldown = binrdr.read_float()
-
-        self.inventory.fromBinary(binrdr)
-        self.known_recipes.fromBinary(binrdr)
-        self.known_stations.fromBinary(binrdr)
-        self.discovered_materials.fromBinary(binrdr)
-        self.shown_tutorials.fromBinary(binrdr)
-        self.discovered_uniques.fromBinary(binrdr)
-        self.trophies.fromBinary(binrdr)
-        self.known_biomes.fromBinary(binrdr)
-
-        # Journal entries
-        if self.version >= 22:
-            self.journal.fromBinary(binrdr)
+        DecodePlan.get_plan(FCH_PlayerData, self.version).read(binrdr, self)
 
-        self.appearance.fromBinary(binrdr)
-        self.active_food.fromBinary(binrdr)
-        self.skill_list.fromBinary(binrdr)
+        for name in self.binSections(self.version):
+            getattr(self, name).fromBinary(binrdr)
         return
 
+    def binSections(self, version):
+        """
+        Attribute names of the parts following the header at version, in
+        file order.
+        """
+        ret = ['inventory', 'known_recipes', 'known_stations',
+               'discovered_materials', 'shown_tutorials', 'discovered_uniques',
+               'trophies', 'known_biomes']
+        # Journal entries
+        if version >= 22:
+            ret.append('journal')
+        ret.extend(['appearance', 'active_food', 'skill_list'])
+        return ret
+
     def fromJSON(self, data):
         self.clear()
         self.version = self.CURRENT_VERSION
@@ -605,12 +636,11 @@ class FCH_PlayerData(JSONIFace):
         binwr.write_i64(self.player_id)
         binwr.write_binstr(self.start_seed)
         binwr.write(True) # HavePlayerData
+        # Player Data, prefixed by its byte count
+        binwr.write_sized(self._toBinaryData)
+        return
 
-        # Player Data byte count (temporary)
-        byte_count_pos = binwr.tell()
-        binwr.write(0)
-        start_pos = binwr.tell()
-
+    def _toBinaryData(self, binwr):
         binwr.write(self.CURRENT_VERSION)
         binwr.write(self.health_max)
         binwr.write(self.health)
@@ -632,12 +662,6 @@ class FCH_PlayerData(JSONIFace):
         self.appearance.toBinary(binwr)
         self.active_food.toBinary(binwr)
         self.skill_list.toBinary(binwr)
-
-        # Ending player data position
-        end_pos = binwr.tell()
-        byte_count = end_pos - start_pos
-        # Fixup the count
-        binwr.write(byte_count, pos=byte_count_pos)
         return
 
     def toJSON(self):
@@ -720,6 +744,14 @@ class FCH_PlayerData(JSONIFace):
 
 
 class FCH_WorldMarker(JSONIFace):
+    # Binary layout, see DecodePlan
+    BIN_FIELDS = [
+        ('text', 'str', None),
+        ('point', '3f', None),
+        ('symbol', 'i', None, Valheim.WorldMarkerType_i2a),
+        ('crossed', '?', 3),
+    ]
+
     def __init__(self):
         self.clear()
 
@@ -731,12 +763,7 @@ class FCH_WorldMarker(JSONIFace):
 
     def fromBinary(self, binrdr, world_version):
         self.clear()
-        self.text = binrdr.read_str()
-        self.point = binrdr.read_float(3)
-        symbol_val = binrdr.read_i32()
-        self.symbol = Valheim.WorldMarkerType_i2a(symbol_val)
-        if world_version >= 3:
-            self.crossed = binrdr.read_bool()
+        DecodePlan.get_plan(FCH_WorldMarker, world_version).read(binrdr, self)
         return
 
     def fromJSON(self, data):
@@ -756,6 +783,14 @@ class FCH_WorldMarker(JSONIFace):
         binwr.write(self.crossed)
         return
 
+    def binSize(self):
+        """
+        Number of bytes toBinary() writes.
+        """
+        text_len = len(self.text.encode('ascii'))
+        return (len(BinWriter.encode_7bit_encoded_int(text_len)) + text_len +
+                (4 * len(self.point)) + 4 + 1)
+
     def toJSON(self):
         data = {
             'Text': self.text,
@@ -783,10 +818,8 @@ class FCH_WorldMarkerList(JSONIFace):
         self.clear()
         if world_version >= 2:
             count = binrdr.read_i32()
-            for i in range(count):
-                v = FCH_WorldMarker()
-                v.fromBinary(binrdr, world_version)
-                self.markers.append(v)
+            plan = DecodePlan.get_plan(FCH_WorldMarker, world_version)
+            self.markers = plan.read_list(binrdr, FCH_WorldMarker, count)
         return
 
     def fromJSON(self, data):
@@ -803,6 +836,26 @@ class FCH_WorldMarkerList(JSONIFace):
             v.toBinary(binwr)
         return
 
+    def binSize(self):
+        """
+        Number of bytes toBinary() writes.
+        """
+        return 4 + sum([v.binSize() for v in self.markers])
+
+    def spatialIndex(self, cell_size=64.0):
+        return MarkerIndex.MarkerIndex(self.markers, cell_size=cell_size)
+
+    def dedupe(self, tolerance):
+        """
+        Remove markers with the same text and symbol as an earlier marker
+        within tolerance meters of it. Returns the number removed.
+        """
+        groups = self.spatialIndex().duplicates(tolerance,
+                key=lambda m: (m.text, m.symbol))
+        dupes = set([id(m) for g in groups for m in g[1:]])
+        self.markers = [m for m in self.markers if id(m) not in dupes]
+        return len(dupes)
+
     def toJSON(self):
         data = []
         for v in self.markers:
@@ -831,17 +884,28 @@ class FCH_WorldVisibility(BinIFace, JSONIFace):
         self.pixel_data = WBitMatrix.WBitMatrix()
         self.marker_list = FCH_WorldMarkerList()
         self.public_position = False
+        self.pixels_released = False
+        self.pbm_rows = None # PBMRowReader, when streaming from a PBM
 
-    def fromBinary(self, binrdr):
+    def fromBinary(self, binrdr, skip_pixels=False):
+        """
+        With skip_pixels the visibility matrix is skipped over rather than
+        decoded, leaving the world as if releasePixels() had been called.
+        """
         self.clear()
         self.version = binrdr.read_i32()
         if self.version > self.CURRENT_VERSION:
             die("Unknown FCH world version:", self.version)
         info("World Version:", self.version)
         self.edge_length = binrdr.read_i32()
-        # Load the visibility matrix data
-        self.pixel_data.set_dimensions(self.edge_length, self.edge_length)
-        self.pixel_data.fromBinary(binrdr)
+        if skip_pixels:
+            binrdr.skip(self.edge_length * self.edge_length)
+            self.pixels_released = True
+        else:
+            # Load the visibility matrix data, run-length encoded if that's
+            # smaller
+            self.pixel_data = WBitMatrix.load_matrix(binrdr,
+                    self.edge_length, self.edge_length)
         # Load the marker list
         self.marker_list.fromBinary(binrdr, self.version)
         if self.version >= 4:
@@ -856,14 +920,103 @@ class FCH_WorldVisibility(BinIFace, JSONIFace):
             self.marker_list.fromJSON(data['MapMarkers'])
         return
 
+    def worldToPixel(self, point):
+        """
+        Map a world position (e.g. a spawn point or marker point) to
+        unrounded (x, y) matrix coordinates.
+        """
+        return Valheim.MinimapWorldToPixel(point, self.edge_length)
+
+    def fillCircle(self, center, radius, value=1):
+        """
+        Reveal (value=1) or hide (value=0) everything within radius meters
+        of the world position center.
+        """
+        self._check_pixels()
+        (x, y) = self.worldToPixel(center)
+        self.pixel_data.fill_circle(x, y,
+                Valheim.MinimapMetersToPixels(radius), value)
+
+    def fillRect(self, corner_a, corner_b, value=1):
+        """
+        Reveal or hide the axis aligned rectangle between two world
+        positions.
+        """
+        self._check_pixels()
+        (xa, ya) = self.worldToPixel(corner_a)
+        (xb, yb) = self.worldToPixel(corner_b)
+        x = int(round(min(xa, xb)))
+        y = int(round(min(ya, yb)))
+        self.pixel_data.fill_rect(x, y, int(round(max(xa, xb))) - x + 1,
+                int(round(max(ya, yb))) - y + 1, value)
+
+    def fillPolygon(self, points, value=1):
+        """
+        Reveal or hide the polygon through a list of world positions.
+        """
+        self._check_pixels()
+        self.pixel_data.fill_polygon(
+                [self.worldToPixel(p) for p in points], value)
+
+    def fillCorridor(self, points, radius, value=1):
+        """
+        Reveal or hide everything within radius meters of the path through
+        a list of world positions.
+        """
+        self._check_pixels()
+        self.pixel_data.fill_corridor(
+                [self.worldToPixel(p) for p in points],
+                Valheim.MinimapMetersToPixels(radius), value)
+
+    def foggedMarkers(self):
+        """
+        Get the markers placed on unexplored parts of the minimap.
+        """
+        self._check_pixels()
+        index = self.marker_list.spatialIndex()
+        explored = index.explored(self.pixel_data)
+        return [index.items[i] for i in range(len(index))
+                if not explored[i]]
+
+    def releasePixels(self):
+        """
+        Drop the visibility matrix (e.g. once it's been written out) to free
+        its memory. Everything else is kept.
+        """
+        self.pixel_data = WBitMatrix.WBitMatrix()
+        self.pixels_released = True
+
+    def hasPixels(self):
+        """
+        If the visibility matrix is held in memory.
+        """
+        return (not self.pixels_released) and (self.pbm_rows is None)
+
+    def _check_pixels(self):
+        if self.pixels_released:
+            raise RuntimeError("World visibility data has been released")
+
     def toBinary(self, binwr):
+        self._check_pixels()
         binwr.write(self.CURRENT_VERSION)
         binwr.write(self.edge_length)
-        self.pixel_data.toBinary(binwr)
+        if self.pbm_rows is not None:
+            # The PBM is top-down, on disk it's bottom-up
+            for y in range(self.edge_length - 1, -1, -1):
+                binwr.write_raw(self.pbm_rows.read_row(y))
+        else:
+            self.pixel_data.toBinary(binwr)
         self.marker_list.toBinary(binwr)
         binwr.write(self.public_position)
         return
 
+    def binSize(self):
+        """
+        Number of bytes toBinary() writes.
+        """
+        return (4 + 4 + (self.edge_length * self.edge_length) +
+                self.marker_list.binSize() + 1)
+
     def toJSON(self):
         data = {
             'PublicPosition': self.public_position,
@@ -871,21 +1024,36 @@ class FCH_WorldVisibility(BinIFace, JSONIFace):
         }
         return data
 
-    def readPBM(self, pbm_path):
-        info("Attempting to read world data from PBM file...")
-        img = PBMImage.PBMImage()
-        img.load(pbm_path)
+    def readPBM(self, pbm_path, stream=False):
+        """
+        Load the visibility matrix from a PBM file.
+
+        With stream=True only the PBM's row offsets are read; toBinary()
+        then reads the rows one at a time as it writes them.
+        """
+        if stream:
+            info("Indexing PBM file for streaming world data...")
+            img = PBMImage.PBMRowReader(pbm_path)
+        else:
+            info("Attempting to read world data from PBM file...")
+            img = PBMImage.PBMImage()
+            img.load(pbm_path)
 
         if img.get_width() != img.get_height():
             die("Invalid World PBM file '{}':".format(pbm_path),
                 "Dimensions are not square.")
 
         self.edge_length = img.get_width()
+        if stream:
+            self.pbm_rows = img
+            info("Indexing PBM succeeded.")
+            return
         # We just steal the data from the PBM, no sense copying it.
         self.pixel_data = img.get_matrix()
         info("Loading PBM succeeded.")
 
     def writePBM(self, pbm_path, overwrite=False):
+        self._check_pixels()
         info("Attempting to write world data to PBM file...")
         img = PBMImage.PBMImage()
         img.set_matrix(self.pixel_data)
@@ -895,7 +1063,7 @@ class FCH_WorldVisibility(BinIFace, JSONIFace):
     def printInfo(self, pp):
         pp.println("Visibility Info Version:", self.version)
         pp.println("Edge Length:", self.edge_length)
-        count = self.pixel_data.get_height() * self.pixel_data.get_width()
+        count = self.edge_length * self.edge_length
         pp.println("Visibility Byte Count:", count)
         pp.println("Public Position On Map:", self.public_position)
         pp.println("Map Markers:")
@@ -905,6 +1073,19 @@ class FCH_WorldVisibility(BinIFace, JSONIFace):
 
 
 class FCH_World:
+    # Binary layout of the header, up to the visibility data, see DecodePlan
+    BIN_FIELDS = [
+        ('uid', 'q', None),
+        ('have_spawn_point', '?', None),
+        ('spawn_point', '3f', None),
+        ('have_logout_point', '?', None),
+        ('logout_point', '3f', None),
+        ('have_death_point', '?', 30),
+        ('death_point', '3f', 30),
+        ('home_point', '3f', None),
+        ('have_vis_data', '?', 29),
+    ]
+
     def __init__(self):
         self.clear()
 
@@ -920,27 +1101,12 @@ class FCH_World:
         self.have_vis_data = False
         self.vis_data = FCH_WorldVisibility()
 
-    def fromBinary(self, binrdr, file_version):
+    def fromBinary(self, binrdr, file_version, skip_pixels=False):
         self.clear()
-        self.uid = binrdr.read_i64()
-
-        self.have_spawn_point = binrdr.read_bool()
-        self.spawn_point = binrdr.read_float(count=3)
-
-        self.have_logout_point = binrdr.read_bool()
-        self.logout_point = binrdr.read_float(count=3)
-
-        if file_version >= 30:
-            self.have_death_point = binrdr.read_bool()
-            self.death_point = binrdr.read_float(count=3)
-
-        self.home_point = binrdr.read_float(count=3)
-
-        if file_version >= 29:
-            self.have_vis_data = binrdr.read_bool()
-            if self.have_vis_data:
-                world_bytes = binrdr.read_i32() # XXX we should use this...
-                self.vis_data.fromBinary(binrdr)
+        DecodePlan.get_plan(FCH_World, file_version).read(binrdr, self)
+        if self.have_vis_data:
+            world_bytes = binrdr.read_i32() # XXX we should use this...
+            self.vis_data.fromBinary(binrdr, skip_pixels=skip_pixels)
         return
 
     def readJSON(self, json_path):
@@ -968,9 +1134,9 @@ class FCH_World:
             self.have_vis_data = True
         return
 
-    def readPBM(self, pbm_path):
+    def readPBM(self, pbm_path, stream=False):
         try:
-            self.vis_data.readPBM(pbm_path)
+            self.vis_data.readPBM(pbm_path, stream=stream)
             self.have_vis_data = True
         except(FileNotFoundError):
             info("Missing PBM file for world:", pbm_path);
@@ -992,22 +1158,57 @@ class FCH_World:
 
         binwr.write(self.have_vis_data)
         if self.have_vis_data:
-            # Temporary visibility data length
-            size_pos = binwr.tell()
-            binwr.write_i32(0)
-            data_start = binwr.tell()
-            self.vis_data.toBinary(binwr)
-            data_end = binwr.tell()
-            # Calculate and update the size
-            size = data_end - data_start
-            binwr.write_i32(size, pos=size_pos)
+            # Visibility data, prefixed by its length
+            binwr.write_sized(self.vis_data.toBinary,
+                              size=self.vis_data.binSize())
         return
 
+    def binSize(self):
+        """
+        Number of bytes toBinary() writes.
+        """
+        size = 8 + 1 + (4 * len(self.home_point))
+        for p in (self.spawn_point, self.logout_point, self.death_point):
+            size += 1 + (4 * len(p))
+        if self.have_vis_data:
+            size += 4 + self.vis_data.binSize()
+        return size
+
+    def namedPoint(self, name):
+        """
+        Get the 'spawn', 'home', 'logout' or 'death' point, or None if the
+        world doesn't have it.
+        """
+        if name == 'spawn':
+            return self.spawn_point if self.have_spawn_point else None
+        elif name == 'home':
+            return self.home_point
+        elif name == 'logout':
+            return self.logout_point if self.have_logout_point else None
+        elif name == 'death':
+            return self.death_point if self.have_death_point else None
+        raise ValueError("Unknown world point: {}".format(name))
+
     def writePBM(self, pbm_path, overwrite=False):
         if self.have_vis_data:
             self.vis_data.writePBM(pbm_path, overwrite=overwrite)
 
+    def destruct(self, path_base, overwrite=False):
+        """
+        Write path_base.json and path_base.pbm
+        """
+        self.writeJSON(path_base + '.json', overwrite=overwrite)
+        self.writePBM(path_base + '.pbm', overwrite=overwrite)
+
     def writeJSON(self, json_path, overwrite=False):
+        data = self.toJSON()
+        # Write the data to disk.
+        mode = 'w' if overwrite else 'x'
+        with open(json_path, mode) as f:
+            json.dump(data, f, indent=4)
+        return
+
+    def toJSON(self):
         data = {}
         data['UID'] = self.uid
         if self.have_spawn_point:
@@ -1019,11 +1220,7 @@ class FCH_World:
         data['HomePointXYZ'] = self.home_point
         if self.have_vis_data:
             data['VisibilityData'] = self.vis_data.toJSON()
-        # Write the data to disk.
-        mode = 'w' if overwrite else 'x'
-        with open(json_path, mode) as f:
-            json.dump(data, f, indent=4)
-        return
+        return data
 
     def printInfo(self, pp):
         pp.println("UID:", self.uid)
@@ -1053,27 +1250,53 @@ class FCH_WorldManager:
     def clear(self):
         self.worlds = [] # FCH_World
 
-    def fromBinary(self, binrdr, file_version):
+    def fromBinary(self, binrdr, file_version, world_fn=None,
+                   skip_pixels=False):
+        """
+        If world_fn is given, world_fn(index, world) is called as soon as
+        each world has been read. skip_pixels is passed on to
+        FCH_WorldVisibility.fromBinary().
+        """
         self.clear()
         world_count = binrdr.read_i32()
         for i in range(world_count):
             w = FCH_World()
-            w.fromBinary(binrdr, file_version)
+            w.fromBinary(binrdr, file_version, skip_pixels=skip_pixels)
+            if world_fn is not None:
+                world_fn(i, w)
             self.worlds.append(w)
 
+    def getWorld(self, index=0, uid=None):
+        """
+        Get the world with the given UID, or else at index. None if there's
+        no such world.
+        """
+        if uid is not None:
+            for w in self.worlds:
+                if w.uid == uid:
+                    return w
+            return None
+        if (index < 0) or (index >= len(self.worlds)):
+            return None
+        return self.worlds[index]
+
     def destruct(self, outdir, overwrite=False):
         for i in range(len(self.worlds)):
             path_base = '{}/world{}'.format(outdir, i)
-            self.worlds[i].writeJSON(path_base + '.json', overwrite=overwrite)
-            self.worlds[i].writePBM(path_base + '.pbm', overwrite=overwrite)
-        pass
+            self.worlds[i].destruct(path_base, overwrite=overwrite)
 
     def toBinary(self, binwr):
         binwr.write_i32(len(self.worlds))
         for w in self.worlds:
             w.toBinary(binwr)
 
-    def construct(self, indir):
+    def binSize(self):
+        """
+        Number of bytes toBinary() writes.
+        """
+        return 4 + sum([w.binSize() for w in self.worlds])
+
+    def construct(self, indir, stream=False):
         self.clear()
         world_files = glob.glob(indir + '/world*.json')
         world_files.sort()
@@ -1081,7 +1304,7 @@ class FCH_WorldManager:
             w = FCH_World()
             w.readJSON(wf)
             # Replace the 'json' suffix with 'pbm'
-            w.readPBM(wf[0:-4] + 'pbm')
+            w.readPBM(wf[0:-4] + 'pbm', stream=stream)
             self.worlds.append(w)
 
     def printInfo(self, pp):
@@ -1094,7 +1317,14 @@ class FCH_WorldManager:
 
 class FCH_PlayerStats(BinIFace, JSONIFace):
     CURRENT_VERSION = 33
-    
+    # Binary layout following the version, see DecodePlan
+    BIN_FIELDS = [
+        ('kill_count', 'i', 28),
+        ('death_count', 'i', 28),
+        ('craft_count', 'i', 28),
+        ('build_count', 'i', 28),
+    ]
+
     def __init__(self):
         self.clear()
 
@@ -1111,11 +1341,7 @@ class FCH_PlayerStats(BinIFace, JSONIFace):
         if (self.version > self.CURRENT_VERSION):
             die("Unknown FCH file version:", self.version)
         info("File Version:", self.version)
-        if (self.version >= 28):
-            self.kill_count = binrdr.read_i32()
-            self.death_count = binrdr.read_i32()
-            self.craft_count = binrdr.read_i32()
-            self.build_count = binrdr.read_i32()
+        DecodePlan.get_plan(FCH_PlayerStats, self.version).read(binrdr, self)
 
     def fromJSON(self, data):
         self.clear()
@@ -1133,6 +1359,12 @@ class FCH_PlayerStats(BinIFace, JSONIFace):
         binwr.write(self.craft_count)
         binwr.write(self.build_count)
 
+    def binSize(self):
+        """
+        Number of bytes toBinary() writes.
+        """
+        return 5 * 4
+
     def toJSON(self):
         data = {
             'Kills': self.kill_count,
@@ -1165,18 +1397,25 @@ class FCH_Root:
             rem = byte_count % 8192
             m = hashlib.sha512()
             for i in range(blocks):
-                block = binrdr.read(8192)
+                block = binrdr.read_view(8192)
                 m.update(block)
             if rem != 0:
-                block = binrdr.read(rem)
+                block = binrdr.read_view(rem)
                 m.update(block)
             return m.digest()
         else:
             return b'\x00' * 64 
 
-    def fromBinary(self, binrdr):
+    def fromBinary(self, binrdr, verify_checksum=True, world_fn=None,
+                   skip_pixels=False):
         """
         Load an FCH file into memory.
+
+        verify_checksum can be set to False to skip hashing the data segment,
+        e.g. when the data was just produced by toBinary().
+
+        world_fn and skip_pixels are passed on to
+        FCH_WorldManager.fromBinary().
         """
         # Before we can load the data we have some validation to perform.
         # The file is wrapped in the following format:
@@ -1191,6 +1430,10 @@ class FCH_Root:
         # to validate it here if we have access to a SHA-512 algorithm.
         #
         info("Reading FCH file from disk...")
+        if not binrdr.seekable():
+            self._fromStream(binrdr, verify_checksum, world_fn,
+                             skip_pixels)
+            return
         byte_count = binrdr.read_i32()
         start_pos = binrdr.tell()
         # Skip the byte data for now, we'll extract the checksum first.
@@ -1202,24 +1445,63 @@ class FCH_Root:
         # according to the basic check.
         #
         # Now calculate the checksum and verify the data!
-        if _have_sha512:
+        if _have_sha512 and verify_checksum:
             binrdr.push_pos(start_pos)
             calc_checksum = self._calculate_checksum(binrdr, byte_count)
             binrdr.pop_pos()
             if checksum != calc_checksum:
-                pp = PrettyPrinter()
-                pp.bytes("Disk Checksum", checksum)
-                pp.bytes("Calculated Checksum", calc_checksum)
-                die("Calculated checksum does not match the one loaded from "
-                    "disk!")
+                self._checksum_mismatch(checksum, calc_checksum)
         # Checksum seems legit, lets go!
         binrdr.push_pos(start_pos)
         self.player_stats.fromBinary(binrdr)
-        self.worlds.fromBinary(binrdr, self.player_stats.version)
+        self.worlds.fromBinary(binrdr, self.player_stats.version,
+                               world_fn=world_fn, skip_pixels=skip_pixels)
         self.player_data.fromBinary(binrdr, self.player_stats.version)
         binrdr.pop_pos()
         info("Reading FCH file succeeded.")
 
+    def fromBytes(self, buf, verify_checksum=True):
+        """
+        Load an FCH file from buf, any object supporting the buffer protocol
+        (bytes, bytearray, memoryview, mmap, ...). buf is read in place.
+        """
+        with BinReader.BinReader(buf) as br:
+            self.fromBinary(br, verify_checksum=verify_checksum)
+
+    def _fromStream(self, binrdr, verify_checksum, world_fn, skip_pixels):
+        # fromBinary() for sources that can only be read forward: the data
+        # is hashed while it's parsed, and the checksum checked at the end.
+        byte_count = binrdr.read_i32()
+        start_pos = binrdr.tell()
+        hashing = _have_sha512 and verify_checksum
+        if hashing:
+            binrdr.start_hash(hashlib.sha512())
+        self.player_stats.fromBinary(binrdr)
+        self.worlds.fromBinary(binrdr, self.player_stats.version,
+                               world_fn=world_fn, skip_pixels=skip_pixels)
+        self.player_data.fromBinary(binrdr, self.player_stats.version)
+        # Anything left over is still part of the hashed data
+        left = start_pos + byte_count - binrdr.tell()
+        if left < 0:
+            die("FCH data runs past the end of the data segment")
+        binrdr.skip(left)
+        m = binrdr.end_hash() if hashing else None
+        checksum_size = binrdr.read_i32()
+        checksum = binrdr.read(checksum_size)
+        if len(checksum) != checksum_size:
+            die("Unexpected end of data while reading the checksum.")
+        if (m is not None) and (checksum != m.digest()):
+            self._checksum_mismatch(checksum, m.digest())
+        info("Reading FCH file succeeded.")
+
+    def _checksum_mismatch(self, checksum, calc_checksum):
+        pp = PrettyPrinter()
+        pp.bytes("Disk Checksum", checksum)
+        pp.bytes("Calculated Checksum", calc_checksum)
+        pp.flush()
+        die("Calculated checksum does not match the one loaded from "
+            "disk!")
+
     def destruct(self, outdir, overwrite=False):
         """
         Deconstruct an in-memory FCH file to a series of output files:
@@ -1231,6 +1513,11 @@ class FCH_Root:
         not exist if there isn't any world data in the FCH.
         """
         info("Destructing FCH data...")
+        self._destruct_player(outdir, overwrite=overwrite)
+        self.worlds.destruct(outdir, overwrite=overwrite)
+        info("Destructing succeeded.")
+
+    def _destruct_player(self, outdir, overwrite=False):
         path = outdir + '/player.json'
         data = {
             'PlayerStats': self.player_stats.toJSON(),
@@ -1239,7 +1526,23 @@ class FCH_Root:
         mode = 'w' if overwrite else 'x'
         with open(path, mode) as f:
             json.dump(data, f, indent=4)
-        self.worlds.destruct(outdir, overwrite=overwrite)
+
+    def destructStream(self, binrdr, outdir, overwrite=False):
+        """
+        Load an FCH file from binrdr, destructing it to outdir (see
+        destruct()) along the way.
+
+        Each world is written out as soon as it has been read and its
+        visibility data is then released, so at most one world's map is
+        held in memory at a time. Everything else is kept, so printInfo()
+        still works afterwards.
+        """
+        info("Destructing FCH data...")
+        def world_fn(i, w):
+            w.destruct('{}/world{}'.format(outdir, i), overwrite=overwrite)
+            w.vis_data.releasePixels()
+        self.fromBinary(binrdr, world_fn=world_fn)
+        self._destruct_player(outdir, overwrite=overwrite)
         info("Destructing succeeded.")
 
     def toBinary(self, binwr):
@@ -1247,29 +1550,75 @@ class FCH_Root:
         Write an FCH file.
         """
         info("Writing FCH file to disk...")
-        byte_count_pos = binwr.tell()
-        # Temporary byte count
-        binwr.write_i32(0)
+        # The player data is small, serializing it first makes the size of
+        # the data known up front, so nothing has to be patched afterwards
+        # and the output needn't be seekable.
+        with BinWriter.BinWriter() as player_wr:
+            self.player_data.toBinary(player_wr)
+            player_bytes = player_wr.getvalue()
+        byte_count = (self.player_stats.binSize() + self.worlds.binSize() +
+                      len(player_bytes))
+        binwr.write_i32(byte_count)
         data_start_pos = binwr.tell()
-        # Write all the data.
+        # Write all the data, hashing it as it goes out.
+        if _have_sha512:
+            binwr.start_hash(hashlib.sha512())
         self.player_stats.toBinary(binwr)
         self.worlds.toBinary(binwr)
-        self.player_data.toBinary(binwr)
-        data_end_pos = binwr.tell()
-        byte_count = data_end_pos - data_start_pos
+        binwr.write_raw(player_bytes)
+        m = binwr.end_hash()
+        if binwr.tell() - data_start_pos != byte_count:
+            raise RuntimeError("Expected to write {} bytes, wrote {}".format(
+                byte_count, binwr.tell() - data_start_pos))
         # Checksum bytes
-        binwr.flush()
-        with BinReader.BinReader(binwr.get_path()) as br:
-            br.push_pos(data_start_pos)
-            checksum = self._calculate_checksum(br, byte_count)
-            br.pop_pos()
+        if m is not None:
+            checksum = m.digest()
+        else:
+            checksum = b'\x00' * 64
         binwr.write_i32(len(checksum))
         binwr.write_raw(checksum)
-        # finally update the byte count
-        binwr.write_i32(byte_count, pos=byte_count_pos)
         info("Writing FCH data succeeded.")
 
-    def construct(self, indir):
+    def toBytes(self):
+        """
+        Get the FCH file as bytes.
+        """
+        with BinWriter.BinWriter() as wr:
+            self.toBinary(wr)
+            return wr.getvalue()
+
+    def compare(self, other):
+        """
+        Structurally compare against another FCH_Root.
+
+        Returns a list of human readable differences; the list is empty if
+        both are equivalent. Visibility matrices are only compared where
+        both sides hold them in memory. Floats are compared at the precision
+        they're stored on disk (32-bit) so a freshly constructed root
+        compares equal to the same data read back from its serialized form.
+        """
+        diffs = []
+        _json_diff(self.player_stats.toJSON(), other.player_stats.toJSON(),
+                   'PlayerStats', diffs)
+        _json_diff(self.player_data.toJSON(), other.player_data.toJSON(),
+                   'PlayerData', diffs)
+        mine = self.worlds.worlds
+        theirs = other.worlds.worlds
+        if len(mine) != len(theirs):
+            diffs.append("Worlds: count {} != {}".format(len(mine),
+                                                         len(theirs)))
+        for i in range(min(len(mine), len(theirs))):
+            prefix = 'World{}'.format(i)
+            _json_diff(mine[i].toJSON(), theirs[i].toJSON(), prefix, diffs)
+            if (mine[i].have_vis_data and theirs[i].have_vis_data and
+                    mine[i].vis_data.hasPixels() and
+                    theirs[i].vis_data.hasPixels() and
+                    mine[i].vis_data.pixel_data !=
+                    theirs[i].vis_data.pixel_data):
+                diffs.append(prefix + ".VisibilityData: pixels differ")
+        return diffs
+
+    def construct(self, indir, stream=False):
         """
         Construct an in-memory FCH file from a series of input files:
           indir/player.json
@@ -1278,6 +1627,9 @@ class FCH_Root:
 
         Where 'N' is the world index. The world files are optional and do not
         have to exist.
+
+        With stream=True the PBM files are only indexed, and their rows are
+        copied straight to the output by toBinary().
         """
         info("Constructing FCH data...")
         path = indir + '/player.json'
@@ -1287,16 +1639,26 @@ class FCH_Root:
             self.player_stats.fromJSON(data['PlayerStats'])
         if 'PlayerData' in data:
             self.player_data.fromJSON(data['PlayerData'])
-        self.worlds.construct(indir)
+        self.worlds.construct(indir, stream=stream)
         info("Construction succeeded.")
 
-    def printInfo(self):
-        pp = PrettyPrinter()
+    def printInfo(self, fmt='text', out=None, label=None):
+        """
+        Print the file info (see PrettyPrinter for the formats) to out,
+        stdout by default. With label, the info goes in a block of that
+        name (e.g. the file's path, when printing several).
+        """
+        pp = PrettyPrinter(fmt=fmt, out=out)
+        if label is not None:
+            pp.block(label)
         with PPWrap(pp, "Player Stats"):
             self.player_stats.printInfo(pp)
         with PPWrap(pp, "World Data"):
             self.worlds.printInfo(pp)
         with PPWrap(pp, "Player Data"):
             self.player_data.printInfo(pp)
+        if label is not None:
+            pp.end_block()
+        pp.flush()
 
 # vim:ts=4:sw=4:et
@@ -0,0 +1,111 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+import asyncio
+import concurrent.futures
+import io
+
+# Local modules
+import Compression
+from FCH import FCH_Root
+
+def _read(path):
+    # The whole file in one read
+    with open(path, mode='rb') as f:
+        return f.read()
+
+def _decode(path, data, verify_checksum):
+    """
+    Worker: decode FCH data read from path, decompressing it first if
+    needed.
+    """
+    fmt = Compression.detect(data[:Compression.MAGIC_SIZE], len(data))
+    if (fmt is None) and (Compression.format_for_path(path) == 'lzma'):
+        fmt = 'lzma'
+    if fmt is not None:
+        with Compression.open_read(io.BytesIO(data), fmt) as f:
+            data = f.read()
+    fh = FCH_Root()
+    try:
+        fh.fromBytes(data, verify_checksum=verify_checksum)
+    except SystemExit:
+        # die() has already explained what went wrong on stderr, but
+        # SystemExit would take the event loop down with it
+        raise ValueError("Failed to load {}".format(path))
+    return fh
+
+async def load_async(path, executor=None, verify_checksum=True):
+    """
+    Load an FCH file from path without blocking the event loop.
+
+    The file is read in a single read on a thread and decoded (and its
+    checksum verified) in executor, the loop's default executor if None.
+    With a concurrent.futures.ProcessPoolExecutor decoding doesn't compete
+    with the loop for the GIL.
+
+    Raises ValueError if the file can't be loaded. Needs Python 3.9 or
+    higher, like load_many_async().
+    """
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(None, _read, path)
+    return await loop.run_in_executor(executor, _decode, path, data,
+                                      verify_checksum)
+
+async def load_many_async(paths, concurrency=4, executor=None,
+                          verify_checksum=True):
+    """
+    Load the FCH files in paths (any iterable), at most concurrency at a
+    time, as an async generator.
+
+    Yields (path, FCH_Root, error) tuples as the loads complete, like
+    FCHBatch.run(), error being None on success. Without an executor the
+    files are decoded in a pool of concurrency worker processes, shut down
+    when the generator finishes.
+
+    Closing the generator early (e.g. breaking out of the async for loop)
+    or cancelling the task iterating it cancels the loads still pending,
+    including those already handed to the pool: that is
+    Executor.shutdown(cancel_futures=True), so Python 3.9 or higher is
+    needed.
+    """
+    if concurrency < 1:
+        raise ValueError("Bad concurrency:", concurrency)
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ProcessPoolExecutor(concurrency)
+
+    async def load(path):
+        try:
+            return (path, await load_async(path, executor=executor,
+                                           verify_checksum=verify_checksum),
+                    None)
+        except OSError as e:
+            return (path, None, "Can't open {}: {}".format(path, e.strerror))
+        except ValueError as e:
+            return (path, None, " ".join([str(a) for a in e.args]))
+        except Exception as e:
+            return (path, None, "{}: {}".format(type(e).__name__, e))
+
+    paths = iter(paths)
+    pending = set()
+    try:
+        while True:
+            # Top up to concurrency loads in flight
+            for path in paths:
+                pending.add(asyncio.ensure_future(load(path)))
+                if len(pending) >= concurrency:
+                    break
+            if len(pending) == 0:
+                return
+            (done, pending) = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                yield t.result()
+    finally:
+        for t in pending:
+            t.cancel()
+        if len(pending) != 0:
+            await asyncio.wait(pending)
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+# vim:ts=4:sw=4:et
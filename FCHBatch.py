@@ -0,0 +1,66 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+import multiprocessing
+import os
+
+# Local modules
+from BinReader import BinReader
+from FCH import FCH_Root
+
+def load(path, str_pool=None, verify_checksum=True, skip_pixels=False):
+    """
+    Load an FCH file from path. With skip_pixels the minimap pixels are
+    not decoded (see FCH_WorldVisibility.fromBinary()).
+    """
+    fh = FCH_Root()
+    with BinReader(path, str_pool=str_pool) as br:
+        fh.fromBinary(br, verify_checksum=verify_checksum,
+                      skip_pixels=skip_pixels)
+    return fh
+
+def file_checksum(path):
+    """
+    Get the checksum stored at the end of an FCH file without parsing (or
+    hashing) the data before it.
+    """
+    with BinReader(path) as br:
+        byte_count = br.read_i32()
+        br.skip(byte_count)
+        checksum_size = br.read_i32()
+        return br.read(checksum_size)
+
+def _call(job):
+    (fn, path, args) = job
+    try:
+        return (path, fn(path, *args), None)
+    except SystemExit:
+        # die() has already explained what went wrong on stderr
+        return (path, None, "Failed to process file")
+    except Exception as e:
+        return (path, None, "{}: {}".format(type(e).__name__, e))
+
+def run(fn, paths, workers=None, args=()):
+    """
+    Call fn(path, *args) for each path using a pool of worker processes.
+
+    Yields (path, result, error) tuples as the calls complete, error being
+    None on success. fn has to be a module level function so the workers
+    can find it, and the results should be kept small since they are sent
+    back from the workers (e.g. rows rather than an FCH_Root).
+
+    workers defaults to the number of CPUs, with 1 everything is run in
+    the calling process.
+    """
+    jobs = [(fn, p, args) for p in paths]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        for job in jobs:
+            yield _call(job)
+        return
+    with multiprocessing.Pool(workers) as pool:
+        for ret in pool.imap_unordered(_call, jobs):
+            yield ret
+
+# vim:ts=4:sw=4:et
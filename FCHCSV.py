@@ -0,0 +1,97 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+import csv
+import os
+
+# Local modules
+import FCHBatch
+import Valheim
+
+from LocalUtil import *
+
+INVENTORY_COLUMNS = (
+    'path', 'player_id', 'player_name', 'name', 'count', 'durability',
+    'slot_x', 'slot_y', 'equipped', 'level', 'style', 'crafter_id',
+    'crafter_name',
+)
+
+SKILL_COLUMNS = (
+    'path', 'player_id', 'player_name', 'skill_id', 'skill', 'level',
+    'experience',
+)
+
+def _rows(path):
+    """
+    Worker side of the export: load path and flatten it into rows.
+    """
+    fh = FCHBatch.load(path, skip_pixels=True)
+    pd = fh.player_data
+    items = [(
+        path, pd.player_id, pd.name, v.name, v.count, v.durability,
+        v.slot[0], v.slot[1], int(v.equipped), v.level, v.style,
+        v.crafter_id, v.crafter_name,
+    ) for v in pd.inventory.items]
+    skills = [(
+        path, pd.player_id, pd.name, Valheim.SkillType_a2i(v.skill),
+        v.skill, v.level, v.exp,
+    ) for v in pd.skill_list.skills]
+    return (items, skills)
+
+
+class FCHCSV:
+    """
+    Streams inventory items and skills of many FCH files into flat tables:
+      outdir/inventory.csv
+      outdir/skills.csv
+
+    Rows are written as each file is processed, so memory use doesn't grow
+    with the number of files. With tsv=True the files are tab separated
+    (and use a .tsv suffix) instead.
+    """
+    def __init__(self, outdir, tsv=False, overwrite=False):
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        suffix = '.tsv' if tsv else '.csv'
+        dialect = 'excel-tab' if tsv else 'excel'
+        mode = 'w' if overwrite else 'x'
+        self.files = []
+        self.writers = []
+        for (name, columns) in (('inventory', INVENTORY_COLUMNS),
+                                ('skills', SKILL_COLUMNS)):
+            f = open(os.path.join(outdir, name + suffix), mode, newline='')
+            w = csv.writer(f, dialect=dialect)
+            w.writerow(columns)
+            self.files.append(f)
+            self.writers.append(w)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.files = []
+        self.writers = []
+
+    def export(self, paths, workers=None):
+        """
+        Export paths, parsing the files in worker processes.
+
+        Returns a tuple of (exported, failed) counts.
+        """
+        exported = 0
+        failed = 0
+        for (path, rows, err) in FCHBatch.run(_rows, paths, workers=workers):
+            if err is not None:
+                info("Failed to export", path, "({})".format(err))
+                failed += 1
+                continue
+            for (w, table_rows) in zip(self.writers, rows):
+                w.writerows(table_rows)
+            exported += 1
+        return (exported, failed)
+
+# vim:ts=4:sw=4:et
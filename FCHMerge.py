@@ -0,0 +1,234 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+try:
+    import hashlib
+    _have_sha512 = True
+except:
+    _have_sha512 = False
+import os
+
+# Local modules
+import FCHBatch
+import MarkerIndex
+import Valheim
+
+import BinWriter
+from BinReader import BinReader
+from FCH import FCH_Root, FCH_WorldVisibility
+from FCHSections import FCHSectionIndex
+from FCHValidate import FCHValidator
+from LocalUtil import *
+
+def _stamp(path):
+    # Tells if a file was changed: its size, modification time and the
+    # checksum stored in it
+    st = os.stat(path)
+    with BinReader(path) as br:
+        byte_count = br.read_i32()
+        br.skip(byte_count + 4)
+        checksum = br.read(-1)
+    return (st.st_size, st.st_mtime_ns, checksum)
+
+def _scan(path, verify_checksum):
+    """
+    Worker: index path and decode the visibility data of its worlds.
+    Returns (index, [(world index, FCH_WorldVisibility)], stamp).
+    """
+    stamp = _stamp(path)
+    with BinReader(path) as br:
+        if not br.seekable():
+            die("Merging needs uncompressed files")
+        index = FCHSectionIndex()
+        index.fromBinary(br)
+        if verify_checksum and _have_sha512:
+            br.push_pos(index.data.offset)
+            calc = FCH_Root()._calculate_checksum(br, index.data.size)
+            br.pop_pos()
+            if calc != br.read(index.checksum.size, index.checksum.offset):
+                die("Calculated checksum does not match the one loaded " +
+                    "from disk!")
+        worlds = []
+        for i in range(len(index.worlds)):
+            w = index.worlds[i]
+            if w.visibility is None:
+                continue
+            br.push_pos(w.visibility.offset)
+            vis = FCH_WorldVisibility()
+            vis.fromBinary(br)
+            if br.tell() != w.visibility.end():
+                die("World visibility data of world {}".format(w.uid),
+                    "doesn't match its byte count")
+            br.pop_pos()
+            worlds.append((i, vis))
+    return (index, worlds, stamp)
+
+
+class _Member:
+    # A world of one file taking part in a merge
+    def __init__(self, path, world_index, vis):
+        self.path = path
+        self.world_index = world_index
+        self.explored = vis.pixel_data.popcount()
+        self.markers = vis.marker_list.markers
+        self.public_position = vis.public_position
+
+
+class FCHMapMerge:
+    """
+    Combines the minimaps of the worlds sharing a UID across many FCH files
+    (a "party map") and writes the union back into every file.
+
+    Each member's markers are kept as they are, and the shared markers of
+    the other members (see Valheim.WorldMarkerType_shared) are added unless
+    one with the same text and symbol is within tolerance meters. Those
+    include the boss pins from vegvisirs on purpose: a boss one player has
+    found is shown to the whole party.
+
+    Files are only written if something changed, and then only the worlds
+    that changed are re-encoded; everything else is copied over as is.
+    """
+    def __init__(self, tolerance=1.0, uids=None):
+        self.tolerance = tolerance
+        self.uids = uids # Only merge these world UIDs, if set
+
+    def merge(self, paths, workers=None, verify_checksum=True):
+        """
+        Merge the worlds of paths in place. Returns a tuple of (written,
+        unchanged, failed) file counts.
+
+        Files changed since they were read (e.g. by the game saving) are
+        left alone and count as failed. The others are replaced whole, via
+        a temporary file.
+        """
+        indexes = {}
+        stamps = {}
+        members = {} # uid -> [_Member]
+        unions = {} # uid -> WBitMatrix
+        failed = 0
+        for (path, ret, err) in FCHBatch.run(_scan, paths, workers=workers,
+                                             args=(verify_checksum,)):
+            if err is not None:
+                info("Failed to read", path, "({})".format(err))
+                failed += 1
+                continue
+            (index, worlds, stamp) = ret
+            indexes[path] = index
+            stamps[path] = stamp
+            for (i, vis) in worlds:
+                uid = index.worlds[i].uid
+                if (self.uids is not None) and (uid not in self.uids):
+                    continue
+                members.setdefault(uid, []).append(_Member(path, i, vis))
+                union = unions.get(uid)
+                if union is False:
+                    # Already known not to match
+                    continue
+                if union is None:
+                    unions[uid] = vis.pixel_data
+                elif union.get_width() != vis.pixel_data.get_width():
+                    info("World", uid, "has different map sizes, skipping")
+                    unions[uid] = False
+                else:
+                    union.merge_or(vis.pixel_data)
+
+        # Work out what changes in each file
+        order = dict([(paths[i], i) for i in range(len(paths))])
+        changes = {} # path -> {world index: FCH_WorldVisibility}
+        for (uid, l) in members.items():
+            union = unions[uid]
+            if (union is False) or (len(l) < 2):
+                continue
+            # Keep the results independent of the order the workers finish
+            l.sort(key=lambda m: (order[m.path], m.world_index))
+            explored = union.popcount()
+            for m in l:
+                markers = self._merge_markers(m, l)
+                if (m.explored == explored) and \
+                        (len(markers) == len(m.markers)):
+                    continue
+                vis = FCH_WorldVisibility()
+                vis.edge_length = union.get_width()
+                vis.pixel_data = union
+                vis.marker_list.markers = markers
+                vis.public_position = m.public_position
+                changes.setdefault(m.path, {})[m.world_index] = vis
+            info("World {}: {} characters, {} pixels explored".format(
+                uid, len(l), explored))
+
+        written = 0
+        for path in paths:
+            if path not in changes:
+                continue
+            # The unchanged sections are copied from the file as it was
+            # scanned, so it mustn't have changed since
+            if _stamp(path) != stamps[path]:
+                info("Skipping", path, "(changed since it was read)")
+                failed += 1
+                continue
+            with BinReader(path) as br:
+                with BinWriter.BinWriter() as wr:
+                    self._write(br, indexes[path], changes[path], wr)
+                    data = wr.getvalue()
+            ret = FCHValidator(verify_checksum=False).validate(data)
+            if ret is not None:
+                info("Skipping", path, "(merged data is inconsistent, " +
+                     "{})".format(ret))
+                failed += 1
+                continue
+            BinWriter.replace_file(path, data, compress='none')
+            written += 1
+        return (written, len(indexes) - len(changes), failed)
+
+    def _merge_markers(self, member, members):
+        incoming = []
+        for m in members:
+            if m is member:
+                continue
+            incoming.extend([v for v in m.markers if v.symbol in
+                             Valheim.WorldMarkerType_shared])
+        if len(incoming) == 0:
+            return member.markers
+        index = MarkerIndex.MarkerIndex(member.markers + incoming)
+        groups = index.duplicates(self.tolerance,
+                                  key=lambda v: (v.text, v.symbol))
+        # Only drop incoming markers, the member's own are left alone
+        own = set([id(v) for v in member.markers])
+        drop = set([id(v) for g in groups for v in g[1:]
+                    if id(v) not in own])
+        return member.markers + [v for v in incoming if id(v) not in drop]
+
+    def _write(self, br, index, changes, binwr):
+        # Like FCH_Root.toBinary(), but copying the unchanged sections
+        def copy(section):
+            binwr.write_raw(br.read(section.size, section.offset))
+        byte_count_pos = binwr.tell()
+        binwr.write_i32(0)
+        data_start_pos = binwr.tell()
+        if _have_sha512:
+            binwr.start_hash(hashlib.sha512())
+        copy(index.stats)
+        copy(index.world_count)
+        for i in range(len(index.worlds)):
+            w = index.worlds[i]
+            vis = changes.get(i)
+            if vis is None:
+                copy(w.header)
+                if w.visibility is not None:
+                    copy(w.visibility)
+                continue
+            # The header ends with the visibility byte count
+            binwr.write_raw(br.read(w.header.size - 4, w.header.offset))
+            binwr.write_sized(vis.toBinary, size=vis.binSize())
+        copy(index.player_data)
+        m = binwr.end_hash()
+        byte_count = binwr.tell() - data_start_pos
+        if m is not None:
+            checksum = m.digest()
+        else:
+            checksum = b'\x00' * 64
+        binwr.write_i32(len(checksum))
+        binwr.write_raw(checksum)
+        binwr.write_i32(byte_count, pos=byte_count_pos)
+        return
+
+# vim:ts=4:sw=4:et
@@ -0,0 +1,257 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+import os
+import sqlite3
+import struct
+import time
+
+# Local modules
+import FCHBatch
+import Valheim
+
+from LocalUtil import *
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    checksum BLOB NOT NULL,
+    exported_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS players (
+    file_id INTEGER PRIMARY KEY REFERENCES files(file_id),
+    player_id INTEGER,
+    name TEXT,
+    file_version INTEGER,
+    kills INTEGER,
+    deaths INTEGER,
+    crafts INTEGER,
+    builds INTEGER,
+    player_version INTEGER,
+    health REAL,
+    health_max REAL,
+    stamina_max REAL,
+    first_spawn INTEGER,
+    time_since_death REAL,
+    guardian_power TEXT,
+    guardian_power_cooldown REAL,
+    beard TEXT,
+    hair TEXT,
+    body_type INTEGER
+);
+CREATE INDEX IF NOT EXISTS players_player_id ON players(player_id);
+CREATE INDEX IF NOT EXISTS players_name ON players(name);
+CREATE TABLE IF NOT EXISTS items (
+    file_id INTEGER REFERENCES files(file_id),
+    name TEXT,
+    count INTEGER,
+    durability REAL,
+    slot_x INTEGER,
+    slot_y INTEGER,
+    equipped INTEGER,
+    level INTEGER,
+    style INTEGER,
+    crafter_id INTEGER,
+    crafter_name TEXT
+);
+CREATE INDEX IF NOT EXISTS items_file_id ON items(file_id);
+CREATE INDEX IF NOT EXISTS items_name ON items(name);
+CREATE TABLE IF NOT EXISTS skills (
+    file_id INTEGER REFERENCES files(file_id),
+    skill_id INTEGER,
+    skill TEXT,
+    level REAL,
+    experience REAL
+);
+CREATE INDEX IF NOT EXISTS skills_file_id ON skills(file_id);
+CREATE INDEX IF NOT EXISTS skills_skill ON skills(skill);
+CREATE TABLE IF NOT EXISTS biomes (
+    file_id INTEGER REFERENCES files(file_id),
+    biome_id INTEGER,
+    biome TEXT
+);
+CREATE INDEX IF NOT EXISTS biomes_file_id ON biomes(file_id);
+CREATE INDEX IF NOT EXISTS biomes_biome ON biomes(biome);
+CREATE TABLE IF NOT EXISTS known (
+    file_id INTEGER REFERENCES files(file_id),
+    kind TEXT,
+    name TEXT
+);
+CREATE INDEX IF NOT EXISTS known_file_id ON known(file_id);
+CREATE INDEX IF NOT EXISTS known_kind_name ON known(kind, name);
+CREATE TABLE IF NOT EXISTS worlds (
+    file_id INTEGER REFERENCES files(file_id),
+    world_index INTEGER,
+    uid INTEGER,
+    spawn_x REAL, spawn_y REAL, spawn_z REAL,
+    logout_x REAL, logout_y REAL, logout_z REAL,
+    death_x REAL, death_y REAL, death_z REAL,
+    home_x REAL, home_y REAL, home_z REAL,
+    edge_length INTEGER,
+    public_position INTEGER
+);
+CREATE INDEX IF NOT EXISTS worlds_file_id ON worlds(file_id);
+CREATE INDEX IF NOT EXISTS worlds_uid ON worlds(uid);
+CREATE TABLE IF NOT EXISTS markers (
+    file_id INTEGER REFERENCES files(file_id),
+    world_index INTEGER,
+    uid INTEGER,
+    text TEXT,
+    x REAL, y REAL, z REAL,
+    symbol TEXT,
+    crossed INTEGER
+);
+CREATE INDEX IF NOT EXISTS markers_file_id ON markers(file_id);
+CREATE INDEX IF NOT EXISTS markers_uid ON markers(uid);
+"""
+
+# Tables holding per-file rows, in the order _rows() returns them, with
+# the number of columns after file_id.
+_TABLES = (
+    ('players', 18),
+    ('items', 10),
+    ('skills', 4),
+    ('biomes', 2),
+    ('known', 2),
+    ('worlds', 16),
+    ('markers', 8),
+)
+
+def _point(have, p):
+    if not have:
+        return [None, None, None]
+    return list(p)
+
+def _rows(path):
+    """
+    Worker side of the export: load path and flatten it into rows. The
+    minimap pixels aren't exported, so they're skipped rather than decoded.
+    """
+    fh = FCHBatch.load(path, skip_pixels=True)
+    stats = fh.player_stats
+    pd = fh.player_data
+    players = [(
+        pd.player_id, pd.name, stats.version, stats.kill_count,
+        stats.death_count, stats.craft_count, stats.build_count, pd.version,
+        pd.health, pd.health_max, pd.stamina_max, pd.first_spawn,
+        pd.time_since_death, pd.gp_name, pd.gp_cooldown, pd.appearance.beard,
+        pd.appearance.hair, pd.appearance.body_type,
+    )]
+    items = [(
+        v.name, v.count, v.durability, v.slot[0], v.slot[1], v.equipped,
+        v.level, v.style, v.crafter_id, v.crafter_name,
+    ) for v in pd.inventory.items]
+    skills = [(
+        Valheim.SkillType_a2i(v.skill), v.skill, v.level, v.exp,
+    ) for v in pd.skill_list.skills]
+    biomes = [(
+        Valheim.BiomeType_a2i(v.biome_str), v.biome_str,
+    ) for v in pd.known_biomes]
+    known = []
+    for (kind, l) in (('recipe', pd.known_recipes),
+                      ('material', pd.discovered_materials),
+                      ('tutorial', pd.shown_tutorials),
+                      ('unique', pd.discovered_uniques),
+                      ('trophy', pd.trophies)):
+        known.extend([(kind, name) for name in l])
+    worlds = []
+    markers = []
+    for (i, w) in enumerate(fh.worlds.worlds):
+        row = [i, w.uid]
+        row += _point(w.have_spawn_point, w.spawn_point)
+        row += _point(w.have_logout_point, w.logout_point)
+        row += _point(w.have_death_point, w.death_point)
+        row += list(w.home_point)
+        if w.have_vis_data:
+            row += [w.vis_data.edge_length, w.vis_data.public_position]
+        else:
+            row += [None, None]
+        worlds.append(tuple(row))
+        for m in w.vis_data.marker_list.markers:
+            markers.append((i, w.uid, m.text, m.point[0], m.point[1],
+                            m.point[2], m.symbol, m.crossed))
+    return (players, items, skills, biomes, known, worlds, markers)
+
+
+class FCHSQLite:
+    """
+    Exports many FCH files into a normalized SQLite database.
+
+    Every file gets a row in 'files' keyed by its path. The other tables
+    reference it through file_id. Exports are incremental: files whose
+    checksum matches the one stored from a previous export are skipped,
+    and changed files have their old rows replaced.
+    """
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+
+    def _stale(self, paths):
+        # Returns {path: checksum} for the files needing an export
+        known = dict(self.conn.execute("SELECT path, checksum FROM files"))
+        ret = {}
+        for p in paths:
+            try:
+                checksum = FCHBatch.file_checksum(p)
+            except (OSError, IndexError, struct.error) as e:
+                info("Cannot read checksum of", p, "({})".format(e))
+                # Let the export report the failure
+                checksum = b''
+            if known.get(p) != checksum:
+                ret[p] = checksum
+        return ret
+
+    def _replace(self, path, checksum, rows):
+        cur = self.conn.cursor()
+        row = cur.execute("SELECT file_id FROM files WHERE path = ?",
+                          (path,)).fetchone()
+        if row is not None:
+            file_id = row[0]
+            for (table, ncols) in _TABLES:
+                cur.execute("DELETE FROM {} WHERE file_id = ?".format(table),
+                            (file_id,))
+            cur.execute("UPDATE files SET checksum = ?, exported_at = ? " +
+                        "WHERE file_id = ?", (checksum, time.time(), file_id))
+        else:
+            cur.execute("INSERT INTO files (path, checksum, exported_at) " +
+                        "VALUES (?, ?, ?)", (path, checksum, time.time()))
+            file_id = cur.lastrowid
+        for ((table, ncols), table_rows) in zip(_TABLES, rows):
+            sql = "INSERT INTO {} VALUES ({})".format(
+                table, ', '.join(['?'] * (ncols + 1)))
+            cur.executemany(sql, [(file_id,) + r for r in table_rows])
+
+    def export(self, paths, workers=None):
+        """
+        Export paths, parsing the files in worker processes.
+
+        Everything is written in a single transaction. Returns a tuple of
+        (exported, skipped, failed) counts.
+        """
+        paths = [os.path.abspath(p) for p in paths]
+        stale = self._stale(paths)
+        exported = 0
+        failed = 0
+        with self.conn:
+            for (path, rows, err) in FCHBatch.run(_rows, list(stale),
+                                                  workers=workers):
+                if err is not None:
+                    info("Failed to export", path, "({})".format(err))
+                    failed += 1
+                    continue
+                self._replace(path, stale[path], rows)
+                exported += 1
+        return (exported, len(paths) - len(stale), failed)
+
+# vim:ts=4:sw=4:et
@@ -0,0 +1,289 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+try:
+    import hashlib
+    _have_sha512 = True
+except ImportError:
+    _have_sha512 = False
+import mmap
+import os
+import struct
+
+# Local modules
+import DecodePlan
+import WBitMatrix
+from BinReader import BinReader
+from BinWriter import BinWriter
+from FCH import FCH_PlayerData, FCH_Root, FCH_World, FCH_WorldMarker
+from FCHValidate import FCHValidator, read_file
+
+_s_i32 = struct.Struct("<i")
+
+class _Lost(Exception):
+    # Raised with the offset where the data becomes unusable
+    pass
+
+
+class FCHSalvage:
+    """
+    Recovers what it can from a truncated or corrupted FCH file.
+
+    The embedded byte counts of the world visibility data and the player
+    data are used to find the start of each section, so damage inside one
+    section doesn't take the following ones with it. Within a section,
+    whatever was read before the damage is kept where that makes sense
+    (e.g. the pixels of a world whose markers are damaged, or the
+    inventory of a player whose skills are), the rest is dropped.
+
+    salvage() returns the recovered FCH_Root and a list of the losses, each
+    naming the byte offset where the damage was found.
+    """
+    def salvage(self, buf):
+        """
+        Salvage the FCH file in buf (any buffer-protocol object). Returns a
+        tuple of (FCH_Root, losses), the FCH_Root being None if nothing
+        could be recovered.
+        """
+        self.buf = memoryview(buf).cast('B')
+        self.losses = []
+        try:
+            fh = self._file()
+        finally:
+            self.buf.release()
+            self.buf = None
+        return (fh, self.losses)
+
+    def _lose(self, offset, message):
+        self.losses.append("offset {}: {}".format(offset, message))
+
+    def _reader(self, start, end):
+        # A reader over [start, end) of the file; tell() is relative to start
+        return BinReader(self.buf[start:end])
+
+    def _file(self):
+        size = len(self.buf)
+        if size < 4:
+            self._lose(0, "No data")
+            return None
+        byte_count = _s_i32.unpack_from(self.buf, 0)[0]
+        end = 4 + byte_count
+        if (byte_count < 0) or (end > size):
+            self._lose(min(max(end, 0), size),
+                       "Truncated, {} of {} data bytes present".format(
+                           size - 4, byte_count))
+            end = size
+        elif not self._checksum_ok(byte_count):
+            self._lose(end, "Checksum mismatch")
+
+        fh = FCH_Root()
+        with self._reader(4, end) as br:
+            try:
+                fh.player_stats.fromBinary(br)
+            except (Exception, SystemExit):
+                self._lose(4, "Player stats unreadable, nothing recovered")
+                return None
+            pos = 4 + br.tell()
+        try:
+            pos = self._worlds(fh, pos, end)
+        except _Lost as e:
+            # Everything from the damaged world on is gone
+            self._lose(e.args[0], "Player data lost")
+            return fh
+        self._player_data(fh.player_data, pos, end)
+        return fh
+
+    def _checksum_ok(self, byte_count):
+        end = 4 + byte_count
+        if len(self.buf) < end + 4:
+            return False
+        checksum_size = _s_i32.unpack_from(self.buf, end)[0]
+        checksum = self.buf[end + 4:end + 4 + checksum_size].tobytes()
+        if not _have_sha512:
+            return True
+        return hashlib.sha512(self.buf[4:end]).digest() == checksum
+
+    def _worlds(self, fh, pos, end):
+        # Returns where the player data starts, raises _Lost if that's not
+        # known
+        file_version = fh.player_stats.version
+        plan = DecodePlan.get_plan(FCH_World, file_version)
+        header_size = plan.fixed_size()
+        if pos + 4 > end:
+            self._lose(pos, "World count missing")
+            raise _Lost(pos)
+        count = _s_i32.unpack_from(self.buf, pos)[0]
+        if (count < 0) or (pos + 4 + (count * header_size) > end):
+            self._lose(pos, "World count {} damaged, worlds lost".format(
+                count))
+            raise _Lost(pos)
+        pos += 4
+        for i in range(count):
+            if pos + header_size > end:
+                self._lose_worlds(pos, i, count)
+                raise _Lost(pos)
+            w = FCH_World()
+            with self._reader(pos, pos + header_size) as br:
+                plan.read(br, w)
+            pos += header_size
+            what = "World {} (UID {})".format(i, w.uid)
+            if w.have_vis_data:
+                if pos + 4 > end:
+                    self._lose(pos, what + " visibility data lost")
+                    w.have_vis_data = False
+                    fh.worlds.worlds.append(w)
+                    self._lose_worlds(pos, i + 1, count)
+                    raise _Lost(pos)
+                world_bytes = _s_i32.unpack_from(self.buf, pos)[0]
+                pos += 4
+                vis_end = pos + world_bytes
+                if (world_bytes < 0) or (vis_end > end):
+                    # Nothing to resynchronize on past this
+                    self._visibility(w, what, pos, end)
+                    fh.worlds.worlds.append(w)
+                    self._lose_worlds(pos, i + 1, count)
+                    raise _Lost(pos)
+                self._visibility(w, what, pos, vis_end)
+                pos = vis_end
+            fh.worlds.worlds.append(w)
+        return pos
+
+    def _lose_worlds(self, pos, first, count):
+        if first < count:
+            self._lose(pos, "Worlds {} to {} lost".format(first, count - 1))
+
+    def _visibility(self, w, what, start, end):
+        vis = w.vis_data
+        with self._reader(start, end) as br:
+            try:
+                vis.fromBinary(br)
+                if br.tell() == end - start:
+                    return
+            except (Exception, SystemExit):
+                pass
+        # Keep the pixels, and as many markers as can be read
+        vis.clear()
+        with self._reader(start, end) as br:
+            try:
+                vis.version = br.read_i32()
+                vis.edge_length = br.read_i32()
+                if (vis.version > vis.CURRENT_VERSION) or \
+                        (vis.edge_length < 0):
+                    raise ValueError()
+                vis.pixel_data = WBitMatrix.load_matrix(br, vis.edge_length,
+                                                        vis.edge_length)
+            except (Exception, SystemExit):
+                self._lose(start, what + " visibility data lost")
+                vis.clear()
+                w.have_vis_data = False
+                return
+            pos = start + br.tell()
+            if vis.version < 2:
+                self._lose(pos, what + " visibility data damaged")
+                return
+            markers = vis.marker_list.markers
+            count = None
+            try:
+                count = br.read_i32()
+                # Each marker takes at least 17 bytes
+                if (count < 0) or (17 * count > end - start - br.tell()):
+                    self._lose(pos, "{} marker count {} damaged".format(
+                        what, count))
+                    return
+                plan = DecodePlan.get_plan(FCH_WorldMarker, vis.version)
+                for i in range(count):
+                    markers.append(plan.read(br, FCH_WorldMarker()))
+                    pos = start + br.tell()
+            except (Exception, SystemExit):
+                pass
+            if (count is not None) and (len(markers) < count):
+                self._lose(pos, "{} {} of {} markers lost".format(
+                    what, count - len(markers), count))
+            else:
+                self._lose(pos, "{} visibility data damaged after the {}"
+                           .format(what, "pixels" if count is None else
+                                   "markers"))
+
+    def _player_data(self, pd, start, end):
+        with self._reader(start, end) as br:
+            try:
+                pd.name = br.read_str()
+                pd.player_id = br.read_i64()
+                pd.start_seed = br.read_binstr()
+                if not br.read_bool():
+                    return
+            except (Exception, SystemExit):
+                self._lose(start + br.tell(), "Player data lost")
+                pd.clear()
+                return
+            try:
+                byte_count = br.read_i32()
+                section_end = br.tell() + byte_count
+                if (byte_count < 0) or (section_end > end - start):
+                    self._lose(start + br.tell() - 4,
+                               "Player data truncated")
+                version = br.read_i32()
+                if (version > pd.CURRENT_VERSION) or (version <= 20):
+                    raise ValueError()
+                pd.version = version
+                DecodePlan.get_plan(FCH_PlayerData, version).read(br, pd)
+            except (Exception, SystemExit):
+                # Only the name, ID and seed survive
+                self._lose(start + br.tell(), "Player data lost")
+                (name, player_id, start_seed) = (pd.name, pd.player_id,
+                                                 pd.start_seed)
+                pd.clear()
+                (pd.name, pd.player_id, pd.start_seed) = (name, player_id,
+                                                          start_seed)
+                return
+            blank = FCH_PlayerData()
+            lost = None
+            for name in pd.binSections(version):
+                if lost is None:
+                    pos = start + br.tell()
+                    try:
+                        getattr(pd, name).fromBinary(br)
+                        continue
+                    except (Exception, SystemExit):
+                        lost = [name]
+                else:
+                    lost.append(name)
+                # Back to a blank part, rather than a partially read one
+                setattr(pd, name, getattr(blank, name))
+            if lost is not None:
+                self._lose(pos, "Player data lost: {}".format(
+                    ", ".join(lost)))
+
+
+def salvage_file(path, outdir=None, overwrite=False):
+    """
+    Triage the FCH file at path. Returns a tuple of (status, losses) with
+    status one of:
+      'ok':       The file is intact (see FCHValidator).
+      'salvaged': Parts of it were recovered; losses lists what wasn't.
+      'lost':     Nothing could be recovered.
+
+    With outdir, salvaged files are written there under the same name with
+    a fresh checksum.
+    """
+    buf = read_file(path)
+    try:
+        if FCHValidator().validate(buf) is None:
+            return ('ok', [])
+        (fh, losses) = FCHSalvage().salvage(buf)
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+    if fh is None:
+        return ('lost', losses)
+    if outdir is not None:
+        data = fh.toBytes()
+        # What's written has to hold up, at least structurally
+        ret = FCHValidator(verify_checksum=False).validate(data)
+        if ret is not None:
+            raise RuntimeError("Salvaged data is inconsistent, {}".format(ret))
+        out = os.path.join(outdir, os.path.basename(path))
+        with BinWriter(out, overwrite=overwrite) as wr:
+            wr.write_raw(data)
+    return ('salvaged', losses)
+
+# vim:ts=4:sw=4:et
@@ -0,0 +1,167 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+
+# Local modules
+from LocalUtil import *
+from PrettyPrinter import PPWrap
+
+class FCHSection:
+    """
+    A byte range of an FCH file.
+    """
+    def __init__(self, kind, offset, size):
+        self.kind = kind
+        self.offset = offset
+        self.size = size
+
+    def end(self):
+        return self.offset + self.size
+
+    def __repr__(self):
+        return "FCHSection({!r}, {}, {})".format(self.kind, self.offset,
+                                                 self.size)
+
+
+class FCHWorldSections:
+    """
+    Where a world's data lives in an FCH file.
+
+      header:     From the UID up to, and including, the HaveVisibilityData
+                  flag (and the i32 visibility byte count, if present).
+      visibility: The visibility data (version, edge length, pixels,
+                  markers, ...) or None if the world has none.
+      pixels:     Just the EdgeLen x EdgeLen pixel bytes, or None.
+    """
+    def __init__(self):
+        self.uid = 0
+        self.header = None
+        self.visibility = None
+        self.pixels = None
+        self.vis_version = 0
+        self.edge_length = 0
+
+    def pixel_offset(self, x, y):
+        """
+        File offset of pixel (x,y), with y in on-disk (bottom-up) order.
+        """
+        return self.pixels.offset + (y * self.edge_length) + x
+
+
+class FCHSectionIndex:
+    """
+    Locates the sections of an FCH file without decoding them.
+
+    Only the few fixed size fields needed to find the next section are read;
+    the visibility data and the player data are skipped over using their
+    embedded byte counts.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.data = None # Data segment (FCHSection)
+        self.file_version = 0
+        self.stats = None
+        self.world_count = None # The i32 world count
+        self.worlds = [] # FCHWorldSections
+        self.player_data = None
+        self.checksum = None
+
+    def fromBinary(self, binrdr):
+        self.clear()
+        byte_count = binrdr.read_i32()
+        self.data = FCHSection('data', binrdr.tell(), byte_count)
+
+        # Player stats
+        start = binrdr.tell()
+        self.file_version = binrdr.read_i32()
+        if self.file_version >= 28:
+            binrdr.skip(4 * 4)
+        self.stats = FCHSection('stats', start, binrdr.tell() - start)
+
+        # Worlds
+        self.world_count = FCHSection('world_count', binrdr.tell(), 4)
+        world_count = binrdr.read_i32()
+        for i in range(world_count):
+            self.worlds.append(self._read_world(binrdr))
+
+        # Player data runs up to the end of the data segment
+        start = binrdr.tell()
+        if start > self.data.end():
+            die("FCH world data runs past the end of the data segment")
+        self.player_data = FCHSection('player_data', start,
+                                      self.data.end() - start)
+
+        binrdr.push_pos(self.data.end())
+        checksum_size = binrdr.read_i32()
+        self.checksum = FCHSection('checksum', binrdr.tell(), checksum_size)
+        binrdr.pop_pos()
+        return
+
+    def _read_world(self, binrdr):
+        w = FCHWorldSections()
+        start = binrdr.tell()
+        w.uid = binrdr.read_i64()
+        # Spawn and logout points (a flag and three floats each)
+        binrdr.skip(2 * 13)
+        if self.file_version >= 30:
+            # Death point
+            binrdr.skip(13)
+        # Home point
+        binrdr.skip(12)
+        have_vis_data = False
+        if self.file_version >= 29:
+            have_vis_data = binrdr.read_bool()
+        world_bytes = 0
+        if have_vis_data:
+            world_bytes = binrdr.read_i32()
+        w.header = FCHSection('world_header', start, binrdr.tell() - start)
+        if have_vis_data:
+            vis_start = binrdr.tell()
+            w.visibility = FCHSection('visibility', vis_start, world_bytes)
+            w.vis_version = binrdr.read_i32()
+            w.edge_length = binrdr.read_i32()
+            pixel_count = w.edge_length * w.edge_length
+            w.pixels = FCHSection('pixels', binrdr.tell(), pixel_count)
+            if w.pixels.end() > w.visibility.end():
+                die("World visibility data of world {}".format(w.uid),
+                    "is larger than its byte count")
+            # Skip the pixels and markers
+            binrdr.skip(w.visibility.end() - binrdr.tell())
+        return w
+
+    def sections(self):
+        """
+        All the sections of the data segment, in file order.
+        """
+        ret = [self.stats, self.world_count]
+        for w in self.worlds:
+            ret.append(w.header)
+            if w.visibility is not None:
+                ret.append(w.visibility)
+        ret.append(self.player_data)
+        return ret
+
+    def printInfo(self, pp):
+        def pr(s):
+            pp.println("{}:".format(s.kind), "offset {} size {}".format(
+                s.offset, s.size))
+        pr(self.data)
+        pp.println("File Version:", self.file_version)
+        pr(self.stats)
+        pp.println("Worlds:", len(self.worlds))
+        for i in range(len(self.worlds)):
+            w = self.worlds[i]
+            pp.println("{}:".format(i))
+            with PPWrap(pp):
+                pp.println("UID:", w.uid)
+                pr(w.header)
+                if w.visibility is not None:
+                    pr(w.visibility)
+                    pr(w.pixels)
+                    pp.println("Edge Length:", w.edge_length)
+        pr(self.player_data)
+        pr(self.checksum)
+        return
+
+# vim:ts=4:sw=4:et
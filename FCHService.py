@@ -0,0 +1,312 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+import asyncio
+import collections
+import concurrent.futures
+import copy
+import io
+import json
+import os
+import signal
+import socket
+
+# Local modules
+import BinWriter
+import FCHBatch
+
+from BinReader import BinReader
+from FCH import FCH_Root
+from LocalUtil import die, info
+from MapTiles import MapTileExporter
+
+def _destruct(path, outdir, overwrite):
+    """
+    Worker: destruct path to outdir.
+    """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    fh = FCH_Root()
+    with BinReader(path) as br:
+        fh.destructStream(br, outdir, overwrite=overwrite)
+    return outdir
+
+
+class RequestError(Exception):
+    """
+    A request that can't be served, reported back to the client.
+    """
+    pass
+
+
+class FCHService:
+    """
+    Serves FCH files over a Unix domain socket, keeping recently used files
+    loaded.
+
+    The protocol is JSON lines: each request is a JSON object on a line of
+    its own, answered by one line of JSON:
+      {"id": 1, "op": "info", "path": "viking.fch"}
+      {"id": 1, "ok": true, "result": ...}
+      {"id": 1, "ok": false, "error": "..."}
+
+    The "id" is optional and echoed back; requests on one connection may be
+    answered out of order. Operations (see the _op_* methods):
+      info:   "format" text or jsonl (default).
+      query:  "pixel" [X,Y], "crop" [X,Y,W,H] or "count_explored" [X,Y,W,H]
+              in top-down (PBM) coordinates.
+      patch:  "reveal"/"hide" lists of [CENTER, RADIUS], CENTER being
+              spawn, home, logout, death or [X,Z]; "dedupe_markers"
+              meters; written to "output" or back to "path".
+      export: "destruct" or "tiles" (with "tile_size", "tile_mode",
+              "tile_format") naming the output directory.
+    query, patch and tiles take a "world" index (default 0) or "world_uid".
+
+    Files are decoded in a pool of worker processes and the results kept
+    in an LRU cache of cache_size files, keyed by path, modification time
+    and size, so changed files are picked up.
+    """
+    def __init__(self, socket_path, workers=None, cache_size=8):
+        self.socket_path = socket_path
+        self.workers = workers
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict() # key -> FCH_Root
+        self.loading = {} # key -> Future of a load in progress
+        self.locks = {} # path -> asyncio.Lock for patches
+        self.pool = None
+        self.server = None
+
+    def serve(self):
+        """
+        Serve until interrupted (SIGINT or SIGTERM).
+        """
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        await self._start()
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        info("Serving on", self.socket_path)
+        try:
+            await stop.wait()
+        finally:
+            await self._stop()
+        info("Stopped serving")
+
+    async def _start(self):
+        self._claim_socket()
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+        # Start the workers before accepting anything: forked workers would
+        # otherwise inherit the client connections open at the time, and
+        # keep them open after the service closes its end.
+        await asyncio.get_running_loop().run_in_executor(self.pool,
+                                                         os.getpid)
+        self.server = await asyncio.start_unix_server(self._client,
+                                                      path=self.socket_path)
+
+    async def _stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.pool.shutdown(cancel_futures=True)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def _claim_socket(self):
+        # Take over a socket left behind, but not one that's still in use
+        if not os.path.exists(self.socket_path):
+            return
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self.socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(self.socket_path)
+            return
+        finally:
+            s.close()
+        die("Already serving on", self.socket_path)
+
+    async def _client(self, reader, writer):
+        tasks = set()
+        write_lock = asyncio.Lock()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip() == b'':
+                    continue
+                t = asyncio.ensure_future(self._respond(line, writer,
+                                                        write_lock))
+                tasks.add(t)
+                t.add_done_callback(tasks.discard)
+            if len(tasks) != 0:
+                await asyncio.wait(tasks)
+        finally:
+            writer.close()
+
+    async def _respond(self, line, writer, write_lock):
+        rid = None
+        try:
+            req = json.loads(line)
+            if not isinstance(req, dict):
+                raise RequestError("Requests have to be JSON objects")
+            rid = req.get('id')
+            op = getattr(self, '_op_' + str(req.get('op')), None)
+            if op is None:
+                raise RequestError("Unknown op: {}".format(req.get('op')))
+            resp = {'id': rid, 'ok': True, 'result': await op(req)}
+        except RequestError as e:
+            resp = {'id': rid, 'ok': False, 'error': str(e)}
+        except ValueError as e:
+            # Includes bad JSON, and out of range coordinates
+            resp = {'id': rid, 'ok': False,
+                    'error': " ".join([str(a) for a in e.args])}
+        except SystemExit:
+            # die() has already explained what went wrong on stderr
+            resp = {'id': rid, 'ok': False, 'error': "Failed"}
+        except Exception as e:
+            resp = {'id': rid, 'ok': False,
+                    'error': "{}: {}".format(type(e).__name__, e)}
+        async with write_lock:
+            writer.write(json.dumps(resp).encode('utf-8') + b'\n')
+            await writer.drain()
+
+    def _path(self, req, key='path'):
+        path = req.get(key)
+        if not isinstance(path, str):
+            raise RequestError("Missing '{}'".format(key))
+        return os.path.abspath(path)
+
+    def _key(self, path):
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            raise RequestError("Can't open {}: {}".format(path, e.strerror))
+        return (path, st.st_mtime_ns, st.st_size)
+
+    async def _load(self, path):
+        """
+        Get the FCH_Root for path, from the cache or decoded by the pool.
+        The result is shared; copy it before making changes.
+        """
+        key = self._key(path)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        # Requests for a file that's already loading wait for that load
+        fut = self.loading.get(key)
+        if fut is None:
+            loop = asyncio.get_running_loop()
+            fut = loop.run_in_executor(self.pool, FCHBatch.load, path)
+            self.loading[key] = fut
+            try:
+                fh = await fut
+            finally:
+                del self.loading[key]
+            self._store(key, fh)
+            return fh
+        return await asyncio.shield(fut)
+
+    def _store(self, key, fh):
+        # Older versions of the file won't be asked for again
+        for k in [k for k in self.cache if k[0] == key[0]]:
+            del self.cache[k]
+        self.cache[key] = fh
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _world(self, fh, req):
+        world = fh.worlds.getWorld(req.get('world', 0),
+                                   uid=req.get('world_uid'))
+        if (world is None) or (not world.have_vis_data):
+            raise RequestError("No such world with visibility data")
+        return world
+
+    async def _op_info(self, req):
+        fh = await self._load(self._path(req))
+        fmt = req.get('format', 'jsonl')
+        out = io.StringIO()
+        fh.printInfo(fmt=fmt, out=out)
+        if fmt == 'jsonl':
+            return [json.loads(l) for l in out.getvalue().splitlines()]
+        return out.getvalue()
+
+    async def _op_query(self, req):
+        fh = await self._load(self._path(req))
+        wbm = self._world(fh, req).vis_data.pixel_data
+        if 'pixel' in req:
+            (x, y) = req['pixel']
+            return wbm.get(x, y, flipped=True)
+        for kind in ('crop', 'count_explored'):
+            if kind in req:
+                (x, y, w, h) = req[kind]
+                break
+        else:
+            raise RequestError("query needs pixel, crop or count_explored")
+        if (x < 0) or (y < 0) or (w < 0) or (h < 0) or \
+                (x + w > wbm.get_width()) or (y + h > wbm.get_height()):
+            raise ValueError("Area", [x, y, w, h], "is out of range")
+        rows = [wbm.get_row_bytes(r, flipped=True)[x:x+w]
+                for r in range(y, y + h)]
+        if kind == 'count_explored':
+            return sum([r.count(1) for r in rows])
+        return [r.translate(bytes.maketrans(b'\x00\x01', b'01')).decode()
+                for r in rows]
+
+    async def _op_patch(self, req):
+        path = self._path(req)
+        output = self._path(req, 'output') if 'output' in req else path
+        lock = self.locks.setdefault(output, asyncio.Lock())
+        async with lock:
+            if os.path.exists(output) and not req.get('overwrite', False):
+                raise RequestError("{} exists, patch needs "
+                                   "\"overwrite\": true".format(output))
+            fh = copy.deepcopy(await self._load(path))
+            world = self._world(fh, req)
+            changes = [(1, r) for r in req.get('reveal', [])] + \
+                      [(0, r) for r in req.get('hide', [])]
+            for (value, (center, radius)) in changes:
+                if isinstance(center, str):
+                    name = center
+                    center = world.namedPoint(name)
+                    if center is None:
+                        raise RequestError("World has no {} point".format(
+                            name))
+                else:
+                    # [X, Z] on the map plane
+                    center = [center[0], 0.0, center[1]]
+                world.vis_data.fillCircle(center, radius, value)
+            removed = 0
+            if req.get('dedupe_markers') is not None:
+                removed = world.vis_data.marker_list.dedupe(
+                        req['dedupe_markers'])
+            # Serializing is CPU bound, keep it off the event loop
+            def write():
+                BinWriter.replace_file(output, fh.toBytes())
+            await asyncio.get_running_loop().run_in_executor(None, write)
+            self._store(self._key(output), fh)
+        return {'output': output, 'removed_markers': removed}
+
+    async def _op_export(self, req):
+        path = self._path(req)
+        loop = asyncio.get_running_loop()
+        if 'destruct' in req:
+            outdir = self._path(req, 'destruct')
+            await loop.run_in_executor(self.pool, _destruct, path, outdir,
+                                       bool(req.get('overwrite', False)))
+            return {'destruct': outdir}
+        if 'tiles' in req:
+            outdir = self._path(req, 'tiles')
+            fh = await self._load(path)
+            vis = self._world(fh, req).vis_data
+            exporter = MapTileExporter(
+                    tile_size=req.get('tile_size', 256),
+                    mode=req.get('tile_mode', 'or'),
+                    fmt=req.get('tile_format', 'png'))
+            (written, skipped) = await loop.run_in_executor(
+                    None, exporter.export, vis, outdir)
+            return {'tiles': outdir, 'written': written, 'skipped': skipped}
+        raise RequestError("export needs destruct or tiles")
+
+# vim:ts=4:sw=4:et
@@ -0,0 +1,304 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+try:
+    import hashlib
+    _have_sha512 = True
+except ImportError:
+    _have_sha512 = False
+import mmap
+import os
+import struct
+
+# Local modules
+import Compression
+import DecodePlan
+from FCH import FCH_Inventory, FCH_PlayerData, FCH_PlayerStats, \
+                FCH_SkillList, FCH_World, FCH_WorldVisibility
+
+_s_i32 = struct.Struct("<i")
+
+class FCHInconsistency(Exception):
+    """
+    Where, and how, an FCH file doesn't add up.
+    """
+    def __init__(self, offset, message):
+        super().__init__(offset, message)
+        self.offset = offset
+        self.message = message
+
+    def __str__(self):
+        return "offset {}: {}".format(self.offset, self.message)
+
+
+class FCHValidator:
+    """
+    Checks an FCH file is well-formed without decoding it: the structure is
+    walked with offset arithmetic, checking that the byte counts, list
+    counts and string lengths all fit together, the versions are known,
+    and the checksum matches. The minimap pixels are never looked at.
+    """
+    def __init__(self, verify_checksum=True):
+        self.verify_checksum = verify_checksum
+
+    def validate(self, buf):
+        """
+        Check the FCH file in buf (any buffer-protocol object).
+
+        Returns None if it's valid, otherwise the FCHInconsistency found
+        first.
+        """
+        self.buf = memoryview(buf).cast('B')
+        self.pos = 0
+        try:
+            self._file()
+        except FCHInconsistency as e:
+            # Drop the frames, they'd keep views of buf alive
+            return e.with_traceback(None)
+        finally:
+            self.buf.release()
+            self.buf = None
+        return None
+
+    def _fail(self, message, offset=None):
+        raise FCHInconsistency(self.pos if offset is None else offset,
+                               message)
+
+    def _need(self, size, what):
+        if (size < 0) or (self.pos + size > self.end):
+            self._fail("{} runs past the end of {}".format(what,
+                                                          self.end_name))
+
+    def _skip(self, size, what):
+        self._need(size, what)
+        self.pos += size
+
+    def _i32(self, what):
+        self._need(4, what)
+        v = _s_i32.unpack_from(self.buf, self.pos)[0]
+        self.pos += 4
+        return v
+
+    def _u8(self, what):
+        self._need(1, what)
+        v = self.buf[self.pos]
+        self.pos += 1
+        return v
+
+    def _count(self, what, min_size):
+        # A list count that can't be negative, nor have its entries (of at
+        # least min_size bytes each) overrun the section.
+        start = self.pos
+        count = self._i32(what + " count")
+        if (count < 0) or (self.pos + (count * min_size) > self.end):
+            self._fail("{} count {} doesn't fit in {}".format(
+                what, count, self.end_name), start)
+        return count
+
+    def _str(self, what):
+        # A C# 7-bit length prefixed string, see BinReader. Returns the
+        # offset of the text.
+        start = self.pos
+        length = 0
+        shift = 0
+        while True:
+            if shift >= (5 * 7):
+                self._fail("{} length has too many bytes".format(what), start)
+            b = self._u8(what + " length")
+            length |= (b & 0x7f) << shift
+            shift += 7
+            if (b & 0x80) == 0:
+                break
+        text = self.pos
+        self._need(length, what)
+        self.pos += length
+        return text
+
+    def _ascii(self, what):
+        start = self.pos
+        text = self._str(what)
+        if max(self.buf[text:self.pos], default=0) >= 0x80:
+            self._fail("{} isn't ASCII".format(what), start)
+
+    def _version(self, what, current, minimum=None):
+        start = self.pos
+        v = self._i32(what + " version")
+        if (v > current) or ((minimum is not None) and (v < minimum)):
+            self._fail("Unhandled {} version: {}".format(what, v), start)
+        return v
+
+    def _section(self, size, name):
+        # Enter a section of size bytes starting here; returns what to pass
+        # to _leave()
+        outer = (self.end, self.end_name)
+        if (size < 0) or (self.pos + size > self.end):
+            self._fail("Byte count {} of {} doesn't fit in {}".format(
+                size, name, self.end_name), self.pos - 4)
+        self.end = self.pos + size
+        self.end_name = name
+        return outer
+
+    def _leave(self, outer):
+        if self.pos != self.end:
+            self._fail("{} bytes left over at the end of {}".format(
+                self.end - self.pos, self.end_name))
+        (self.end, self.end_name) = outer
+
+    def _file(self):
+        self.end = len(self.buf)
+        self.end_name = "the file"
+        byte_count = self._i32("Data byte count")
+        outer = self._section(byte_count, "the data segment")
+        data_start = self.pos
+        self._data()
+        self._leave(outer)
+        checksum_size = self._i32("Checksum size")
+        if checksum_size != 64:
+            self._fail("Checksum size {} isn't a SHA-512".format(
+                checksum_size), self.pos - 4)
+        self._skip(checksum_size, "Checksum")
+        if self.pos != len(self.buf):
+            self._fail("{} bytes past the checksum".format(
+                len(self.buf) - self.pos))
+        if _have_sha512 and self.verify_checksum:
+            checksum = self.buf[self.pos - checksum_size:self.pos].tobytes()
+            m = hashlib.sha512(self.buf[data_start:data_start + byte_count])
+            if m.digest() != checksum:
+                self._fail("Checksum mismatch", self.pos - checksum_size)
+
+    def _data(self):
+        file_version = self._version("FCH file",
+                                     FCH_PlayerStats.CURRENT_VERSION)
+        if file_version >= 28:
+            # Kills, deaths, crafts and builds
+            self._skip(4 * 4, "Player stats")
+        world_size = DecodePlan.get_plan(FCH_World, file_version).fixed_size()
+        world_count = self._count("World", world_size)
+        for i in range(world_count):
+            self._world(i, world_size, file_version)
+        self._player_data()
+
+    def _world(self, index, world_size, file_version):
+        what = "World {}".format(index)
+        self._skip(world_size, what)
+        # The HaveVisibilityData flag is the last of the header
+        if (file_version < 29) or (self.buf[self.pos - 1] == 0):
+            return
+        outer = self._section(self._i32(what + " byte count"),
+                              what + " visibility data")
+        version = self._version(what + " visibility",
+                                FCH_WorldVisibility.CURRENT_VERSION)
+        edge = self._i32(what + " edge length")
+        if edge < 0:
+            self._fail("{} edge length {} is negative".format(what, edge),
+                       self.pos - 4)
+        self._skip(edge * edge, what + " pixels")
+        if version >= 2:
+            # Text, position, symbol and the crossed flag
+            marker_size = 12 + 4 + (1 if version >= 3 else 0)
+            count = self._count(what + " marker", 1 + marker_size)
+            for i in range(count):
+                self._ascii(what + " marker text")
+                self._skip(marker_size, what + " marker")
+        if version >= 4:
+            self._skip(1, what + " public position flag")
+        self._leave(outer)
+
+    def _str_list(self, what):
+        for i in range(self._count(what, 1)):
+            self._ascii(what)
+
+    def _player_data(self):
+        self._ascii("Player name")
+        self._skip(8, "Player ID")
+        self._str("Start seed")
+        if self._u8("HavePlayerData flag") == 0:
+            return
+        outer = self._section(self._i32("Player data byte count"),
+                              "the player data")
+        version = self._version("player data",
+                                FCH_PlayerData.CURRENT_VERSION, minimum=21)
+        # Health, max health, max stamina, first spawn and time since death
+        self._skip(17, "Player data header")
+        if version >= 23:
+            self._ascii("Guardian power")
+        if version >= 24:
+            self._skip(4, "Guardian power cooldown")
+
+        inv_version = self._version("inventory",
+                                    FCH_Inventory.CURRENT_VERSION)
+        # Count, durability, slot and equipped flag, then level, style and
+        # crafter ID by version
+        item_size = 17
+        if inv_version >= 101:
+            item_size += 4
+        if inv_version >= 102:
+            item_size += 4
+        if inv_version >= 103:
+            item_size += 8
+        for i in range(self._count("Inventory item", 1 + item_size)):
+            self._ascii("Item name")
+            self._skip(item_size, "Inventory item")
+            if inv_version >= 103:
+                self._ascii("Item crafter name")
+
+        self._str_list("Known recipe")
+        for i in range(self._count("Crafting station", 5)):
+            self._ascii("Crafting station name")
+            self._skip(4, "Crafting station level")
+        self._str_list("Discovered material")
+        self._str_list("Shown tutorial")
+        self._str_list("Discovered unique")
+        self._str_list("Trophy")
+        self._skip(4 * self._count("Known biome", 4), "Known biomes")
+        if version >= 22:
+            for i in range(self._count("Journal entry", 2)):
+                self._ascii("Journal entry label")
+                self._ascii("Journal entry text")
+        self._ascii("Beard")
+        self._ascii("Hair")
+        # Complexion, hair color and body type
+        self._skip(28, "Appearance")
+        for i in range(self._count("Active food", 9)):
+            self._ascii("Active food name")
+            self._skip(8, "Active food")
+
+        skill_version = self._version("skills", FCH_SkillList.CURRENT_VERSION)
+        skill_size = 12 if skill_version >= 2 else 8
+        self._skip(skill_size * self._count("Skill", skill_size), "Skills")
+        self._leave(outer)
+
+
+def read_file(path):
+    """
+    Get the contents of the FCH file at path, decompressed if need be, as a
+    buffer. Uncompressed files are memory mapped.
+    """
+    with open(path, mode='rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        fmt = Compression.detect(f.read(Compression.MAGIC_SIZE), size)
+        if (fmt is None) and (Compression.format_for_path(path) == 'lzma'):
+            fmt = 'lzma'
+        if fmt is not None:
+            f.seek(0)
+            with Compression.open_read(f, fmt) as c:
+                return c.read()
+        if size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def validate_file(path, verify_checksum=True):
+    """
+    Validate the FCH file at path, see FCHValidator.validate(). Returns a
+    tuple of (offset, message), or None if it's valid.
+    """
+    buf = read_file(path)
+    try:
+        ret = FCHValidator(verify_checksum).validate(buf)
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+    if ret is None:
+        return None
+    return (ret.offset, ret.message)
+
+# vim:ts=4:sw=4:et
@@ -104,8 +104,12 @@ class CountedList(BinIFace, JSONIFace):
         """
         # Write the i32 item count
         binwr.write_i32(len(self.data))
-        for v in self.data:
-            binwr.write(v)
+        if issubclass(self.type, BinIFace):
+            for v in self.data:
+                v.toBinary(binwr)
+        else:
+            # Basic types are packed as a whole
+            binwr.write_list(self.data, type_=self.type)
         return
 
     def fromJSON(self, jdata):
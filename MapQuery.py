@@ -0,0 +1,119 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+import mmap
+
+# Local modules
+from BinReader import BinReader
+from FCHSections import FCHSectionIndex
+from LocalUtil import *
+
+# Visibility bytes are 0 or 1, but treat anything non-zero as visible.
+_to_bit = bytes([0] + ([1] * 255))
+
+class FCHMapQuery:
+    """
+    Answers minimap visibility queries straight from an FCH file.
+
+    The world's pixel bytes are located through an FCHSectionIndex and only
+    the bytes covered by a query are read (through mmap), so nothing is
+    decoded into a WBitMatrix.
+
+    As with WBitMatrix, y is in the on-disk (bottom-up) row order unless
+    flipped is True, in which case it's top-down as in the PBM files.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index = FCHSectionIndex()
+        with BinReader(path) as br:
+            if not br.seekable():
+                die("Minimap queries need an uncompressed file:", path)
+            self.index.fromBinary(br)
+        self.file_handle = open(path, 'rb')
+        self.mm = mmap.mmap(self.file_handle.fileno(), 0,
+                            access=mmap.ACCESS_READ)
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        if getattr(self, 'mm', None) is not None:
+            self.mm.close()
+            self.file_handle.close()
+        self.mm = None
+        self.file_handle = None
+
+    def world_count(self):
+        return len(self.index.worlds)
+
+    def find_world(self, uid):
+        """
+        Get the index of the world with the given UID, or None.
+        """
+        for i in range(len(self.index.worlds)):
+            if self.index.worlds[i].uid == uid:
+                return i
+        return None
+
+    def get_edge_length(self, world):
+        return self._world(world).edge_length
+
+    def _world(self, world):
+        if (world < 0) or (world >= len(self.index.worlds)):
+            raise ValueError("World index", world, "is out of range")
+        w = self.index.worlds[world]
+        if w.pixels is None:
+            raise ValueError("World", world, "has no visibility data")
+        return w
+
+    def _rect(self, w, x, y, width, height, flipped):
+        # Validates the rectangle, returns the first and last+1 disk rows
+        edge = w.edge_length
+        if (x < 0) or (width < 0) or (x + width > edge):
+            raise ValueError("Columns", x, "to", x + width, "are out of range")
+        if (y < 0) or (height < 0) or (y + height > edge):
+            raise ValueError("Rows", y, "to", y + height, "are out of range")
+        if flipped:
+            return (edge - y - height, edge - y)
+        return (y, y + height)
+
+    def get_pixel(self, world, x, y, flipped=False):
+        w = self._world(world)
+        (row, end) = self._rect(w, x, y, 1, 1, flipped)
+        return _to_bit[self.mm[w.pixel_offset(x, row)]]
+
+    def crop(self, world, x, y, width, height, flipped=False):
+        """
+        Get the width x height area at (x,y) as a list of rows, in order of
+        increasing y, with one byte (0 or 1) per pixel.
+        """
+        w = self._world(world)
+        (first, end) = self._rect(w, x, y, width, height, flipped)
+        mm = self.mm
+        rows = []
+        for r in range(first, end):
+            off = w.pixel_offset(x, r)
+            rows.append(mm[off:off+width].translate(_to_bit))
+        if flipped:
+            rows.reverse()
+        return rows
+
+    def count_explored(self, world, x, y, width, height, flipped=False):
+        """
+        Number of visible pixels in the width x height area at (x,y).
+        """
+        w = self._world(world)
+        (first, end) = self._rect(w, x, y, width, height, flipped)
+        mm = self.mm
+        count = 0
+        for r in range(first, end):
+            off = w.pixel_offset(x, r)
+            count += width - mm[off:off+width].count(0)
+        return count
+
+# vim:ts=4:sw=4:et
@@ -0,0 +1,242 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+import hashlib
+import json
+import os
+import struct
+import zlib
+
+# Local modules
+from LocalUtil import *
+from PBMImage import rows_to_pbm
+
+_nonzero_to_1 = bytes([0] + ([1] * 255))
+_nonzero_to_255 = bytes([0] + ([255] * 255))
+
+# Per-width lane constants for _coverage_reduce()
+_lane_consts = {}
+
+def _spread16(b):
+    # Put each byte of b in its own little-endian 16-bit lane of an int.
+    lanes = bytearray(2 * len(b))
+    lanes[0::2] = b
+    return int.from_bytes(lanes, 'little')
+
+def _or_reduce(rows, width):
+    """
+    Halve an image (rows of 0/1 bytes, even width and height): each output
+    pixel is the OR of a 2x2 block. Bytewise OR is done as one big int OR.
+    """
+    half = width // 2
+    out = []
+    for y in range(0, len(rows), 2):
+        v = (int.from_bytes(rows[y], 'little') |
+             int.from_bytes(rows[y+1], 'little')).to_bytes(width, 'little')
+        out.append((int.from_bytes(v[0::2], 'little') |
+                    int.from_bytes(v[1::2], 'little')).to_bytes(half,
+                                                                'little'))
+    return out
+
+def _coverage_reduce(rows, width):
+    """
+    Halve an image (rows of 0-255 bytes, even width and height): each output
+    pixel is the rounded average of a 2x2 block. Pixels are summed in 16-bit
+    lanes of big ints, so there's no per-pixel Python work.
+    """
+    half = width // 2
+    consts = _lane_consts.get(half)
+    if consts is None:
+        consts = (int.from_bytes(b'\x02\x00' * half, 'little'),
+                  int.from_bytes(b'\xff\x3f' * half, 'little'))
+        _lane_consts[half] = consts
+    (rounding, mask) = consts
+    out = []
+    for y in range(0, len(rows), 2):
+        # Vertical pairs, at most 510 per lane
+        v = (_spread16(rows[y]) + _spread16(rows[y+1])).to_bytes(2 * width,
+                                                                 'little')
+        # Horizontal pairs: the even and odd columns' lanes
+        even = bytearray(width)
+        even[0::2] = v[0::4]
+        even[1::2] = v[1::4]
+        odd = bytearray(width)
+        odd[0::2] = v[2::4]
+        odd[1::2] = v[3::4]
+        s = (int.from_bytes(even, 'little') + int.from_bytes(odd, 'little') +
+             rounding)
+        # Divide each lane by 4, dropping the bits shifted in from the next
+        s = (s >> 2) & mask
+        out.append(s.to_bytes(width, 'little')[0::2])
+    return out
+
+def _png(width, rows):
+    # 8-bit grayscale PNG
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data +
+                struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+    ihdr = struct.pack(">IIBBBBB", width, len(rows), 8, 0, 0, 0, 0)
+    raw = b''.join([b'\x00' + r for r in rows])
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) +
+            chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+def _pgm(width, rows):
+    # Binary (P5) PGM
+    return "P5\n{} {}\n255\n".format(width, len(rows)).encode('ascii') + \
+        b''.join(rows)
+
+
+class MapTileExporter:
+    """
+    Exports a world's minimap as a pyramid of square tiles for map viewers:
+      outdir/<z>/<x>/<y>.<format>
+
+    Zoom level 0 is a single tile covering the whole map (padded with fog
+    to a power of two number of tiles per side); each level doubles the
+    number of tiles per side until the last one is at full resolution.
+    Rows go top-down, as in the PBM files.
+
+    Modes:
+      or:       A tile pixel is explored if any pixel it covers is.
+      coverage: A tile pixel is the fraction of pixels it covers that are
+                explored, from 0 to 255.
+
+    Formats:
+      pbm: Plain PBM, 1 (black) for explored. Coverage is thresholded.
+      pgm: Binary PGM, 255 (white) for fully explored.
+      png: 8-bit grayscale PNG, 255 (white) for fully explored.
+
+    outdir/tiles.json records a hash of each full resolution block. When
+    exporting to the same directory again, only the tiles covering blocks
+    that changed (or tiles that are missing) are written.
+    """
+    MODES = ('or', 'coverage')
+    FORMATS = ('pbm', 'pgm', 'png')
+
+    def __init__(self, tile_size=256, mode='or', fmt='png'):
+        if mode not in self.MODES:
+            raise ValueError("Unknown tile mode:", mode)
+        if fmt not in self.FORMATS:
+            raise ValueError("Unknown tile format:", fmt)
+        if tile_size <= 0:
+            raise ValueError("Bad tile size:", tile_size)
+        self.tile_size = tile_size
+        self.mode = mode
+        self.fmt = fmt
+
+    def _bands(self, wbm, size):
+        # The full resolution image, padded with fog to size, a band of
+        # tile_size rows at a time
+        t = self.tile_size
+        edge = wbm.get_width()
+        pad = b'\x00' * (size - edge)
+        blank = b'\x00' * size
+        for y0 in range(0, size, t):
+            rows = []
+            for y in range(y0, min(y0 + t, edge)):
+                r = wbm.get_row_bytes(y, flipped=True)
+                if self.mode == 'coverage':
+                    r = r.translate(_nonzero_to_255)
+                rows.append(r + pad)
+            rows.extend([blank] * (t - len(rows)))
+            yield rows
+
+    def _tile(self, rows, x, y):
+        t = self.tile_size
+        return [r[x*t:(x+1)*t] for r in rows[y*t:(y+1)*t]]
+
+    def _encode(self, tile):
+        if self.fmt == 'pbm':
+            if self.mode == 'coverage':
+                tile = [r.translate(_nonzero_to_1) for r in tile]
+            return rows_to_pbm(self.tile_size, tile).encode('ascii')
+        if self.mode == 'or':
+            tile = [r.translate(_nonzero_to_255) for r in tile]
+        if self.fmt == 'pgm':
+            return _pgm(self.tile_size, tile)
+        return _png(self.tile_size, tile)
+
+    def _settings(self, edge):
+        return {
+            'TileSize': self.tile_size,
+            'Mode': self.mode,
+            'Format': self.fmt,
+            'EdgeLength': edge,
+        }
+
+    def export(self, vis_data, outdir):
+        """
+        Export the tiles of an FCH_WorldVisibility to outdir.
+
+        Returns a tuple of (written, skipped) tile counts.
+        """
+        wbm = vis_data.pixel_data
+        edge = wbm.get_width()
+        tiles = 1
+        while tiles * self.tile_size < edge:
+            tiles *= 2
+        max_zoom = tiles.bit_length() - 1
+        reduce_fn = _or_reduce if self.mode == 'or' else _coverage_reduce
+
+        manifest_path = os.path.join(outdir, 'tiles.json')
+        old = {}
+        try:
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('Settings') == self._settings(edge):
+                old = manifest.get('Blocks', {})
+        except (OSError, ValueError):
+            pass
+
+        blocks = {}
+        # (z, x, y) of the tiles covering blocks that changed
+        dirty = set()
+        written = 0
+        skipped = 0
+
+        def emit(z, y, rows):
+            nonlocal written, skipped
+            for x in range(1 << z):
+                xdir = os.path.join(outdir, str(z), str(x))
+                path = os.path.join(xdir, '{}.{}'.format(y, self.fmt))
+                if ((z, x, y) not in dirty) and os.path.exists(path):
+                    skipped += 1
+                    continue
+                if not os.path.exists(xdir):
+                    os.makedirs(xdir)
+                data = self._encode(self._tile(rows, x, 0))
+                with open(path, 'wb') as f:
+                    f.write(data)
+                written += 1
+
+        # Only a band of tile rows per zoom level is held at a time: each
+        # pair of bands at one level is reduced to a band of the next level
+        # down as soon as the second one is done. pending[z] is the first
+        # of a pair.
+        pending = [None] * (max_zoom + 1)
+        for (by, rows) in enumerate(self._bands(wbm, tiles * self.tile_size)):
+            # Hash the full resolution blocks and compare with the last
+            # export
+            for bx in range(tiles):
+                k = '{}/{}'.format(bx, by)
+                blocks[k] = hashlib.sha1(b''.join(
+                    self._tile(rows, bx, 0))).hexdigest()
+                if old.get(k) != blocks[k]:
+                    for z in range(max_zoom + 1):
+                        shift = max_zoom - z
+                        dirty.add((z, bx >> shift, by >> shift))
+            (z, y, width) = (max_zoom, by, tiles * self.tile_size)
+            while True:
+                emit(z, y, rows)
+                if (z == 0) or (y % 2 == 0):
+                    pending[z] = rows
+                    break
+                rows = reduce_fn(pending[z] + rows, width)
+                pending[z] = None
+                (z, y, width) = (z - 1, y // 2, width // 2)
+
+        with open(manifest_path, 'w') as f:
+            json.dump({'Settings': self._settings(edge), 'Blocks': blocks},
+                      f, indent=4)
+        return (written, skipped)
+
+# vim:ts=4:sw=4:et
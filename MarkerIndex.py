@@ -0,0 +1,199 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+import math
+
+import Valheim
+
+class MarkerIndex:
+    """
+    Uniform grid over the X/Z plane for map markers, or anything else with
+    a world position [X, Y, Z] in .point. Y (the height) is ignored.
+
+    Query results are in the order the items were given.
+    """
+    def __init__(self, items=(), cell_size=64.0):
+        if cell_size <= 0:
+            raise ValueError("Cell size", cell_size, "is not positive")
+        self.cell_size = float(cell_size)
+        self.items = []
+        self.cells = {} # (cx, cz) -> [item index]
+        self.bounds = None # Occupied cells, [min cx, min cz, max cx, max cz]
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return len(self.items)
+
+    def _cell(self, x, z):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(z / self.cell_size)))
+
+    def add(self, item):
+        self.items.append(item)
+        key = self._cell(item.point[0], item.point[2])
+        self.cells.setdefault(key, []).append(len(self.items) - 1)
+        if self.bounds is None:
+            self.bounds = [key[0], key[1], key[0], key[1]]
+        else:
+            self.bounds = [min(self.bounds[0], key[0]),
+                           min(self.bounds[1], key[1]),
+                           max(self.bounds[2], key[0]),
+                           max(self.bounds[3], key[1])]
+        return
+
+    def _indices_in_cells(self, x0, z0, x1, z1):
+        # Indices of everything in the cells overlapping the rectangle
+        (cx0, cz0) = self._cell(x0, z0)
+        (cx1, cz1) = self._cell(x1, z1)
+        ret = []
+        if (cx1 - cx0 + 1) * (cz1 - cz0 + 1) > len(self.cells):
+            # Cheaper to walk the occupied cells
+            for ((cx, cz), l) in self.cells.items():
+                if (cx0 <= cx <= cx1) and (cz0 <= cz <= cz1):
+                    ret.extend(l)
+        else:
+            for cx in range(cx0, cx1 + 1):
+                for cz in range(cz0, cz1 + 1):
+                    ret.extend(self.cells.get((cx, cz), ()))
+        ret.sort()
+        return ret
+
+    def _radius_indices(self, point, radius):
+        (x, z) = (point[0], point[2])
+        r2 = radius * radius
+        ret = []
+        for i in self._indices_in_cells(x - radius, z - radius,
+                                        x + radius, z + radius):
+            p = self.items[i].point
+            if ((p[0] - x) ** 2) + ((p[2] - z) ** 2) <= r2:
+                ret.append(i)
+        return ret
+
+    def in_rect(self, corner_a, corner_b):
+        """
+        Get the items inside the axis aligned rectangle between two world
+        positions (edges included).
+        """
+        x0 = min(corner_a[0], corner_b[0])
+        x1 = max(corner_a[0], corner_b[0])
+        z0 = min(corner_a[2], corner_b[2])
+        z1 = max(corner_a[2], corner_b[2])
+        ret = []
+        for i in self._indices_in_cells(x0, z0, x1, z1):
+            p = self.items[i].point
+            if (x0 <= p[0] <= x1) and (z0 <= p[2] <= z1):
+                ret.append(self.items[i])
+        return ret
+
+    def in_radius(self, point, radius):
+        """
+        Get the items within radius meters of the world position point.
+        """
+        return [self.items[i] for i in self._radius_indices(point, radius)]
+
+    def nearest(self, point, max_dist=None, exclude=None):
+        """
+        Get (item, distance) for the item closest to the world position
+        point, or None if there's nothing (within max_dist). Items that are
+        exclude are skipped, so an item's nearest neighbour can be found.
+        """
+        if len(self.items) == 0:
+            return None
+        (x, z) = (point[0], point[2])
+        (cx, cz) = self._cell(x, z)
+        # Rings further out than this can't hold anything
+        (lo_x, lo_z, hi_x, hi_z) = self.bounds
+        max_ring = max(cx - lo_x, hi_x - cx, cz - lo_z, hi_z - cz, 0)
+        best = None
+        best_d2 = None
+        ring = 0
+        while ring <= max_ring:
+            # Everything in ring n or beyond is at least (n - 1) cells away
+            if best is not None:
+                reach = (ring - 1) * self.cell_size
+                if reach * reach > best_d2:
+                    break
+            for i in self._ring_indices(cx, cz, ring):
+                item = self.items[i]
+                if item is exclude:
+                    continue
+                p = item.point
+                d2 = ((p[0] - x) ** 2) + ((p[2] - z) ** 2)
+                if (best is None) or (d2 < best_d2) or \
+                        ((d2 == best_d2) and (i < best)):
+                    best = i
+                    best_d2 = d2
+            ring += 1
+        if best is None:
+            return None
+        dist = math.sqrt(best_d2)
+        if (max_dist is not None) and (dist > max_dist):
+            return None
+        return (self.items[best], dist)
+
+    def _ring_indices(self, cx, cz, ring):
+        if ring == 0:
+            return self.cells.get((cx, cz), [])
+        ret = []
+        for dx in range(-ring, ring + 1):
+            ret.extend(self.cells.get((cx + dx, cz - ring), ()))
+            ret.extend(self.cells.get((cx + dx, cz + ring), ()))
+        for dz in range(-ring + 1, ring):
+            ret.extend(self.cells.get((cx - ring, cz + dz), ()))
+            ret.extend(self.cells.get((cx + ring, cz + dz), ()))
+        return ret
+
+    def duplicates(self, tolerance, key=None):
+        """
+        Group the items lying within tolerance meters of an earlier item.
+        With key, only items with equal key(item) are grouped.
+
+        Returns a list of groups, each a list starting with the item to
+        keep followed by its duplicates. Items without duplicates aren't
+        listed.
+        """
+        taken = [False] * len(self.items)
+        groups = []
+        for i in range(len(self.items)):
+            if taken[i]:
+                continue
+            first = self.items[i]
+            k = key(first) if key is not None else None
+            group = [first]
+            for j in self._radius_indices(first.point, tolerance):
+                if (j <= i) or taken[j]:
+                    continue
+                if (key is not None) and (key(self.items[j]) != k):
+                    continue
+                taken[j] = True
+                group.append(self.items[j])
+            if len(group) > 1:
+                groups.append(group)
+        return groups
+
+    def explored(self, matrix):
+        """
+        Check the items against a minimap WBitMatrix in one pass. Returns a
+        list of booleans, True where the item's pixel is explored. Items off
+        the map are unexplored.
+        """
+        edge = matrix.get_width()
+        by_row = {}
+        for i in range(len(self.items)):
+            (x, y) = Valheim.MinimapWorldToPixel(self.items[i].point, edge)
+            (x, y) = (int(round(x)), int(round(y)))
+            if (0 <= x < matrix.get_width()) and \
+                    (0 <= y < matrix.get_height()):
+                by_row.setdefault(y, []).append((x, i))
+        ret = [False] * len(self.items)
+        # Decode each row once, however many items are on it
+        for (y, l) in by_row.items():
+            if len(l) == 1:
+                ret[l[0][1]] = (matrix.get(l[0][0], y) != 0)
+                continue
+            row = matrix.get_row_bytes(y)
+            for (x, i) in l:
+                ret[i] = (row[x] != 0)
+        return ret
+
+# vim:ts=4:sw=4:et
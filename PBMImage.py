@@ -56,6 +56,152 @@ def _get_pixel(f, first=None):
     die("Bad character ({}) in PBM pixel".format(first))
 
 
+# Maps the ASCII pixel digits to one byte per pixel values
+_digit_to_byte = bytes.maketrans(b'01', b'\x00\x01')
+
+def _line_digits(line, drop=0):
+    """
+    Get the pixel digits in a (binary) line of a plain PBM, ignoring
+    whitespace, comments and the first 'drop' tokens.
+    """
+    i = line.find(b'#')
+    if i >= 0:
+        line = line[:i]
+    tokens = line.split()
+    if drop != 0:
+        tokens = tokens[drop:]
+    digits = b''.join(tokens)
+    bad = digits.translate(None, b'01')
+    if len(bad) != 0:
+        die("Bad character ({}) in PBM pixel".format(chr(bad[0])))
+    return digits
+
+
+_byte_to_digit = bytes.maketrans(b'\x00\x01', b'01')
+
+def rows_to_pbm(width, rows):
+    """
+    Render rows (bytes with one byte, 0 or 1, per pixel; top to bottom) as
+    plain PBM text.
+    """
+    lines = ["P1\n{} {}\n".format(width, len(rows))]
+    lines.extend([r.translate(_byte_to_digit).decode('ascii') + "\n"
+                  for r in rows])
+    return ''.join(lines)
+
+
+class PBMRowReader:
+    """
+    Reads the rows of a plain (P1) PBM file one at a time, in any order,
+    without loading the whole image.
+
+    Opening the file makes one pass over it to record where each row
+    starts; read_row() then seeks straight to the row. Rows are returned as
+    bytes with one byte (0 or 1) per pixel.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file_handle = open(path, 'rb')
+        self._read_header()
+        self._index_rows()
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        if getattr(self, 'file_handle', None) is not None:
+            self.file_handle.close()
+        self.file_handle = None
+
+    def get_width(self):
+        return self.width
+
+    def get_height(self):
+        return self.height
+
+    def _read_header(self):
+        # Magic, width, and height tokens. The pixel data may start on the
+        # same line as the last of them.
+        f = self.file_handle
+        tokens = []
+        offset = 0
+        while len(tokens) < 3:
+            line = f.readline()
+            if len(line) == 0:
+                die('File {} is not a PBM'.format(self.path))
+            i = line.find(b'#')
+            line_tokens = (line if i < 0 else line[:i]).split()
+            need = 3 - len(tokens)
+            tokens.extend(line_tokens[:need])
+            # Where the pixel data starts
+            self.data_offset = offset
+            self.data_drop = min(need, len(line_tokens))
+            offset += len(line)
+        if tokens[0] != b'P1':
+            die('File {} is not a PBM'.format(self.path))
+        try:
+            self.width = int(tokens[1])
+            self.height = int(tokens[2])
+        except ValueError:
+            die('File {} has a bad PBM header'.format(self.path))
+
+    def _index_rows(self):
+        # For each row: (line offset, tokens to drop, digits to skip)
+        self.rows = []
+        if (self.width == 0) or (self.height == 0):
+            return
+        f = self.file_handle
+        f.seek(self.data_offset)
+        offset = self.data_offset
+        drop = self.data_drop
+        have = 0
+        while len(self.rows) < self.height or have != 0:
+            line = f.readline()
+            if len(line) == 0:
+                die('File {} has truncated PBM pixel data'.format(self.path))
+            digits = _line_digits(line, drop)
+            i = 0
+            while i < len(digits):
+                if have == 0:
+                    if len(self.rows) == self.height:
+                        # PBM parsers are supposed to be lenient so we just
+                        # ignore any trailing data.
+                        break
+                    self.rows.append((offset, drop, i))
+                take = min(self.width - have, len(digits) - i)
+                have += take
+                i += take
+                if have == self.width:
+                    have = 0
+            offset += len(line)
+            drop = 0
+
+    def read_row(self, y):
+        """
+        Get row y (top to bottom, as in the file) as one byte per pixel.
+        """
+        (offset, drop, skip) = self.rows[y]
+        f = self.file_handle
+        f.seek(offset)
+        parts = []
+        need = self.width
+        while need > 0:
+            digits = _line_digits(f.readline(), drop)
+            if skip != 0:
+                digits = digits[skip:]
+            drop = 0
+            skip = 0
+            parts.append(digits[:need])
+            need -= len(parts[-1])
+        return b''.join(parts).translate(_digit_to_byte)
+
+
 class PBMImage:
     def __init__(self, width=0, height=0):
         self.data = WBitMatrix.WBitMatrix(width, height)
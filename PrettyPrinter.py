@@ -1,7 +1,9 @@
 # Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
 # SPDX-License-Identifier: MIT
 import binascii
+import json
 import struct
+import sys
 
 class PPWrap:
     def __init__(self, pp, label=None):
@@ -17,81 +19,147 @@ class PPWrap:
 
 
 class PrettyPrinter:
-    def __init__(self):
+    """
+    Renders info dumps into a line buffer that's written out in one go by
+    flush().
+
+    Formats:
+      text:  Indented, human readable output.
+      jsonl: One JSON object per line: {"key": <path>, "value": <value>}.
+             The path is built from the block labels (or the "N:" style
+             lines preceding anonymous blocks) joined with '/'.
+    """
+    FORMATS = ('text', 'jsonl')
+
+    def __init__(self, fmt='text', out=None):
+        if fmt not in self.FORMATS:
+            raise ValueError("Unknown PrettyPrinter format:", fmt)
+        self.fmt = fmt
+        self.out = out
+        self.lines = []
         self.indent_lvl = 0
+        self.indent_str = ''
+        # jsonl state: current key path and a label waiting for its block
+        self.path = []
+        self.pending_label = None
         self.s_u32 = struct.Struct("<I")
         self.s_float = struct.Struct("<f")
 
+    def flush(self):
+        if len(self.lines) == 0:
+            return
+        out = self.out if self.out is not None else sys.stdout
+        self.lines.append('')
+        out.write('\n'.join(self.lines))
+        out.flush()
+        self.lines = []
+
+    def _set_indent(self, lvl):
+        self.indent_lvl = lvl
+        self.indent_str = "  " * lvl
+
+    def _flush_pending(self):
+        if self.pending_label is not None:
+            label = self.pending_label
+            self.pending_label = None
+            self._emit(label, None)
+
+    def _emit(self, key, value):
+        path = [p for p in self.path if p is not None]
+        if key:
+            path.append(key)
+        self.lines.append(json.dumps({'key': '/'.join(path), 'value': value},
+                                     default=str))
+
     def block(self, s = None):
-        if (s is not None):
+        if self.fmt == 'jsonl':
+            if s is None:
+                s = self.pending_label
+            else:
+                self._flush_pending()
+            self.pending_label = None
+            self.path.append(s)
+        elif (s is not None):
             l = 78 - len(s) - (2 * self.indent_lvl)
             if (l <= 0):
                 l = 6
             self.println("{} {}".format(s, "-" *  l))
-        self.indent_lvl += 1
+        self._set_indent(self.indent_lvl + 1)
 
     def end_block(self):
         if self.indent_lvl != 0:
-            self.indent_lvl -= 1
-
-    def indent(self):
-        print("  " * self.indent_lvl, end='')
+            self._set_indent(self.indent_lvl - 1)
+        if self.fmt == 'jsonl':
+            self._flush_pending()
+            if len(self.path) != 0:
+                self.path.pop()
 
     def println(self, first, *args):
-        self.indent()
-        print(first, end='')
-        for a in args:
-            print(' ', a, sep='', end='')
-        print('')
+        if self.fmt == 'jsonl':
+            self._println_jsonl(first, args)
+            return
+        line = self.indent_str + str(first)
+        if len(args) != 0:
+            line += ' ' + ' '.join([str(a) for a in args])
+        self.lines.append(line)
+
+    def _println_jsonl(self, first, args):
+        self._flush_pending()
+        first = str(first)
+        if len(args) != 0:
+            value = args[0] if len(args) == 1 else list(args)
+            self._emit(first.rstrip(':'), value)
+        elif first.endswith(':'):
+            # Probably the label of an anonymous block, find out when the
+            # next line comes in.
+            self.pending_label = first[:-1]
+        elif ': ' in first:
+            (key, value) = first.split(': ', 1)
+            self._emit(key, value)
+        else:
+            self._emit(None, first)
+
+    def _hex_pairs(self, b):
+        s = binascii.hexlify(b).decode('ascii')
+        return [s[i:i+2] for i in range(0, len(s), 2)]
 
     def small_bytes(self, prefix, b):
         if (len(b) > 4):
             self.bytes(prefix, b)
             return
-        s = binascii.hexlify(b).decode('ascii')
-        self.indent()
-        print(prefix, ": {", sep='', end='')
-        i = 0;
-        while (i < len(b)):
-            print(" ", s[i*2:(i*2)+2], sep='', end='')
-            i += 1
-        print(" }")
+        if self.fmt == 'jsonl':
+            self._println_jsonl(prefix, (binascii.hexlify(b).decode('ascii'),))
+            return
+        pairs = self._hex_pairs(b)
+        self.lines.append("{}{}: {{{} }}".format(
+            self.indent_str, prefix, ''.join([' ' + p for p in pairs])))
 
     def bytes(self, prefix, b):
         if (len(b) <= 4):
             self.small_bytes(prefix, b)
             return
-        self.indent()
-        print(prefix, ":", sep='')
-        self.block()
-        i = 0
-        offset = 0
-        s = binascii.hexlify(b).decode('ascii')
-        chunks = (len(s) & ~15)
-        while (i < chunks):
-            self.indent()
-            print("{0:06x}: ".format(offset), end='')
-            print(s[i+0:i+2], s[i+2:i+4], s[i+4:i+6], s[i+6:i+8], end='')
-            print('', s[i+8:i+10], s[i+10:i+12], s[i+12:i+14], s[i+14:i+16])
-            i += 16
-            offset += 8
-        if (i < len(s)):
-            self.indent()
-            print("{0:06x}:".format(offset), end='')
-            o = 0
-            while (i < len(s)):
-                print(' ', s[i:i+2], sep='', end='')
-                i += 2
-            print('')
-        self.end_block()
+        if self.fmt == 'jsonl':
+            self._println_jsonl(prefix, (binascii.hexlify(b).decode('ascii'),))
+            return
+        self.lines.append("{}{}:".format(self.indent_str, prefix))
+        # 8 bytes per row: "<offset>: xx xx xx xx xx xx xx xx"
+        indent = "  " * (self.indent_lvl + 1)
+        pairs = self._hex_pairs(b)
+        self.lines.extend([
+            "{}{:06x}: {}".format(indent, offset,
+                                  ' '.join(pairs[offset:offset+8]))
+            for offset in range(0, len(pairs), 8)
+        ])
 
     def print_a4(self, prefix, b):
         i = self.s_u32.unpack(b)[0]
         f = self.s_float.unpack(b)[0]
-        s = binascii.hexlify(b).decode('ascii')
-        self.indent()
-        print(prefix, ": { ", sep='', end='')
-        print(s[0:2], s[2:4], s[4:6], s[6:8], "}", end='')
-        print(" i:({}) f:({})".format(i, f))
+        if self.fmt == 'jsonl':
+            self._println_jsonl(prefix, (binascii.hexlify(b).decode('ascii'),
+                                         i, f))
+            return
+        pairs = self._hex_pairs(b)
+        self.lines.append("{}{}: {{ {} }} i:({}) f:({})".format(
+            self.indent_str, prefix, ' '.join(pairs), i, f))
 
 # vim:ts=4:sw=4:et
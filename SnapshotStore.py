@@ -0,0 +1,198 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+import hashlib
+import json
+import os
+import time
+
+# Local modules
+from BinReader import BinReader
+from BinWriter import BinWriter, replace_file
+from FCHSections import FCHSectionIndex
+from LocalUtil import *
+
+# Chunk size for anything that can't be split up by section
+_blob_chunk = 1 << 17
+
+def _cut_points(data, rows_per_chunk):
+    """
+    Get the offsets data is split at: every section boundary, and every
+    rows_per_chunk rows of each world's pixels.
+    """
+    index = FCHSectionIndex()
+    with BinReader(data) as br:
+        index.fromBinary(br)
+    cuts = set([0])
+    for s in index.sections():
+        cuts.add(s.offset)
+        cuts.add(s.end())
+    for w in index.worlds:
+        if w.pixels is None:
+            continue
+        step = rows_per_chunk * w.edge_length
+        if step > 0:
+            cuts.update(range(w.pixels.offset, w.pixels.end(), step))
+        cuts.add(w.pixels.end())
+    return cuts
+
+
+class FCHSnapshotStore:
+    """
+    Deduplicating store for FCH file backups.
+
+    Each file is cut into chunks along its sections (stats, world headers,
+    visibility data, player data, checksum), with each world's pixels cut
+    further into blocks of rows_per_chunk rows. Chunks are stored once,
+    named by their SHA-256, so a snapshot only adds the chunks that changed
+    since any earlier one:
+      root/chunks/ab/abcdef...
+      root/snapshots/NAME.json
+
+    The snapshot manifest lists the file's chunks in order; restoring is
+    joining them back together. Files that can't be parsed are still
+    stored, in fixed size chunks.
+    """
+    def __init__(self, root, rows_per_chunk=64):
+        self.root = root
+        self.rows_per_chunk = rows_per_chunk
+        self.chunk_dir = os.path.join(root, 'chunks')
+        self.snapshot_dir = os.path.join(root, 'snapshots')
+        for d in (self.chunk_dir, self.snapshot_dir):
+            if not os.path.exists(d):
+                os.makedirs(d)
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.chunk_dir, digest[0:2], digest)
+
+    def _manifest_path(self, name):
+        if (name != os.path.basename(name)) or name.startswith('.'):
+            die("Invalid snapshot name:", name)
+        return os.path.join(self.snapshot_dir, name + '.json')
+
+    def _put(self, chunk):
+        # Store chunk unless it's already there. Returns (digest, is_new).
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = self._chunk_path(digest)
+        if os.path.exists(path):
+            return (digest, False)
+        d = os.path.dirname(path)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        # Write under a temporary name so a chunk is either whole or absent
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(chunk)
+        os.replace(tmp, path)
+        return (digest, True)
+
+    def snapshot(self, path, name=None, overwrite=False):
+        """
+        Store a snapshot of the FCH file at path (anything BinReader reads,
+        compressed files included) as name, by default the file's name, the
+        current time and the start of the data's hash. Existing snapshots
+        are only replaced with overwrite.
+
+        Returns a tuple of (name, new chunk count, new bytes).
+        """
+        with BinReader(path) as br:
+            data = br.read(-1)
+        data_hash = hashlib.sha256(data).hexdigest()
+        if name is None:
+            # The hash tells apart different data snapshotted in one second
+            name = "{}-{}-{}".format(os.path.basename(path),
+                                     time.strftime("%Y%m%dT%H%M%S"),
+                                     data_hash[0:8])
+        manifest_path = self._manifest_path(name)
+        if os.path.exists(manifest_path) and not overwrite:
+            die("Snapshot '{}' already exists".format(name))
+
+        try:
+            cuts = _cut_points(data, self.rows_per_chunk)
+        except (SystemExit, Exception):
+            info("Not a valid FCH file, storing", path, "in fixed size chunks")
+            cuts = set(range(0, len(data), _blob_chunk))
+        cuts = sorted([c for c in cuts if 0 <= c < len(data)] + [len(data)])
+
+        chunks = []
+        new_count = 0
+        new_bytes = 0
+        start = 0
+        for end in cuts:
+            if end == start:
+                continue
+            (digest, is_new) = self._put(data[start:end])
+            chunks.append([digest, end - start])
+            if is_new:
+                new_count += 1
+                new_bytes += end - start
+            start = end
+
+        manifest = {
+            'Source': os.path.abspath(path),
+            'Created': time.time(),
+            'Size': len(data),
+            'SHA256': data_hash,
+            'Chunks': chunks,
+        }
+        tmp = '{}.{}.tmp'.format(manifest_path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp, manifest_path)
+        return (name, new_count, new_bytes)
+
+    def snapshots(self):
+        """
+        Get the names of the stored snapshots, sorted.
+        """
+        return sorted([n[:-len('.json')] for n in os.listdir(self.snapshot_dir)
+                       if n.endswith('.json')])
+
+    def manifest(self, name):
+        path = self._manifest_path(name)
+        if not os.path.exists(path):
+            die("No snapshot named '{}'".format(name))
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def restore(self, name, out_path, overwrite=False, compress='auto',
+                level=None):
+        """
+        Write snapshot name to out_path (see BinWriter for '-' and
+        compression). Every chunk and the whole file are checked against
+        their hashes before anything is written, and an existing out_path
+        is replaced in one go.
+        """
+        manifest = self.manifest(name)
+        if (out_path != '-') and os.path.exists(out_path) and not overwrite:
+            die("'{}' already exists".format(out_path))
+        chunks = []
+        for (digest, size) in manifest['Chunks']:
+            path = self._chunk_path(digest)
+            if not os.path.exists(path):
+                die("Snapshot chunk {} is missing".format(digest))
+            with open(path, 'rb') as f:
+                chunk = f.read()
+            if (len(chunk) != size) or \
+                    (hashlib.sha256(chunk).hexdigest() != digest):
+                die("Snapshot chunk {} is damaged".format(digest))
+            chunks.append(chunk)
+        data = b''.join(chunks)
+        if hashlib.sha256(data).hexdigest() != manifest['SHA256']:
+            die("Snapshot '{}' doesn't match its hash".format(name))
+        if out_path == '-':
+            with BinWriter(out_path, compress=compress, level=level) as wr:
+                wr.write_raw(data)
+        else:
+            replace_file(out_path, data, compress=compress, level=level)
+        return
+
+    def printInfo(self, pp):
+        names = self.snapshots()
+        pp.println("Snapshots:", len(names))
+        for name in names:
+            m = self.manifest(name)
+            pp.println("{}:".format(name), "{} bytes in {} chunks".format(
+                m['Size'], len(m['Chunks'])))
+        return
+
+# vim:ts=4:sw=4:et
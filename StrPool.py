@@ -0,0 +1,90 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+import sys
+
+class StrPool:
+    """
+    Shared string pool for loading many FCH files.
+
+    Item, recipe, material and trophy names come from a small vocabulary of
+    game identifiers, so when a pool is handed to BinReader every string it
+    reads is replaced by the pool's canonical copy and the duplicate is
+    dropped. Each distinct string also gets a compact integer symbol ID
+    which can be used in place of the string (see symbol() and lookup()).
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.ids = {} # str -> symbol ID
+        self.strings = [] # symbol ID -> str
+        self.lookups = 0
+        self.unique_bytes = 0
+        self.saved_bytes = 0
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __contains__(self, s):
+        return s in self.ids
+
+    def symbol(self, s):
+        """
+        Get the symbol ID for s, adding it to the pool if needed.
+        """
+        self.lookups += 1
+        sid = self.ids.get(s)
+        if sid is None:
+            sid = len(self.strings)
+            self.ids[s] = sid
+            self.strings.append(s)
+            self.unique_bytes += sys.getsizeof(s)
+        else:
+            self.saved_bytes += sys.getsizeof(s)
+        return sid
+
+    def lookup(self, sid):
+        """
+        Get the string for a symbol ID.
+        """
+        return self.strings[sid]
+
+    def intern(self, s):
+        """
+        Get the pool's copy of s.
+        """
+        return self.strings[self.symbol(s)]
+
+    def intern_list(self, l):
+        strings = self.strings
+        symbol = self.symbol
+        return [strings[symbol(s)] for s in l]
+
+    def symbol_list(self, l):
+        symbol = self.symbol
+        return [symbol(s) for s in l]
+
+    def report(self):
+        """
+        Memory report for the pool, as a dict.
+        """
+        # The pool's own overhead: the dict and list, not the strings
+        overhead = sys.getsizeof(self.ids) + sys.getsizeof(self.strings)
+        return {
+            'UniqueStrings': len(self.strings),
+            'Lookups': self.lookups,
+            'UniqueBytes': self.unique_bytes,
+            'PoolOverheadBytes': overhead,
+            'SavedBytes': self.saved_bytes,
+        }
+
+    def printInfo(self, pp):
+        r = self.report()
+        pp.println("Unique Strings:", r['UniqueStrings'])
+        pp.println("Lookups:", r['Lookups'])
+        pp.println("Unique String Bytes:", r['UniqueBytes'])
+        pp.println("Pool Overhead Bytes:", r['PoolOverheadBytes'])
+        pp.println("Bytes Saved By Interning:", r['SavedBytes'])
+        return
+
+# vim:ts=4:sw=4:et
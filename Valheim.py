@@ -18,6 +18,12 @@ WorldMarkerType_codex = {
     13: "EventArea", # Internal
 }
 
+# Markers worth sharing between players: the ones players place
+# themselves, plus the boss pins vegvisirs leave, as opposed to the
+# internal ones
+WorldMarkerType_shared = set(["Campfire", "House", "T", "Dot", "Gate",
+                              "Boss"])
+
 WorldMarkerType_invcodex = {}
 for key, value in WorldMarkerType_codex.items():
     WorldMarkerType_invcodex[ value ] = key
@@ -93,4 +99,20 @@ def BiomeType_a2i(a):
         return BiomeType_invcodex[a]
     return int(a, 16)
 
+# Size of one minimap (explored) pixel, in meters
+MinimapPixelSize = 12.0
+
+def MinimapWorldToPixel(point, edge_length):
+    """
+    Map a world position [X, Y, Z] onto the explored matrix. X and Z are the
+    map plane; the world origin is at the center. Returns (x, y) in on-disk
+    (bottom-up) row order, unrounded.
+    """
+    half = edge_length / 2
+    return ((point[0] / MinimapPixelSize) + half,
+            (point[2] / MinimapPixelSize) + half)
+
+def MinimapMetersToPixels(meters):
+    return meters / MinimapPixelSize
+
 # vim:ts=4:sw=4:autoindent
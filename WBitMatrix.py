@@ -1,6 +1,51 @@
 # Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
 # SPDX-License-Identifier: MIT
 import array
+import bisect
+import math
+
+_digit_to_byte = bytes.maketrans(b'01', b'\x00\x01')
+# On disk any non-zero byte is a visible pixel
+_byte_to_digit = bytes([0x30] + ([0x31] * 255))
+_byte_to_bit = bytes([0] + ([1] * 255))
+
+# load_matrix() picks the run-length backend for maps averaging at most this
+# many runs of visible pixels per row. Past that the packed rows are smaller.
+SPARSE_RUNS_PER_ROW = 4
+
+def _find_runs(data, start, end):
+    # Runs of 1 bytes in data[start:end] as a flat [start0, end0, ...] list,
+    # relative to start. data must only hold 0 and 1 bytes.
+    runs = []
+    pos = start
+    while True:
+        s = data.find(b'\x01', pos, end)
+        if s < 0:
+            break
+        e = data.find(b'\x00', s, end)
+        if e < 0:
+            e = end
+        runs.append(s - start)
+        runs.append(e - start)
+        pos = e
+    return runs
+
+def load_matrix(binrdr, w, h):
+    """
+    Read a w x h matrix (1 byte per bit), using WRunBitMatrix for mostly
+    uniform maps and WBitMatrix otherwise.
+    """
+    data = binrdr.read(w * h)
+    if len(data) != w * h:
+        raise ValueError("Not enough visibility data")
+    bits = data.translate(_byte_to_bit)
+    # Every 0 -> 1 transition starts a run (give or take one per row)
+    if bits.count(b'\x00\x01') <= (SPARSE_RUNS_PER_ROW * h):
+        m = WRunBitMatrix(w, h)
+    else:
+        m = WBitMatrix(w, h)
+    m._load(data, bits)
+    return m
 
 class WBitMatrix:
     """
@@ -14,10 +59,30 @@ class WBitMatrix:
       "Reversable" to translate between top-down indexing of the rows to
       bottom-up indexing. This solves the issue of converting between the
       world data (as seen on disk) and how the PBM needs it ordered.
+
+      Dirty rows: rows changed through set() since the matrix was loaded
+      are tracked. Together with the original bytes kept by fromBinary(),
+      toBinary() copies the clean rows verbatim and only re-expands the
+      dirty ones.
+
+      Mostly uniform maps are better off as runs, see WRunBitMatrix and
+      load_matrix().
     """
     def __init__(self, w=0, h=0):
         self.set_dimensions(w, h)
 
+    def __eq__(self, other):
+        if not isinstance(other, WBitMatrix):
+            return NotImplemented
+        if (self.width != other.width) or (self.height != other.height):
+            return False
+        if type(self) is type(other):
+            return self.rows == other.rows
+        for y in range(self.height):
+            if self._row_bytes(y) != other._row_bytes(y):
+                return False
+        return True
+
     def get_height(self):
         return self.height
 
@@ -33,13 +98,58 @@ class WBitMatrix:
             self.bytes_per_row += 1
 
         self.rows = []
+        empty = bytes(self.bytes_per_row)
         for r in range(h):
-            a = array.array("B")
-            for c in range(w):
-                a.append(0)
-            self.rows.append(a)
+            self.rows.append(array.array("B", empty))
+
+        # Nothing's been loaded, so nothing is dirty either
+        self.original = None
+        self.dirty = bytearray(h)
         return
 
+    def is_dirty(self, y, flipped=False):
+        if flipped:
+            y = (self.height - y - 1)
+        return self.dirty[y] != 0
+
+    def get_dirty_rows(self, flipped=False):
+        """
+        Get the sorted indices of the rows changed since the matrix was
+        loaded (or clear_dirty() was called).
+        """
+        rows = [y for y in range(self.height) if self.dirty[y]]
+        if flipped:
+            rows = [self.height - y - 1 for y in reversed(rows)]
+        return rows
+
+    def get_dirty_intervals(self, flipped=False):
+        """
+        Like get_dirty_rows(), but as a list of (first, last + 1) row ranges.
+        """
+        ret = []
+        start = None
+        for y in self.get_dirty_rows(flipped=flipped):
+            if (start is not None) and (y == end):
+                end += 1
+                continue
+            if start is not None:
+                ret.append((start, end))
+            start = y
+            end = y + 1
+        if start is not None:
+            ret.append((start, end))
+        return ret
+
+    def clear_dirty(self):
+        self.dirty = bytearray(self.height)
+
+    def drop_original(self):
+        """
+        Free the bytes kept by fromBinary(). toBinary() will then encode
+        every row.
+        """
+        self.original = None
+
     def _set(self, x, y, value):
         byte_index = (x >> 3)
         bit = (1 << (x & 7))
@@ -48,6 +158,7 @@ class WBitMatrix:
             self.rows[y][byte_index] &= ~bit
         else:
             self.rows[y][byte_index] |= bit
+        self.dirty[y] = 1
         return
 
     def set(self, x, y, value, flipped=False):
@@ -76,25 +187,330 @@ class WBitMatrix:
             y = (self.height - y - 1)
         return self._get(x, y)
 
+    def get_row_bytes(self, y, flipped=False):
+        """
+        Get row y with one byte (0 or 1) per column.
+        """
+        if (y < 0) or (y >= self.height):
+            raise ValueError("Row index", y, "is out of range")
+        if flipped:
+            y = (self.height - y - 1)
+        return self._row_bytes(y)
+
+    def fill_span(self, y, x0, x1, value, flipped=False):
+        """
+        Set columns [x0, x1) of row y to value. The span is clipped to the
+        matrix.
+        """
+        if (value < 0) or (value > 1):
+            raise ValueError("Value", value, "is not a single bit")
+        if (y < 0) or (y >= self.height):
+            return
+        if flipped:
+            y = (self.height - y - 1)
+        x0 = max(x0, 0)
+        x1 = min(x1, self.width)
+        if x0 >= x1:
+            return
+        self._fill_span(y, x0, x1, value)
+        self.dirty[y] = 1
+        return
+
+    def _fill_span(self, y, x0, x1, value):
+        # Whole bytes are filled at once, only the partial bytes at either
+        # end are masked.
+        row = self.rows[y]
+        b0 = x0 >> 3
+        b1 = (x1 - 1) >> 3
+        # Bits from x0 up in the first byte, and up to x1 in the last byte
+        first = (0xff << (x0 & 7)) & 0xff
+        last = (1 << (((x1 - 1) & 7) + 1)) - 1
+        if b0 == b1:
+            first &= last
+        if value:
+            row[b0] |= first
+        else:
+            row[b0] &= ~first & 0xff
+        if b0 != b1:
+            if b1 - b0 > 1:
+                fill = b'\xff' if value else b'\x00'
+                row[b0+1:b1] = array.array("B", fill * (b1 - b0 - 1))
+            if value:
+                row[b1] |= last
+            else:
+                row[b1] &= ~last & 0xff
+        return
+
+    def fill_rect(self, x, y, w, h, value=1, flipped=False):
+        """
+        Set the w x h rectangle at (x, y) to value, clipped to the matrix.
+        """
+        for row in range(max(y, 0), min(y + h, self.height)):
+            self.fill_span(row, x, x + w, value, flipped=flipped)
+        return
+
+    def fill_circle(self, cx, cy, r, value=1, flipped=False):
+        """
+        Set every pixel within r of (cx, cy) to value. The center and radius
+        don't have to be whole numbers.
+        """
+        if r < 0:
+            return
+        for y in range(max(int(math.ceil(cy - r)), 0),
+                       min(int(math.floor(cy + r)), self.height - 1) + 1):
+            dx = math.sqrt(max((r * r) - ((y - cy) * (y - cy)), 0.0))
+            self.fill_span(y, int(math.ceil(cx - dx)),
+                           int(math.floor(cx + dx)) + 1, value,
+                           flipped=flipped)
+        return
+
+    def _polygon_spans(self, points, y):
+        # Even-odd scanline crossings of row y, as (x0, x1) spans
+        xs = []
+        n = len(points)
+        for i in range(n):
+            (x1, y1) = points[i][0:2]
+            (x2, y2) = points[(i + 1) % n][0:2]
+            if (y1 <= y < y2) or (y2 <= y < y1):
+                xs.append(x1 + ((y - y1) * (x2 - x1) / float(y2 - y1)))
+        xs.sort()
+        return [(int(math.ceil(xs[i])), int(math.ceil(xs[i+1])))
+                for i in range(0, len(xs) - 1, 2)]
+
+    def fill_polygon(self, points, value=1, flipped=False):
+        """
+        Set every pixel inside the polygon given by a list of (x, y) points
+        to value (even-odd rule).
+        """
+        if len(points) < 3:
+            return
+        ys = [p[1] for p in points]
+        for y in range(max(int(math.ceil(min(ys))), 0),
+                       min(int(math.floor(max(ys))), self.height - 1) + 1):
+            for (x0, x1) in self._polygon_spans(points, y):
+                self.fill_span(y, x0, x1, value, flipped=flipped)
+        return
+
+    def fill_corridor(self, points, r, value=1, flipped=False):
+        """
+        Set every pixel within r of the polyline through the list of (x, y)
+        points to value.
+        """
+        if r < 0 or len(points) == 0:
+            return
+        if len(points) == 1:
+            self.fill_circle(points[0][0], points[0][1], r, value,
+                             flipped=flipped)
+            return
+        for i in range(len(points) - 1):
+            self._fill_capsule(points[i][0:2], points[i+1][0:2], r, value,
+                               flipped)
+        return
+
+    def _fill_capsule(self, a, b, r, value, flipped):
+        # Everything within r of the segment a-b. That's convex, so each row
+        # is a single span: the hull of the row's spans through the rotated
+        # rectangle along the segment and the circles at either end.
+        (ax, ay) = a
+        (bx, by) = b
+        length = math.hypot(bx - ax, by - ay)
+        if length == 0:
+            self.fill_circle(ax, ay, r, value, flipped=flipped)
+            return
+        # Offset perpendicular to the segment
+        ox = -(by - ay) * r / length
+        oy = (bx - ax) * r / length
+        rect = [(ax + ox, ay + oy), (bx + ox, by + oy),
+                (bx - ox, by - oy), (ax - ox, ay - oy)]
+        r2 = r * r
+        y_lo = max(int(math.ceil(min(ay, by) - r)), 0)
+        y_hi = min(int(math.floor(max(ay, by) + r)), self.height - 1)
+        for y in range(y_lo, y_hi + 1):
+            spans = self._polygon_spans(rect, y)
+            for (cx, cy) in (a, b):
+                d2 = r2 - ((y - cy) * (y - cy))
+                if d2 >= 0:
+                    dx = math.sqrt(d2)
+                    spans.append((int(math.ceil(cx - dx)),
+                                  int(math.floor(cx + dx)) + 1))
+            spans = [sp for sp in spans if sp[0] < sp[1]]
+            if len(spans) != 0:
+                self.fill_span(y, min([sp[0] for sp in spans]),
+                               max([sp[1] for sp in spans]), value,
+                               flipped=flipped)
+        return
+
+    def popcount(self):
+        """
+        Number of set bits.
+        """
+        return sum([bin(int.from_bytes(r, 'little')).count('1')
+                    for r in self.rows])
+
+    def merge_or(self, other):
+        """
+        Set every bit that's set in other, a matrix of the same dimensions.
+        """
+        if (self.width != other.width) or (self.height != other.height):
+            raise ValueError("Matrix dimensions differ")
+        if type(other) is not WBitMatrix:
+            for y in range(self.height):
+                for (x0, x1) in other._row_spans(y):
+                    self.fill_span(y, x0, x1, 1)
+            return
+        # Whole rows at a time as big ints
+        for y in range(self.height):
+            a = int.from_bytes(self.rows[y], 'little')
+            b = int.from_bytes(other.rows[y], 'little')
+            if (b & ~a) != 0:
+                self.rows[y] = array.array("B",
+                        (a | b).to_bytes(self.bytes_per_row, 'little'))
+                self.dirty[y] = 1
+        return
+
+    def _row_spans(self, y):
+        # Runs of set bits in row y as (x0, x1) pairs
+        runs = _find_runs(self._row_bytes(y), 0, self.width)
+        return list(zip(runs[0::2], runs[1::2]))
+
+    def _row_bytes(self, y):
+        # Bit x of the little-endian row is column x, so the reversed
+        # binary string of the row is the columns in order.
+        v = int.from_bytes(self.rows[y], 'little')
+        bits = format(v, 'b').zfill(self.width)[::-1]
+        return bits.encode('ascii').translate(_digit_to_byte)
+
+    def _pack_row(self, b):
+        # The reverse of _row_bytes()
+        if self.width == 0:
+            return array.array("B")
+        v = int(b.translate(_byte_to_digit)[::-1], 2)
+        return array.array("B", v.to_bytes(self.bytes_per_row, 'little'))
+
     def fromBinary(self, binrdr):
         """
         1 byte per bit
         """
-        # XXX: We could definitly optimize this
-        for y in range(self.height):
-            b = binrdr.read(self.width)
-            for x in range(self.width):
-                self._set(x, y, b[x])
+        data = binrdr.read(self.width * self.height)
+        if len(data) != self.width * self.height:
+            raise ValueError("Not enough visibility data")
+        self._load(data, data.translate(_byte_to_bit))
+        return
+
+    def _load(self, data, bits):
+        # data is as read from disk, bits the same with only 0 and 1 bytes
+        w = self.width
+        self.rows = [self._pack_row(bits[y*w:(y+1)*w])
+                     for y in range(self.height)]
+        # Keep the original bytes for toBinary()
+        self.original = data
+        self.clear_dirty()
         return
 
     def toBinary(self, binwr):
         """
         1 byte per bit
         """
-        # XXX: We could definitly optimize this
+        w = self.width
+        if self.original is None:
+            for y in range(self.height):
+                binwr.write_raw(self._row_bytes(y))
+            return
+        # Copy runs of clean rows straight from the original data
+        y = 0
+        while y < self.height:
+            if self.dirty[y]:
+                binwr.write_raw(self._row_bytes(y))
+                y += 1
+                continue
+            end = y + 1
+            while (end < self.height) and (not self.dirty[end]):
+                end += 1
+            binwr.write_raw(self.original[y*w:end*w])
+            y = end
+        return
+
+
+class WRunBitMatrix(WBitMatrix):
+    """
+    Run-length backed WBitMatrix, for maps that are mostly fog (or mostly
+    explored). Memory and time scale with the number of runs rather than
+    the number of pixels.
+
+    Each row is a flat sorted list [start0, end0, start1, end1, ...] of the
+    column ranges that are set. The runs never touch or overlap, so a
+    column is set when an odd number of boundaries are at or before it.
+
+    The original bytes are only kept by fromBinary() if they hold values
+    other than 0 and 1; otherwise the runs reproduce them exactly.
+    """
+    def set_dimensions(self, w, h):
+        self.width = w
+        self.height = h
+
+        self.bytes_per_row = (w >> 3)
+        if (w & 7) != 0:
+            self.bytes_per_row += 1
+
+        self.rows = [[] for r in range(h)]
+        self._ones = b'\x01' * w
+
+        self.original = None
+        self.dirty = bytearray(h)
+        return
+
+    def _set(self, x, y, value):
+        self._fill_span(y, x, x + 1, value)
+        self.dirty[y] = 1
+        return
+
+    def _get(self, x, y):
+        return bisect.bisect_right(self.rows[y], x) & 1
+
+    def _fill_span(self, y, x0, x1, value):
+        row = self.rows[y]
+        lo = bisect.bisect_left(row, x0)
+        hi = bisect.bisect_right(row, x1)
+        # An odd index means x0 (or x1) is inside or touching a run, which
+        # then absorbs the new run or is cut short by the cleared one.
+        if value:
+            new = ([] if (lo & 1) else [x0]) + ([] if (hi & 1) else [x1])
+        else:
+            new = ([x0] if (lo & 1) else []) + ([x1] if (hi & 1) else [])
+        row[lo:hi] = new
+        return
+
+    def popcount(self):
+        total = 0
+        for row in self.rows:
+            total += sum(row[1::2]) - sum(row[0::2])
+        return total
+
+    def merge_or(self, other):
+        if (self.width != other.width) or (self.height != other.height):
+            raise ValueError("Matrix dimensions differ")
         for y in range(self.height):
-            for x in range(self.width):
-                binwr.write_u8(self._get(x, y))
+            for (x0, x1) in other._row_spans(y):
+                self.fill_span(y, x0, x1, 1)
+        return
+
+    def _row_spans(self, y):
+        row = self.rows[y]
+        return list(zip(row[0::2], row[1::2]))
+
+    def _row_bytes(self, y):
+        row = self.rows[y]
+        b = bytearray(self.width)
+        for i in range(0, len(row), 2):
+            b[row[i]:row[i+1]] = self._ones[row[i]:row[i+1]]
+        return bytes(b)
+
+    def _load(self, data, bits):
+        w = self.width
+        self.rows = [_find_runs(bits, y*w, (y+1)*w)
+                     for y in range(self.height)]
+        self.original = data if (data != bits) else None
+        self.clear_dirty()
         return
 
 # vim:ts=4:sw=4:et
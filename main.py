@@ -7,58 +7,482 @@ import os
 import sys
 
 # Local modules
+import FCHBatch
 from BinReader import BinReader
-from BinWriter import BinWriter
+from BinWriter import BinWriter, replace_file
+from Compression import FORMATS as COMPRESSION_FORMATS
 from FCH import FCH_Root
+from FCHCSV import FCHCSV
+from FCHMerge import FCHMapMerge
+from FCHSQLite import FCHSQLite
+from FCHSalvage import salvage_file
+from FCHValidate import validate_file
+from LocalUtil import die, info
+from MapQuery import FCHMapQuery
+from MapTiles import MapTileExporter
+from PBMImage import rows_to_pbm
+from PrettyPrinter import PPWrap, PrettyPrinter
+from SnapshotStore import FCHSnapshotStore
+from StrPool import StrPool
+
+def int_list(count):
+    # argparse type for comma separated integers, e.g. "X,Y"
+    def parse(s):
+        try:
+            ret = [int(v) for v in s.split(',')]
+        except ValueError:
+            ret = []
+        if len(ret) != count:
+            raise argparse.ArgumentTypeError(
+                "expected {} comma separated integers".format(count))
+        return ret
+    return parse
+
+def region_spec(value):
+    # argparse type for "CENTER:RADIUS", where CENTER is a world point name
+    # or world "X,Z" coordinates and RADIUS is in meters.
+    def parse(s):
+        (center, _, radius) = s.rpartition(':')
+        try:
+            radius = float(radius)
+            if center in ('spawn', 'home', 'logout', 'death'):
+                pass
+            else:
+                center = [float(v) for v in center.split(',')]
+                if len(center) != 2:
+                    raise ValueError()
+                # World points are X,Y,Z with Y the height
+                center = [center[0], 0.0, center[1]]
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "expected CENTER:RADIUS with CENTER spawn, home, logout, " +
+                "death or X,Z")
+        return (value, center, radius)
+    return parse
 
 argsp = argparse.ArgumentParser(description="Valheim Character Save File Tool")
-argsp.add_argument('path', type=str,
+argsp.add_argument('path', type=str, nargs='+',
                    help=("Input or output path, this differs depending on " +
                          " the mode. If no mode is specified, then the path " +
-                         "is an input valheim character file"))
+                         "is an input valheim character file. Modes working " +
+                         "on many character files accept several paths. " +
+                         "'-' reads from stdin, or writes to stdout when " +
+                         "constructing"))
 argsp.add_argument('--destruct', type=str,
                    help="Export valheim character file to a directory")
 argsp.add_argument('--construct', type=str,
                    help=("Construct a valheim character file from a " +
                          "'destruct' formatted directory"))
+argsp.add_argument("--stream", action='store_true',
+                   help=("With --construct: copy the minimap rows from the " +
+                         "PBM files straight into the output file instead " +
+                         "of loading them and serializing in memory. The " +
+                         "file is verified by reading it back afterwards, " +
+                         "without comparing minimaps"))
+argsp.add_argument("--compress", default='auto',
+                   choices=['auto', 'none'] + COMPRESSION_FORMATS,
+                   help=("Compression of written character files. 'auto' " +
+                         "(the default) goes by the file extension: .gz, " +
+                         ".bz2, .xz or .lzma. Compressed input is always " +
+                         "detected"))
+argsp.add_argument("--compress-level", type=int, metavar='N',
+                   help=("Compression level, 1 (fastest) to 9 (smallest) " +
+                         "for gzip and bz2, 0 to 9 for xz and lzma"))
 argsp.add_argument("--overwrite", action='store_true',
                    help="Replace output files if they already exist")
 argsp.add_argument("--quiet", action='store_true',
                    help="Don't print file info")
+argsp.add_argument("--format", choices=PrettyPrinter.FORMATS, default='text',
+                   help=("File info output format: 'text' for humans, " +
+                         "'jsonl' for one JSON key/value object per line"))
+argsp.add_argument("--verify", choices=['none', 'parse', 'full'],
+                   default='parse',
+                   help=("How to verify a constructed file before it's " +
+                         "written: 'none' skips verification, 'parse' " +
+                         "re-parses the serialized data, 'full' also " +
+                         "compares it against the constructed data"))
+argsp.add_argument('--validate', action='store_true',
+                   help=("Check the input character files are well-formed " +
+                         "without loading them, reporting the first " +
+                         "inconsistency in each with its byte offset"))
+argsp.add_argument('--salvage', action='store_true',
+                   help=("Triage damaged input character files, reporting " +
+                         "what of each can't be recovered"))
+argsp.add_argument('--salvage-dir', type=str, metavar='DIR',
+                   help=("Write what --salvage recovers to files of the " +
+                         "same name in DIR, with a fresh checksum"))
+argsp.add_argument('--export-sqlite', type=str, metavar='DB',
+                   help=("Export the input character files into an SQLite " +
+                         "database. Files unchanged since the last export " +
+                         "are skipped"))
+argsp.add_argument('--export-csv', type=str, metavar='DIR',
+                   help=("Export the inventory items and skills of the " +
+                         "input character files to CSV files in DIR"))
+argsp.add_argument('--tsv', action='store_true',
+                   help="Use tab separated files with --export-csv")
+argsp.add_argument('--merge-maps', action='store_true',
+                   help=("Combine the minimaps of worlds with the same UID " +
+                         "across the input character files and write the " +
+                         "result back into each of them. Only --world-uid " +
+                         "is merged, if given. Needs --overwrite"))
+argsp.add_argument('--merge-tolerance', type=float, default=1.0,
+                   metavar='METERS',
+                   help=("With --merge-maps: markers with the same text " +
+                         "and symbol within METERS of each other are the " +
+                         "same marker (default: 1)"))
+argsp.add_argument('--snapshot', type=str, metavar='STORE',
+                   help=("Store a snapshot of each input character file " +
+                         "in the snapshot store directory STORE. Only " +
+                         "the parts that changed since earlier snapshots " +
+                         "take up space"))
+argsp.add_argument('--restore', type=str, metavar='STORE',
+                   help=("Restore the snapshot --snapshot-name from STORE " +
+                         "to the output path"))
+argsp.add_argument('--list-snapshots', action='store_true',
+                   help="List the snapshots in the store at path")
+argsp.add_argument('--serve', action='store_true',
+                   help=("Serve info, query, patch and export requests " +
+                         "as JSON lines on the Unix socket at path, " +
+                         "keeping recently used files loaded"))
+argsp.add_argument('--cache-size', type=int, default=8, metavar='N',
+                   help=("Number of loaded files --serve keeps " +
+                         "(default: 8)"))
+argsp.add_argument('--snapshot-name', type=str, metavar='NAME',
+                   help=("Snapshot to restore, or the name to store a " +
+                         "single snapshot under (default: the file name, " +
+                         "the current time and a hash prefix)"))
+argsp.add_argument('--pixel', type=int_list(2), metavar='X,Y',
+                   help=("Print if minimap pixel (X,Y) is explored (1) or " +
+                         "not (0). Coordinates are top-down, as in the " +
+                         "PBM files"))
+argsp.add_argument('--crop', type=int_list(4), metavar='X,Y,W,H',
+                   help="Print a WxH area of the minimap at (X,Y) as a PBM")
+argsp.add_argument('--count-explored', type=int_list(4), metavar='X,Y,W,H',
+                   help=("Print the number of explored pixels in a WxH " +
+                         "area of the minimap at (X,Y)"))
+argsp.add_argument('--tiles', type=str, metavar='DIR',
+                   help=("Export a world's minimap as a z/x/y tile pyramid " +
+                         "to DIR. Only tiles that changed since the last " +
+                         "export to DIR are written"))
+argsp.add_argument('--tile-size', type=int, default=256,
+                   help="Tile edge length in pixels (default: 256)")
+argsp.add_argument('--tile-mode', choices=MapTileExporter.MODES, default='or',
+                   help=("How tiles are downsampled: 'or' marks a pixel " +
+                         "explored if any pixel it covers is, 'coverage' " +
+                         "gives the explored fraction as a gray level"))
+argsp.add_argument('--tile-format', choices=MapTileExporter.FORMATS,
+                   default='png', help="Tile image format (default: png)")
+argsp.add_argument('--reveal', type=region_spec(1), action='append',
+                   dest='regions', metavar='CENTER:RADIUS',
+                   help=("Mark the minimap explored within RADIUS meters " +
+                         "of CENTER, which is spawn, home, logout, death " +
+                         "or world coordinates X,Z. May be repeated"))
+argsp.add_argument('--hide', type=region_spec(0), action='append',
+                   dest='regions', metavar='CENTER:RADIUS',
+                   help=("Mark the minimap unexplored within RADIUS meters " +
+                         "of CENTER, like --reveal. May be repeated"))
+argsp.add_argument('--dedupe-markers', type=float, metavar='METERS',
+                   help=("Remove map markers with the same text and " +
+                         "symbol as another marker within METERS of it"))
+argsp.add_argument('--output', type=str,
+                   help=("Where --reveal, --hide and --dedupe-markers " +
+                         "write the changed " +
+                         "character file (default: the input file, which " +
+                         "needs --overwrite)"))
+argsp.add_argument('--world', type=int, default=0,
+                   help=("World index used by minimap queries and tiles " +
+                         "(default: 0)"))
+argsp.add_argument('--world-uid', type=int,
+                   help=("World UID used by minimap queries and tiles, " +
+                         "instead of --world"))
+argsp.add_argument('--workers', type=int,
+                   help=("Number of worker processes used by the modes " +
+                         "working on many files (default: CPU count)"))
 
 args = argsp.parse_args()
 
-if args.construct and args.destruct:
-    print("--construct and --destruct are mutually exclusive!")
+# --reveal, --hide and --dedupe-markers all edit a file, so go together
+args.edit = bool(args.regions or (args.dedupe_markers is not None))
+modes = [m for m in ('destruct', 'construct', 'validate', 'salvage',
+                    'export_sqlite', 'export_csv', 'merge_maps', 'snapshot',
+                    'restore', 'list_snapshots', 'serve', 'pixel', 'crop',
+                    'count_explored', 'tiles', 'edit')
+         if getattr(args, m)]
+if len(modes) > 1:
+    names = {'edit': 'reveal/--hide/--dedupe-markers'}
+    print("--{} are mutually exclusive!".format(
+        " and --".join([names.get(m, m.replace('_', '-')) for m in modes])))
     argsp.print_help()
     sys.exit(1)
 
+# Only the multi-file modes accept more than one path, printing the info
+# of several files is one of them
+multi_file = bool(args.validate or args.salvage or args.export_sqlite or
+                  args.export_csv or args.merge_maps or args.snapshot or
+                  ((len(modes) == 0) and (len(args.path) > 1)))
+if not multi_file:
+    if len(args.path) != 1:
+        print("Only a single path is accepted in this mode!")
+        argsp.print_help()
+        sys.exit(1)
+    args.path = args.path[0]
+elif '-' in args.path:
+    print("Reading from stdin isn't supported in this mode!")
+    sys.exit(1)
+
+# Binary output to stdout pushes the file info over to stderr
+info_out = None
+if args.construct and (args.path == '-'):
+    info_out = sys.stderr
+elif args.edit and ((args.output or args.path) == '-'):
+    info_out = sys.stderr
+
 # When destructing, we need to make the directory if it doesn't exist
 if args.destruct:
     if not os.path.exists(args.destruct):
         os.makedirs(args.destruct)
     fh = FCH_Root()
     with BinReader(args.path) as br:
-        fh.fromBinary(br)
+        fh.destructStream(br, args.destruct, overwrite = args.overwrite)
     if not args.quiet:
-        fh.printInfo()
-    fh.destruct(args.destruct, overwrite = args.overwrite)
+        fh.printInfo(fmt=args.format, out=info_out)
+elif args.construct and args.stream:
+    fh = FCH_Root()
+    fh.construct(args.construct, stream=True)
+    with BinWriter(args.path, overwrite = args.overwrite,
+                   compress = args.compress,
+                   level = args.compress_level) as wr:
+        fh.toBinary(wr)
+    if (args.verify != 'none') and (args.path == '-'):
+        info("Can't read back what was written to stdout, not verifying")
+    elif args.verify != 'none':
+        # Sanity read it again, one world at a time.
+        check = FCH_Root()
+        with BinReader(args.path) as br:
+            check.fromBinary(br, verify_checksum=False,
+                             world_fn=lambda i, w: w.vis_data.releasePixels())
+        if args.verify == 'full':
+            diffs = fh.compare(check)
+            if len(diffs) != 0:
+                die("Verification of the constructed file failed:",
+                    "\n  " + "\n  ".join(diffs))
+        fh = check
+    if not args.quiet:
+        fh.printInfo(fmt=args.format, out=info_out)
 elif args.construct:
     fh = FCH_Root()
     fh.construct(args.construct)
-    with BinWriter(args.path, overwrite = args.overwrite) as wr:
-        fh.toBinary(wr)
-    # Sanity read it again!
+    # Serialize in memory so it can be verified before anything hits disk.
+    data = fh.toBytes()
+    if args.verify != 'none':
+        # Sanity read it again! The checksum was just calculated from these
+        # very bytes, so there's no sense hashing them a second time.
+        check = FCH_Root()
+        check.fromBytes(data, verify_checksum=False)
+        if args.verify == 'full':
+            diffs = fh.compare(check)
+            if len(diffs) != 0:
+                die("Verification of the constructed file failed:",
+                    "\n  " + "\n  ".join(diffs))
+        fh = check
+    with BinWriter(args.path, overwrite = args.overwrite,
+                   compress = args.compress,
+                   level = args.compress_level) as wr:
+        wr.write_raw(data)
+    if not args.quiet:
+        fh.printInfo(fmt=args.format, out=info_out)
+elif args.export_sqlite:
+    with FCHSQLite(args.export_sqlite) as db:
+        (exported, skipped, failed) = db.export(args.path,
+                                                workers=args.workers)
+    info("Exported {} files, skipped {} unchanged, {} failed".format(
+        exported, skipped, failed))
+    if failed != 0:
+        sys.exit(1)
+elif args.validate:
+    invalid = 0
+    for (path, ret, error) in FCHBatch.run(validate_file, args.path,
+                                           workers=args.workers):
+        if error is not None:
+            print("{}: {}".format(path, error))
+        elif ret is not None:
+            print("{}: offset {}: {}".format(path, ret[0], ret[1]))
+        else:
+            print("{}: OK".format(path))
+            continue
+        invalid += 1
+    if invalid != 0:
+        sys.exit(1)
+elif args.salvage:
+    if (args.salvage_dir is not None) and \
+            not os.path.exists(args.salvage_dir):
+        os.makedirs(args.salvage_dir)
+    damaged = 0
+    for (path, ret, error) in FCHBatch.run(
+            salvage_file, args.path, workers=args.workers,
+            args=(args.salvage_dir, args.overwrite)):
+        if error is not None:
+            print("{}: {}".format(path, error))
+            damaged += 1
+            continue
+        (status, losses) = ret
+        if status == 'ok':
+            print("{}: OK".format(path))
+            continue
+        damaged += 1
+        if status == 'salvaged':
+            print("{}: salvaged".format(path))
+        else:
+            print("{}: nothing recoverable".format(path))
+        for l in losses:
+            print("  " + l)
+    if damaged != 0:
+        sys.exit(1)
+elif args.export_csv:
+    with FCHCSV(args.export_csv, tsv=args.tsv,
+                overwrite=args.overwrite) as out:
+        (exported, failed) = out.export(args.path, workers=args.workers)
+    info("Exported {} files, {} failed".format(exported, failed))
+    if failed != 0:
+        sys.exit(1)
+elif args.merge_maps:
+    if not args.overwrite:
+        die("--merge-maps rewrites the input files, use --overwrite to " +
+            "allow it")
+    uids = None
+    if args.world_uid is not None:
+        uids = [args.world_uid]
+    merger = FCHMapMerge(tolerance=args.merge_tolerance, uids=uids)
+    (written, unchanged, failed) = merger.merge(args.path,
+                                                workers=args.workers)
+    info("Updated {} files, {} unchanged, {} failed".format(
+        written, unchanged, failed))
+    if failed != 0:
+        sys.exit(1)
+elif args.snapshot:
+    if (args.snapshot_name is not None) and (len(args.path) > 1):
+        die("--snapshot-name only works with a single file")
+    store = FCHSnapshotStore(args.snapshot)
+    for path in args.path:
+        (name, chunks, size) = store.snapshot(path, name=args.snapshot_name,
+                                              overwrite=args.overwrite)
+        info("Stored snapshot {}, {} new chunks ({} bytes)".format(
+            name, chunks, size))
+elif args.restore:
+    if args.snapshot_name is None:
+        die("--restore needs a --snapshot-name")
+    store = FCHSnapshotStore(args.restore)
+    store.restore(args.snapshot_name, args.path, overwrite=args.overwrite,
+                  compress=args.compress, level=args.compress_level)
+elif args.list_snapshots:
+    if not os.path.isdir(args.path):
+        die("No snapshot store at", args.path)
+    pp = PrettyPrinter(fmt=args.format)
+    FCHSnapshotStore(args.path).printInfo(pp)
+    pp.flush()
+elif args.serve:
+    if args.path == '-':
+        die("--serve needs a socket path")
+    if sys.version_info < (3, 9):
+        die("--serve needs python3 version 3.9 or higher")
+    # Only imported here, the service needs a newer python3 than the rest
+    from FCHService import FCHService
+    FCHService(args.path, workers=args.workers,
+               cache_size=args.cache_size).serve()
+elif args.pixel or args.crop or args.count_explored:
+    if args.path == '-':
+        die("Minimap queries need a file, not stdin")
+    with FCHMapQuery(args.path) as q:
+        world = args.world
+        if args.world_uid is not None:
+            world = q.find_world(args.world_uid)
+            if world is None:
+                die("No world with UID", args.world_uid)
+        try:
+            if args.pixel:
+                print(q.get_pixel(world, *args.pixel, flipped=True))
+            elif args.crop:
+                rows = q.crop(world, *args.crop, flipped=True)
+                sys.stdout.write(rows_to_pbm(args.crop[2], rows))
+            else:
+                print(q.count_explored(world, *args.count_explored,
+                                       flipped=True))
+        except ValueError as e:
+            die("Bad minimap query:", " ".join([str(a) for a in e.args]))
+elif args.tiles:
+    exporter = MapTileExporter(tile_size=args.tile_size, mode=args.tile_mode,
+                               fmt=args.tile_format)
+    # Only keep the requested world's minimap in memory
+    def keep_world(i, w):
+        if args.world_uid is not None:
+            keep = (w.uid == args.world_uid)
+        else:
+            keep = (i == args.world)
+        if not keep:
+            w.vis_data.releasePixels()
+    fh = FCH_Root()
+    with BinReader(args.path) as br:
+        fh.fromBinary(br, world_fn=keep_world)
+    world = None
+    for (i, w) in enumerate(fh.worlds.worlds):
+        if w.have_vis_data and w.vis_data.hasPixels():
+            world = w
+    if world is None:
+        die("No such world with visibility data")
+    (written, skipped) = exporter.export(world.vis_data, args.tiles)
+    info("Wrote {} tiles, {} unchanged".format(written, skipped))
+elif args.edit:
+    output = args.output if args.output else args.path
+    if (output != '-') and os.path.exists(output) and not args.overwrite:
+        die("'{}' already exists, use --overwrite to replace it".format(
+            output))
+    fh = FCH_Root()
     with BinReader(args.path) as br:
         fh.fromBinary(br)
+    world = fh.worlds.getWorld(args.world, uid=args.world_uid)
+    if (world is None) or (not world.have_vis_data):
+        die("No such world with visibility data")
+    for (value, center, radius) in (args.regions or []):
+        if isinstance(center, str):
+            name = center
+            center = world.namedPoint(name)
+            if center is None:
+                die("World has no {} point".format(name))
+        world.vis_data.fillCircle(center, radius, value)
+    if args.dedupe_markers is not None:
+        removed = world.vis_data.marker_list.dedupe(args.dedupe_markers)
+        info("Removed {} duplicate markers".format(removed))
+    # Serialize first, then swap the file in whole, so a failure doesn't
+    # leave a partial file behind.
+    data = fh.toBytes()
+    if output == '-':
+        with BinWriter(output, compress = args.compress,
+                       level = args.compress_level) as wr:
+            wr.write_raw(data)
+    else:
+        replace_file(output, data, compress = args.compress,
+                     level = args.compress_level)
+    if not args.quiet:
+        fh.printInfo(fmt=args.format, out=info_out)
+elif multi_file:
+    # Default is read the files and print info. They share a string pool,
+    # so the game identifiers they have in common are only kept once.
+    pool = StrPool()
+    for path in args.path:
+        fh = FCHBatch.load(path, str_pool=pool)
+        if not args.quiet:
+            fh.printInfo(fmt=args.format, out=info_out, label=path)
     if not args.quiet:
-        fh.printInfo()
+        pp = PrettyPrinter(fmt=args.format, out=info_out)
+        with PPWrap(pp, "String Pool"):
+            pool.printInfo(pp)
+        pp.flush()
 else:
     # Default is read the file and print info
     fh = FCH_Root()
     with BinReader(args.path) as br:
         fh.fromBinary(br)
     if not args.quiet:
-        fh.printInfo()
+        fh.printInfo(fmt=args.format, out=info_out)
 
 # vim:ts=4:sw=4:et
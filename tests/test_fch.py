@@ -0,0 +1,1313 @@
+# Copyright 2021-2021, cQuaid and the valheim-fch-editor contributors
+# SPDX-License-Identifier: MIT
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import mmap
+import os
+import random
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# Local modules
+import Compression
+import DecodePlan
+import FCHBatch
+import FCHMerge
+import MapTiles
+import PBMImage
+import WBitMatrix
+from BinReader import BinReader, ForwardStream, MemoryStream, \
+                      decode_7bit_encoded_int, decode_binstrs
+from BinWriter import BinWriter, encode_7bit_encoded_int, \
+                      encode_binstrs, replace_file
+from FCH import FCH_ActiveFood, FCH_Biome, FCH_CraftingStation, \
+                FCH_InvItem, FCH_JournalEntry, FCH_Root, FCH_Skill, \
+                FCH_World, FCH_WorldMarker, FCH_WorldMarkerList
+from FCHCSV import FCHCSV, INVENTORY_COLUMNS, SKILL_COLUMNS
+from FCHSalvage import FCHSalvage, salvage_file
+from FCHSections import FCHSectionIndex
+from FCHSQLite import FCHSQLite
+from FCHValidate import FCHValidator, validate_file
+from LocalUtil import CountedList
+from MapQuery import FCHMapQuery
+from MapTiles import MapTileExporter
+from MarkerIndex import MarkerIndex
+from SnapshotStore import FCHSnapshotStore
+from StrPool import StrPool
+
+def _to_binary(obj):
+    with BinWriter() as wr:
+        obj.toBinary(wr)
+        return wr.getvalue()
+
+def _both(w, h):
+    return (WBitMatrix.WBitMatrix(w, h), WBitMatrix.WRunBitMatrix(w, h))
+
+def _scribble(rnd, matrices, ops=200):
+    # The same random edits on every matrix
+    (w, h) = (matrices[0].get_width(), matrices[0].get_height())
+    for i in range(ops):
+        kind = rnd.randrange(3)
+        value = rnd.randrange(2)
+        if kind == 0:
+            (x, y) = (rnd.randrange(w), rnd.randrange(h))
+            for m in matrices:
+                m.set(x, y, value)
+        elif kind == 1:
+            (y, x0, x1) = (rnd.randrange(h), rnd.randrange(-3, w),
+                           rnd.randrange(-3, w + 3))
+            for m in matrices:
+                m.fill_span(y, x0, x1, value)
+        else:
+            (cx, cy, r) = (rnd.uniform(0, w), rnd.uniform(0, h),
+                           rnd.uniform(0, w / 3))
+            for m in matrices:
+                m.fill_circle(cx, cy, r, value)
+
+def _marker(text, point, symbol, crossed=False):
+    m = FCH_WorldMarker()
+    (m.text, m.point, m.symbol, m.crossed) = (text, point, symbol, crossed)
+    return m
+
+def _fixture(edge=40):
+    # A small FCH file with a bit of everything in it
+    rnd = random.Random(edge)
+    fh = FCH_Root()
+    ps = fh.player_stats
+    ps.version = ps.CURRENT_VERSION
+    (ps.kill_count, ps.death_count, ps.craft_count, ps.build_count) = \
+        (3, 1, 40, 200)
+
+    for uid in (1234567890123, 42):
+        w = FCH_World()
+        w.uid = uid
+        (w.have_spawn_point, w.spawn_point) = (True, [10.5, 32.0, -7.25])
+        (w.have_logout_point, w.logout_point) = (True, [1.0, 2.0, 3.0])
+        w.home_point = [-100.0, 30.5, 250.0]
+        w.have_vis_data = (uid != 42)
+        if w.have_vis_data:
+            vis = w.vis_data
+            vis.edge_length = edge
+            vis.pixel_data = WBitMatrix.WBitMatrix(edge, edge)
+            _scribble(rnd, [vis.pixel_data], ops=20)
+            vis.marker_list.markers = [
+                _marker("Home", [12.0, 0.0, -40.5], "House"),
+                _marker("", [800.0, 0.0, 900.0], "Dot", True),
+                _marker("Elder", [-3000.0, 0.0, 1500.0], "Boss"),
+            ]
+            vis.public_position = True
+        fh.worlds.worlds.append(w)
+
+    pd = fh.player_data
+    (pd.name, pd.player_id, pd.start_seed) = ("Viking", 987654321, b"seed")
+    (pd.health_max, pd.health, pd.stamina_max) = (25.0, 24.5, 50.0)
+    (pd.first_spawn, pd.time_since_death) = (False, 1500.25)
+    (pd.gp_name, pd.gp_cooldown) = ("GP_Eikthyr", 12.5)
+    pd.inventory.version = pd.inventory.CURRENT_VERSION
+    for (i, name) in enumerate(["SwordIron", "Wood", "ShieldWood"]):
+        item = FCH_InvItem()
+        (item.name, item.count, item.durability) = (name, i + 1, 100.0)
+        (item.slot, item.equipped, item.level) = ([i, 0], i != 1, 2)
+        (item.crafter_id, item.crafter_name) = (987654321, "Viking")
+        pd.inventory.items.append(item)
+    pd.known_recipes.data = ["Recipe_Club", "Recipe_Torch"]
+    station = FCH_CraftingStation()
+    (station.name, station.level) = ("piece_workbench", 3)
+    pd.known_stations.data = [station]
+    pd.discovered_materials.data = ["Wood", "Stone"]
+    pd.shown_tutorials.data = ["hammer"]
+    pd.trophies.data = ["TrophyBoar"]
+    for name in ("Meadows", "Black Forest"):
+        biome = FCH_Biome()
+        biome.biome_str = name
+        pd.known_biomes.data.append(biome)
+    entry = FCH_JournalEntry()
+    (entry.label, entry.text) = ("Eikthyr", "A stag")
+    pd.journal.data = [entry]
+    (pd.appearance.beard, pd.appearance.hair) = ("Beard5", "Hair3")
+    pd.appearance.hair_color = [0.5, 0.25, 0.125]
+    food = FCH_ActiveFood()
+    (food.name, food.health, food.stamina) = ("CookedMeat", 30.0, 10.0)
+    pd.active_food.data = [food]
+    pd.skill_list.version = pd.skill_list.CURRENT_VERSION
+    for (name, level) in (("Sword", 12.5), ("Running", 30.0)):
+        skill = FCH_Skill()
+        (skill.skill, skill.level, skill.exp) = (name, level, 0.75)
+        pd.skill_list.skills.append(skill)
+    return fh
+
+def _write_file(d, name, fh):
+    path = os.path.join(d, name)
+    with open(path, 'wb') as f:
+        f.write(fh.toBytes())
+    return path
+
+def _load_file(path):
+    fh = FCH_Root()
+    with open(path, 'rb') as f:
+        fh.fromBytes(f.read())
+    return fh
+
+
+class TestConstructVerify(unittest.TestCase):
+    def test_construct_in_memory(self):
+        orig = _fixture()
+        with tempfile.TemporaryDirectory() as d:
+            orig.destruct(d)
+            fh = FCH_Root()
+            fh.construct(d)
+        data = fh.toBytes()
+        self.assertEqual(data, orig.toBytes())
+        # What construct does before writing anything
+        check = FCH_Root()
+        check.fromBytes(data, verify_checksum=False)
+        self.assertEqual(fh.compare(check), [])
+
+    def test_compare(self):
+        fh = _fixture()
+        other = _fixture()
+        other.player_data.inventory.items[1].count = 7
+        pixels = other.worlds.worlds[0].vis_data.pixel_data
+        pixels.set(0, 0, 1 - pixels.get(0, 0))
+        diffs = fh.compare(other)
+        self.assertIn("PlayerData.Inventory[1].Count: 2 != 7", diffs)
+        self.assertIn("World0.VisibilityData: pixels differ", diffs)
+        # Floats only need to match at 32-bit precision
+        other = _fixture()
+        other.player_data.health += 1e-9
+        self.assertEqual(fh.compare(other), [])
+
+    def test_open_reader(self):
+        with BinWriter() as wr:
+            wr.write_i32(7)
+            wr.write_str("Viking")
+            with wr.open_reader() as br:
+                self.assertEqual(br.read_i32(), 7)
+                self.assertEqual(br.read_str(), "Viking")
+
+
+class TestStrings(unittest.TestCase):
+    LENGTHS = [0, 1, 127, 128, 300, 16383, 16384, 2097152, 2 ** 31 - 1]
+
+    def test_7bit_ints(self):
+        for n in self.LENGTHS:
+            b = encode_7bit_encoded_int(n)
+            self.assertEqual(decode_7bit_encoded_int(b, 0),
+                             (n, len(b)))
+        self.assertEqual(encode_7bit_encoded_int(300), b'\xac\x02')
+        self.assertRaises(ValueError, encode_7bit_encoded_int, -1)
+        self.assertRaises(IndexError, decode_7bit_encoded_int,
+                          b'\xac', 0)
+
+    def test_lists(self):
+        # Long strings need more than one chunk
+        strings = ["", "Wood", "x" * 5000, "Recipe_Club", "y" * 200] * 3
+        with BinWriter() as wr:
+            wr.write_str_list(strings)
+            wr.write_str("end")
+            data = wr.getvalue()
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "strings")
+            with open(path, 'wb') as f:
+                f.write(data)
+            for source in (data, path):
+                with BinReader(source) as br:
+                    self.assertEqual(br.read_str(count=len(strings)),
+                                     strings)
+                    self.assertEqual(br.read_str(), "end")
+                with BinReader(source) as br:
+                    self.assertEqual(br.read_binstr(count=2, pos=0),
+                                     [b"", b"Wood"])
+                    self.assertEqual(br.tell(), 0)
+
+    def test_decode_partial(self):
+        data = encode_binstrs([b"ab", b"cde", b"f"])
+        # Stops at the first string that doesn't fit
+        self.assertEqual(decode_binstrs(data[:-1], 0, 3),
+                         ([b"ab", b"cde"], 7))
+        with BinReader(data[:-1]) as br:
+            self.assertRaises(SystemExit, br.read_binstr, 3)
+
+
+class TestListWriters(unittest.TestCase):
+    def _per_member(self, l):
+        with BinWriter() as wr:
+            for v in l:
+                wr.write(v)
+            return wr.getvalue()
+
+    def _packed(self, l, type_=None):
+        with BinWriter() as wr:
+            wr.write_list(l, type_=type_)
+            return wr.getvalue()
+
+    def test_packed(self):
+        for l in ([1, -2, 2 ** 31 - 1], [0.5, -1.25, 3.0], [True, False],
+                  ["Wood", "", "Stone"], [1, 2.5, "mixed"], []):
+            self.assertEqual(self._packed(l), self._per_member(l), l)
+        # An explicit type packs even an empty list
+        self.assertEqual(self._packed([], type_=int), b'')
+        with BinWriter() as wr:
+            wr.write_i32(0)
+            wr.write_list([7, 8], pos=0)
+            self.assertEqual(wr.getvalue(), struct.pack("<ii", 7, 8))
+
+    def test_counted_lists(self):
+        for (type_, values) in ((int, [3, -4]), (float, [0.25, 8.0]),
+                                (bool, [1, 0, 1]), (str, ["a", "bc"])):
+            cl = CountedList(type_)
+            cl.data = values
+            data = _to_binary(cl)
+            self.assertEqual(data[:4], struct.pack("<i", len(values)))
+            back = CountedList(type_)
+            with BinReader(data) as br:
+                back.fromBinary(br)
+            self.assertEqual(list(back.data), values)
+            self.assertEqual(_to_binary(back), data)
+        # Bools are stored as single bytes
+        cl = CountedList(bool)
+        cl.data = [True, False]
+        self.assertEqual(_to_binary(cl), b'\x02\x00\x00\x00\x01\x00')
+
+
+class TestStrPool(unittest.TestCase):
+    def test_shared_load(self):
+        pool = StrPool()
+        data = _fixture().toBytes()
+        with tempfile.TemporaryDirectory() as d:
+            paths = [os.path.join(d, "{}.fch".format(i)) for i in range(3)]
+            for path in paths:
+                with open(path, 'wb') as f:
+                    f.write(data)
+            loaded = [FCHBatch.load(p, str_pool=pool) for p in paths]
+        # Interning doesn't change what's written back
+        for fh in loaded:
+            self.assertEqual(fh.toBytes(), data)
+        (a, b) = (loaded[0].player_data, loaded[2].player_data)
+        self.assertIs(a.inventory.items[0].name, b.inventory.items[0].name)
+        self.assertIs(a.known_recipes[1], b.known_recipes[1])
+        self.assertIs(a.name, b.name)
+        report = pool.report()
+        self.assertEqual(report['UniqueStrings'], len(pool))
+        self.assertGreaterEqual(report['Lookups'], 3 * len(pool))
+        self.assertGreater(report['SavedBytes'], report['UniqueBytes'])
+        self.assertIn("TrophyBoar", pool)
+
+    def test_symbols(self):
+        pool = StrPool()
+        ids = pool.symbol_list(["Wood", "Stone", "Wood"])
+        self.assertEqual(ids, [0, 1, 0])
+        self.assertEqual(pool.lookup(1), "Stone")
+        s = "".join(["Wo", "od"])
+        self.assertIs(pool.intern(s), pool.lookup(0))
+
+
+class TestSQLiteExport(unittest.TestCase):
+    def test_skip_pixels(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = _write_file(d, 'a.fch', _fixture())
+            fh = FCHBatch.load(path, skip_pixels=True)
+        vis = fh.worlds.worlds[0].vis_data
+        self.assertFalse(vis.hasPixels())
+        self.assertEqual(vis.edge_length, 40)
+        self.assertEqual([m.text for m in vis.marker_list.markers],
+                         ["Home", "", "Elder"])
+        self.assertTrue(vis.public_position)
+        self.assertEqual(fh.player_data.name, "Viking")
+        self.assertRaises(RuntimeError, fh.toBytes)
+
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as d:
+            paths = [_write_file(d, 'a.fch', _fixture()),
+                     _write_file(d, 'b.fch', _fixture(24))]
+            db = os.path.join(d, 'out.db')
+            with FCHSQLite(db) as out:
+                self.assertEqual(out.export(paths, workers=1), (2, 0, 0))
+                self.assertEqual(out.export(paths, workers=1), (0, 2, 0))
+                conn = out.conn
+                self.assertEqual(conn.execute(
+                    "SELECT COUNT(*) FROM items").fetchone()[0], 6)
+                self.assertEqual(sorted(conn.execute(
+                    "SELECT uid, edge_length FROM worlds")), [
+                        (42, None), (42, None),
+                        (1234567890123, 24), (1234567890123, 40)])
+                self.assertEqual(conn.execute(
+                    "SELECT COUNT(*) FROM markers WHERE symbol = 'Boss'"
+                    ).fetchone()[0], 2)
+
+
+class TestCSVExport(unittest.TestCase):
+    def _read(self, path, dialect):
+        with open(path, newline='') as f:
+            return list(csv.reader(f, dialect=dialect))
+
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as d:
+            paths = [_write_file(d, 'a.fch', _fixture()),
+                     _write_file(d, 'b.fch', _fixture(24))]
+            outdir = os.path.join(d, 'out')
+            with FCHCSV(outdir) as out:
+                self.assertEqual(out.export(paths, workers=1), (2, 0))
+            rows = self._read(os.path.join(outdir, 'inventory.csv'), 'excel')
+            self.assertEqual(tuple(rows[0]), INVENTORY_COLUMNS)
+            self.assertEqual(len(rows), 7)
+            self.assertEqual(rows[2][:6],
+                             [paths[0], '987654321', 'Viking', 'Wood', '2',
+                              '100.0'])
+            rows = self._read(os.path.join(outdir, 'skills.csv'), 'excel')
+            self.assertEqual(tuple(rows[0]), SKILL_COLUMNS)
+            self.assertEqual([r[4] for r in rows[1:]],
+                             ['Sword', 'Running'] * 2)
+
+            # Existing tables are only replaced when asked to
+            self.assertRaises(FileExistsError, FCHCSV, outdir)
+            with FCHCSV(outdir, overwrite=True) as out:
+                out.export(paths[:1], workers=1)
+            rows = self._read(os.path.join(outdir, 'inventory.csv'), 'excel')
+            self.assertEqual(len(rows), 4)
+
+    def test_tsv(self):
+        with tempfile.TemporaryDirectory() as d:
+            paths = [_write_file(d, 'a.fch', _fixture())]
+            with FCHCSV(d, tsv=True) as out:
+                self.assertEqual(out.export(paths + [paths[0] + 'x'],
+                                            workers=1), (1, 1))
+            rows = self._read(os.path.join(d, 'skills.tsv'), 'excel-tab')
+            self.assertEqual(rows[1][3:6], ['1', 'Sword', '12.5'])
+
+
+class TestDestructStream(unittest.TestCase):
+    def _files(self, d):
+        ret = {}
+        for name in sorted(os.listdir(d)):
+            with open(os.path.join(d, name), 'rb') as f:
+                ret[name] = f.read()
+        return ret
+
+    def test_same_output(self):
+        orig = _fixture()
+        data = orig.toBytes()
+        with tempfile.TemporaryDirectory() as a, \
+                tempfile.TemporaryDirectory() as b:
+            orig.destruct(a)
+            fh = FCH_Root()
+            with BinReader(data) as br:
+                fh.destructStream(br, b)
+            self.assertEqual(self._files(b), self._files(a))
+            self.assertIn('world0.pbm', self._files(b))
+            # Only the pixels are gone
+            vis = fh.worlds.worlds[0].vis_data
+            self.assertFalse(vis.hasPixels())
+            self.assertEqual(len(vis.marker_list.markers), 3)
+            self.assertEqual(fh.player_data.name, "Viking")
+            self.assertRaises(RuntimeError, fh.toBytes)
+            self.assertRaises(RuntimeError, vis.writePBM,
+                              os.path.join(b, 'x.pbm'))
+            # Nothing is overwritten unless asked to
+            self.assertRaises(FileExistsError, FCH_Root().destructStream,
+                              BinReader(data), b)
+            FCH_Root().destructStream(BinReader(data), b, overwrite=True)
+
+
+class TestConstructStream(unittest.TestCase):
+    def test_same_output(self):
+        orig = _fixture(edge=37)
+        with tempfile.TemporaryDirectory() as d:
+            orig.destruct(d)
+            fh = FCH_Root()
+            fh.construct(d, stream=True)
+            vis = fh.worlds.worlds[0].vis_data
+            self.assertFalse(vis.hasPixels())
+            self.assertEqual(fh.worlds.binSize(),
+                             len(_to_binary(orig.worlds)))
+            # Written both to a file and to memory
+            path = os.path.join(d, 'out.fch')
+            with BinWriter(path) as wr:
+                fh.toBinary(wr)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), orig.toBytes())
+            self.assertEqual(fh.toBytes(), orig.toBytes())
+
+    def test_row_reader(self):
+        rnd = random.Random(5)
+        m = WBitMatrix.WBitMatrix(21, 9)
+        _scribble(rnd, [m], ops=10)
+        img = PBMImage.PBMImage()
+        img.set_matrix(m)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'a.pbm')
+            img.write(path)
+            with PBMImage.PBMRowReader(path) as rows:
+                self.assertEqual((rows.get_width(), rows.get_height()),
+                                 (21, 9))
+                for y in (8, 0, 4):
+                    self.assertEqual(rows.read_row(y), bytes(
+                        [img.get_pixel(x, y) for x in range(21)]))
+
+
+class TestMapQuery(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fh = _fixture(edge=33)
+        cls.data = cls.fh.toBytes()
+        cls.pixels = cls.fh.worlds.worlds[0].vis_data.pixel_data
+
+    def test_sections(self):
+        index = FCHSectionIndex()
+        with BinReader(self.data) as br:
+            index.fromBinary(br)
+        sections = index.sections()
+        self.assertEqual(sections[0].offset, 4)
+        for (a, b) in zip(sections, sections[1:]):
+            self.assertEqual(a.end(), b.offset)
+        self.assertEqual(sections[-1].end(), index.data.end())
+        self.assertEqual(index.checksum.size, 64)
+        self.assertEqual([w.uid for w in index.worlds],
+                         [1234567890123, 42])
+        w = index.worlds[0]
+        self.assertEqual(w.visibility.size, len(_to_binary(
+            self.fh.worlds.worlds[0].vis_data)))
+        self.assertEqual(w.pixels.size, 33 * 33)
+        self.assertIsNone(index.worlds[1].pixels)
+        self.assertEqual(self.data[w.pixel_offset(5, 7)],
+                         self.pixels.get(5, 7))
+
+    def test_query(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'a.fch')
+            with open(path, 'wb') as f:
+                f.write(self.data)
+            with FCHMapQuery(path) as q:
+                self.assertEqual(q.world_count(), 2)
+                self.assertEqual(q.find_world(42), 1)
+                self.assertIsNone(q.find_world(7))
+                self.assertEqual(q.get_edge_length(0), 33)
+                m = self.pixels
+                for (x, y) in ((0, 0), (32, 0), (10, 20), (32, 32)):
+                    self.assertEqual(q.get_pixel(0, x, y), m.get(x, y))
+                    self.assertEqual(q.get_pixel(0, x, y, flipped=True),
+                                     m.get(x, 32 - y))
+                rows = q.crop(0, 3, 4, 10, 6)
+                self.assertEqual(rows, [bytes([m.get(x, y)
+                                               for x in range(3, 13)])
+                                        for y in range(4, 10)])
+                rows = q.crop(0, 3, 4, 10, 6, flipped=True)
+                self.assertEqual(rows[0],
+                                 bytes([m.get(x, 28) for x in range(3, 13)]))
+                self.assertEqual(q.count_explored(0, 0, 0, 33, 33),
+                                 sum([m.get(x, y) for x in range(33)
+                                      for y in range(33)]))
+                self.assertRaises(ValueError, q.get_pixel, 0, 33, 0)
+                self.assertRaises(ValueError, q.crop, 0, 30, 30, 4, 1)
+                self.assertRaises(ValueError, q.get_pixel, 1, 0, 0)
+                self.assertRaises(ValueError, q.get_pixel, 2, 0, 0)
+
+
+class TestMapTiles(unittest.TestCase):
+    def _naive(self, m, size, zoom_out, fn):
+        # Tile pixels for the whole padded map, zoom_out levels down
+        edge = m.get_width()
+        def get(x, y):
+            if (x >= edge) or (y >= edge):
+                return 0
+            return m.get(x, y, flipped=True)
+        n = 1 << zoom_out
+        return [bytes([fn([get(x * n + i, y * n + j)
+                           for j in range(n) for i in range(n)])
+                       for x in range(size // n)])
+                for y in range(size // n)]
+
+    def test_reduce(self):
+        m = WBitMatrix.WBitMatrix(40, 40)
+        _scribble(random.Random(6), [m], ops=20)
+        rows = self._naive(m, 64, 0, sum)
+        self.assertEqual(MapTiles._or_reduce(MapTiles._or_reduce(rows, 64),
+                                             32),
+                         self._naive(m, 64, 2, lambda v: int(any(v))))
+        rows = [r.translate(bytes([0, 255] + [0] * 254)) for r in rows]
+        self.assertEqual(MapTiles._coverage_reduce(rows, 64),
+                         self._naive(m, 64, 1,
+                                     lambda v: (sum(v) * 255 + 2) // 4))
+
+    def test_incremental(self):
+        vis = _fixture().worlds.worlds[0].vis_data
+        exporter = MapTileExporter(tile_size=16, mode='or', fmt='pbm')
+        with tempfile.TemporaryDirectory() as d:
+            # 4x4 tiles at full resolution, for 1 + 4 + 16 in all
+            self.assertEqual(exporter.export(vis, d), (21, 0))
+            with open(os.path.join(d, '0', '0', '0.pbm'), 'rb') as f:
+                tile = f.read()
+            rows = self._naive(vis.pixel_data, 64, 2,
+                               lambda v: int(any(v)))
+            self.assertEqual(tile,
+                             PBMImage.rows_to_pbm(16, rows).encode('ascii'))
+            self.assertEqual(exporter.export(vis, d), (0, 21))
+
+            # Only the tiles over the changed block, one per zoom level
+            path = os.path.join(d, '2', '2', '1.pbm')
+            with open(path, 'rb') as f:
+                tile = f.read()
+            (x, y) = (35, 39 - 20)
+            m = vis.pixel_data
+            m.set(x, y, 1 - m.get(x, y))
+            self.assertEqual(exporter.export(vis, d), (3, 18))
+            with open(path, 'rb') as f:
+                self.assertNotEqual(f.read(), tile)
+
+            # Missing tiles are written again
+            os.remove(os.path.join(d, '1', '0', '1.pbm'))
+            self.assertEqual(exporter.export(vis, d), (1, 20))
+
+            # As is everything, when the settings change
+            exporter = MapTileExporter(tile_size=16, mode='coverage',
+                                       fmt='pbm')
+            self.assertEqual(exporter.export(vis, d), (21, 0))
+
+
+class TestDirtyRows(unittest.TestCase):
+    def test_dirty_rows(self):
+        m = WBitMatrix.WBitMatrix(8, 10)
+        self.assertEqual(m.get_dirty_rows(), [])
+        for y in (1, 2, 3, 6, 9):
+            m.set(0, y, 1)
+        self.assertTrue(m.is_dirty(6))
+        self.assertTrue(m.is_dirty(0, flipped=True))
+        self.assertFalse(m.is_dirty(5, flipped=True))
+        self.assertEqual(m.get_dirty_rows(), [1, 2, 3, 6, 9])
+        self.assertEqual(m.get_dirty_rows(flipped=True), [0, 3, 6, 7, 8])
+        self.assertEqual(m.get_dirty_intervals(), [(1, 4), (6, 7), (9, 10)])
+        self.assertEqual(m.get_dirty_intervals(flipped=True),
+                         [(0, 1), (3, 4), (6, 9)])
+        m.clear_dirty()
+        self.assertEqual(m.get_dirty_intervals(), [])
+
+    def test_clean_rows_copied(self):
+        # Non-zero bytes other than 1 only survive in untouched rows
+        (w, h) = (12, 6)
+        data = bytes([(x * y) % 3 for y in range(h) for x in range(w)])
+        for cls in (WBitMatrix.WBitMatrix, WBitMatrix.WRunBitMatrix):
+            m = cls(w, h)
+            with BinReader(data) as br:
+                m.fromBinary(br)
+            self.assertEqual(m.get_dirty_rows(), [])
+            self.assertEqual(_to_binary(m), data)
+            m.set(1, 4, 1)
+            expect = bytearray(data)
+            expect[4*w:5*w] = bytes([min(v, 1) for v in data[4*w:5*w]])
+            self.assertEqual(_to_binary(m), bytes(expect))
+            m.drop_original()
+            self.assertEqual(_to_binary(m), bytes([min(v, 1)
+                                                   for v in expect]))
+
+
+class TestBitMatrixBackends(unittest.TestCase):
+    def assertSameBits(self, a, b):
+        self.assertEqual(a, b)
+        for y in range(a.get_height()):
+            self.assertEqual(a.get_row_bytes(y), b.get_row_bytes(y))
+            self.assertEqual(a.get_row_bytes(y, flipped=True),
+                             b.get_row_bytes(y, flipped=True))
+        self.assertEqual(a.popcount(), b.popcount())
+        self.assertEqual(_to_binary(a), _to_binary(b))
+
+    def test_edits(self):
+        rnd = random.Random(1)
+        for (w, h) in ((1, 1), (8, 3), (37, 23), (64, 64)):
+            (packed, runs) = _both(w, h)
+            _scribble(rnd, [packed, runs])
+            self.assertSameBits(packed, runs)
+            for i in range(50):
+                (x, y) = (rnd.randrange(w), rnd.randrange(h))
+                self.assertEqual(packed.get(x, y), runs.get(x, y))
+                self.assertEqual(packed.get(x, y, flipped=True),
+                                 runs.get(x, y, flipped=True))
+            self.assertEqual(packed.get_dirty_rows(), runs.get_dirty_rows())
+
+    def test_fill_span_edges(self):
+        (packed, runs) = _both(20, 1)
+        for (x0, x1, value) in ((0, 20, 1), (3, 9, 0), (8, 16, 0),
+                                (5, 6, 1), (9, 10, 1), (-5, 2, 0),
+                                (19, 40, 0), (7, 7, 1)):
+            for m in (packed, runs):
+                m.fill_span(0, x0, x1, value)
+            self.assertSameBits(packed, runs)
+        self.assertEqual(runs.rows[0], [2, 3, 5, 6, 9, 10, 16, 19])
+
+    def test_merge_or(self):
+        rnd = random.Random(2)
+        (w, h) = (45, 17)
+        sources = _both(w, h)
+        _scribble(rnd, list(sources))
+        results = []
+        for cls in (WBitMatrix.WBitMatrix, WBitMatrix.WRunBitMatrix):
+            for src in sources:
+                m = cls(w, h)
+                m.fill_circle(10, 8, 6)
+                m.merge_or(src)
+                results.append(m)
+        for m in results[1:]:
+            self.assertSameBits(results[0], m)
+        self.assertRaises(ValueError, results[0].merge_or,
+                          WBitMatrix.WBitMatrix(w, h + 1))
+
+
+class TestBitMatrixBinary(unittest.TestCase):
+    def test_round_trip(self):
+        rnd = random.Random(3)
+        (w, h) = (33, 29)
+        (packed, runs) = _both(w, h)
+        _scribble(rnd, [packed, runs])
+        data = _to_binary(packed)
+        self.assertEqual(len(data), w * h)
+        for cls in (WBitMatrix.WBitMatrix, WBitMatrix.WRunBitMatrix):
+            m = cls(w, h)
+            with BinReader(data) as br:
+                m.fromBinary(br)
+            self.assertEqual(m, packed)
+            self.assertEqual(_to_binary(m), data)
+        with BinReader(data) as br:
+            m = WBitMatrix.load_matrix(br, w, h)
+        self.assertEqual(_to_binary(m), data)
+
+    def test_backend_choice(self):
+        sparse = bytes(100 * 100)
+        with BinReader(sparse) as br:
+            m = WBitMatrix.load_matrix(br, 100, 100)
+        self.assertIs(type(m), WBitMatrix.WRunBitMatrix)
+        noisy = bytes([i % 2 for i in range(100 * 100)])
+        with BinReader(noisy) as br:
+            m = WBitMatrix.load_matrix(br, 100, 100)
+        self.assertIs(type(m), WBitMatrix.WBitMatrix)
+
+    def test_original_bytes(self):
+        # Bytes other than 0 and 1 survive in the rows left untouched
+        (w, h) = (12, 4)
+        data = bytearray(w * h)
+        data[3] = 0x02
+        data[w + 5] = 0xff
+        data[2 * w + 7] = 1
+        data = bytes(data)
+        for cls in (WBitMatrix.WBitMatrix, WBitMatrix.WRunBitMatrix):
+            m = cls(w, h)
+            with BinReader(data) as br:
+                m.fromBinary(br)
+            self.assertEqual(m.popcount(), 3)
+            self.assertEqual(_to_binary(m), data)
+            m.set(0, 1, 1)
+            out = _to_binary(m)
+            self.assertEqual(out[:w], data[:w])
+            self.assertEqual(out[w:2 * w], b'\x01' + bytes(4) + b'\x01' +
+                             bytes(6))
+            self.assertEqual(out[2 * w:], data[2 * w:])
+
+    def test_short_data(self):
+        for cls in (WBitMatrix.WBitMatrix, WBitMatrix.WRunBitMatrix):
+            m = cls(10, 10)
+            with BinReader(bytes(99)) as br:
+                self.assertRaises(ValueError, m.fromBinary, br)
+
+
+class TestMarkerIndex(unittest.TestCase):
+    def _markers(self, rnd, count):
+        return [_marker("m{}".format(i % 7),
+                        [rnd.uniform(-500, 500), 0.0, rnd.uniform(-500, 500)],
+                        "Dot") for i in range(count)]
+
+    def test_queries(self):
+        rnd = random.Random(11)
+        markers = self._markers(rnd, 300)
+        index = MarkerIndex(markers, cell_size=40.0)
+        self.assertEqual(len(index), 300)
+        def d(m, p):
+            return ((m.point[0] - p[0]) ** 2 +
+                    (m.point[2] - p[2]) ** 2) ** 0.5
+        for _ in range(20):
+            a = [rnd.uniform(-600, 600), 0.0, rnd.uniform(-600, 600)]
+            b = [rnd.uniform(-600, 600), 0.0, rnd.uniform(-600, 600)]
+            self.assertEqual(index.in_rect(a, b), [m for m in markers
+                if (min(a[0], b[0]) <= m.point[0] <= max(a[0], b[0])) and
+                   (min(a[2], b[2]) <= m.point[2] <= max(a[2], b[2]))])
+            r = rnd.uniform(0, 200)
+            self.assertEqual(index.in_radius(a, r),
+                             [m for m in markers if d(m, a) <= r])
+            (m, dist) = index.nearest(a)
+            self.assertEqual(dist, min([d(v, a) for v in markers]))
+            (n, dist) = index.nearest(m.point, exclude=m)
+            self.assertIsNot(n, m)
+            self.assertEqual(dist, min([d(v, m.point) for v in markers
+                                        if v is not m]))
+        self.assertIsNone(index.nearest([5000.0, 0.0, 0.0], max_dist=10))
+        self.assertIsNone(MarkerIndex().nearest([0.0, 0.0, 0.0]))
+
+    def test_dedupe(self):
+        ml = FCH_WorldMarkerList()
+        ml.markers = [
+            _marker("Home", [0.0, 0.0, 0.0], "House"),
+            _marker("Home", [3.0, 0.0, 4.0], "House"),   # dupe of 0
+            _marker("Home", [3.0, 0.0, 4.0], "Dot"),     # other symbol
+            _marker("Home", [100.0, 0.0, 0.0], "House"), # too far
+            _marker("Home", [-4.0, 0.0, 3.0], "House"),  # dupe of 0
+        ]
+        groups = ml.spatialIndex().duplicates(5.0,
+                key=lambda m: (m.text, m.symbol))
+        self.assertEqual(groups, [[ml.markers[0], ml.markers[1],
+                                   ml.markers[4]]])
+        self.assertEqual(ml.dedupe(5.0), 2)
+        self.assertEqual([(m.point[0], m.symbol) for m in ml.markers],
+                         [(0.0, "House"), (3.0, "Dot"), (100.0, "House")])
+
+    def test_explored(self):
+        vis = _fixture().worlds.worlds[0].vis_data
+        vis.marker_list.markers = self._markers(random.Random(12), 200)
+        index = vis.marker_list.spatialIndex()
+        m = vis.pixel_data
+        expect = []
+        for v in index.items:
+            (x, y) = vis.worldToPixel(v.point)
+            (x, y) = (int(round(x)), int(round(y)))
+            expect.append((0 <= x < 40) and (0 <= y < 40) and
+                          (m.get(x, y) != 0))
+        self.assertIn(True, expect)
+        self.assertEqual(index.explored(m), expect)
+        self.assertEqual(vis.foggedMarkers(), [index.items[i]
+                         for i in range(len(expect)) if not expect[i]])
+
+
+class TestMapMerge(unittest.TestCase):
+    def _member(self, d, name, edge, rect, markers):
+        fh = _fixture()
+        vis = fh.worlds.worlds[0].vis_data
+        vis.edge_length = edge
+        vis.pixel_data = WBitMatrix.WBitMatrix(edge, edge)
+        vis.pixel_data.fill_rect(*rect)
+        vis.marker_list.markers = markers
+        return _write_file(d, name, fh)
+
+    def test_party(self):
+        with tempfile.TemporaryDirectory() as d:
+            paths = [
+                self._member(d, "a.fch", 32, (0, 0, 8, 8),
+                             [_marker("Camp", [0.0, 0.0, 0.0], "Campfire"),
+                              _marker("", [1.0, 0.0, 1.0], "Bed")]),
+                self._member(d, "b.fch", 32, (20, 20, 4, 4),
+                             [_marker("Camp", [0.5, 0.0, 0.0], "Campfire"),
+                              _marker("Elder", [90.0, 0.0, 9.0], "Boss")]),
+                self._member(d, "c.fch", 32, (0, 30, 32, 2), []),
+            ]
+            ret = FCHMerge.FCHMapMerge().merge(paths, workers=1)
+            self.assertEqual(ret, (3, 0, 0))
+            for path in paths:
+                fh = _load_file(path)
+                vis = fh.worlds.worlds[0].vis_data
+                self.assertEqual(vis.pixel_data.popcount(),
+                                 64 + 16 + 64)
+                texts = sorted([(m.text, m.symbol)
+                                for m in vis.marker_list.markers])
+                # One campfire, the boss pin, and the bed only for a
+                self.assertIn(("Elder", "Boss"), texts)
+                self.assertEqual(texts.count(("Camp", "Campfire")), 1)
+                self.assertEqual(("", "Bed") in texts, path == paths[0])
+                self.assertIsNone(validate_file(path))
+            # Nothing left to do
+            self.assertEqual(FCHMerge.FCHMapMerge().merge(paths, workers=1),
+                             (0, 3, 0))
+
+    def test_size_mismatch(self):
+        with tempfile.TemporaryDirectory() as d:
+            paths = [self._member(d, "a.fch", 16, (0, 0, 4, 4), []),
+                     self._member(d, "b.fch", 32, (0, 0, 8, 8), []),
+                     self._member(d, "c.fch", 16, (8, 8, 4, 4), [])]
+            before = [open(p, 'rb').read() for p in paths]
+            ret = FCHMerge.FCHMapMerge().merge(paths, workers=1)
+            self.assertEqual(ret, (0, 3, 0))
+            self.assertEqual([open(p, 'rb').read() for p in paths], before)
+
+
+class _Pipe(io.RawIOBase):
+    # A non-seekable stream handing out at most 1000 bytes per read
+    def __init__(self, data=b''):
+        self.data = io.BytesIO(data)
+        self.written = bytearray()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def read(self, count=-1):
+        if (count is None) or (count < 0) or (count > 1000):
+            count = 1000
+        return self.data.read(count)
+
+    def write(self, b):
+        self.written += b
+        return len(b)
+
+
+class TestForwardStream(unittest.TestCase):
+    def test_seek_and_hash(self):
+        data = bytes(range(256)) * 1024
+        fs = ForwardStream(_Pipe(data), chunk_size=100)
+        self.assertFalse(fs.seekable())
+        self.assertEqual(fs.read(10), data[:10])
+        fs.start_hash(hashlib.sha512())
+        fs.seek(200000)
+        self.assertEqual(fs.read(5), data[200000:200005])
+        # Back a little, and read ahead again
+        fs.seek(-1000, 1)
+        self.assertEqual(fs.read(1000), data[199005:200005])
+        self.assertEqual(fs.end_hash().digest(),
+                         hashlib.sha512(data[10:200005]).digest())
+        self.assertRaises(io.UnsupportedOperation, fs.seek, 10)
+        self.assertRaises(io.UnsupportedOperation, fs.seek, 0, 2)
+        self.assertEqual(fs.read(), data[200005:])
+        self.assertEqual(fs.read(1), b'')
+
+    def test_load(self):
+        fh = _fixture()
+        data = fh.toBytes()
+        loaded = FCH_Root()
+        with BinReader(_Pipe(data)) as br:
+            self.assertFalse(br.seekable())
+            loaded.fromBinary(br)
+        self.assertEqual(fh.compare(loaded), [])
+
+        bad = bytearray(data)
+        bad[-1] ^= 1
+        with BinReader(_Pipe(bytes(bad))) as br:
+            self.assertRaises(SystemExit, FCH_Root().fromBinary, br)
+        with BinReader(_Pipe(bytes(bad))) as br:
+            FCH_Root().fromBinary(br, verify_checksum=False)
+
+    def test_write(self):
+        fh = _fixture()
+        out = _Pipe()
+        with BinWriter(out) as wr:
+            fh.toBinary(wr)
+        self.assertEqual(bytes(out.written), fh.toBytes())
+
+
+class TestCompression(unittest.TestCase):
+    MAGIC = {
+        'gzip': b'\x1f\x8b',
+        'bz2': b'BZh',
+        'xz': b'\xfd7zXZ\x00',
+        'lzma': b'\x5d\x00\x00',
+    }
+
+    def _load(self, path):
+        # Decompressed on the fly, so forward only
+        fh = FCH_Root()
+        with BinReader(path) as br:
+            self.assertFalse(br.seekable())
+            fh.fromBinary(br)
+        return fh.toBytes()
+
+    def test_round_trip(self):
+        fh = _fixture()
+        data = fh.toBytes()
+        with tempfile.TemporaryDirectory() as d:
+            for (ext, fmt) in (('.gz', 'gzip'), ('.bz2', 'bz2'),
+                               ('.xz', 'xz'), ('.lzma', 'lzma')):
+                # By extension, and by an explicit format
+                path = os.path.join(d, 'a.fch' + ext)
+                with BinWriter(path) as wr:
+                    fh.toBinary(wr)
+                other = os.path.join(d, fmt + '.fch')
+                with BinWriter(other, compress=fmt, level=1) as wr:
+                    fh.toBinary(wr)
+                for p in (path, other):
+                    with open(p, 'rb') as f:
+                        head = f.read(Compression.MAGIC_SIZE)
+                    self.assertTrue(head.startswith(self.MAGIC[fmt]))
+                    if fmt == 'lzma':
+                        # Without the extension, it can't be told apart
+                        continue
+                    self.assertEqual(self._load(p), data)
+                self.assertEqual(self._load(path), data)
+
+                # No timestamps or such: the same data, the same bytes
+                replace_file(other, data, compress=fmt)
+                with open(other, 'rb') as f:
+                    first = f.read()
+                replace_file(other, data, compress=fmt)
+                with open(other, 'rb') as f:
+                    self.assertEqual(f.read(), first)
+
+            # Random access needs the plain file
+            self.assertRaises(SystemExit, FCHMapQuery,
+                              os.path.join(d, 'a.fch.gz'))
+
+    def test_detect(self):
+        self.assertEqual(Compression.format_for_path('x/a.FCH.GZ'), 'gzip')
+        self.assertIsNone(Compression.format_for_path('a.fch'))
+        self.assertEqual(Compression.detect(b'BZh91AY'), 'bz2')
+        self.assertIsNone(Compression.detect(b'\x00\x01\x02\x03'))
+        # An FCH file whose byte count happens to start like gzip
+        head = b'\x1f\x8b\x08\x00'
+        size = 4 + 0x00088b1f + 4 + 64
+        self.assertEqual(Compression.detect(head), 'gzip')
+        self.assertIsNone(Compression.detect(head, size))
+        self.assertEqual(Compression.detect(head, size + 1), 'gzip')
+
+
+class TestSnapshotStore(unittest.TestCase):
+    def test_snapshots(self):
+        fh = _fixture(edge=64)
+        with tempfile.TemporaryDirectory() as d:
+            store = FCHSnapshotStore(os.path.join(d, 'store'),
+                                     rows_per_chunk=16)
+            path = _write_file(d, 'a.fch', fh)
+            (first, count, size) = store.snapshot(path)
+            self.assertEqual(size, os.path.getsize(path))
+            # One pixel changes one block of rows, and the checksum (with
+            # its size)
+            m = fh.worlds.worlds[0].vis_data.pixel_data
+            m.set(3, 40, 1 - m.get(3, 40))
+            _write_file(d, 'a.fch', fh)
+            (second, count, size) = store.snapshot(path)
+            self.assertEqual((count, size), (2, (16 * 64) + 4 + 64))
+            # Same file name, same second, but different data
+            self.assertNotEqual(first, second)
+            self.assertEqual(store.snapshots(), sorted([first, second]))
+            self.assertRaises(SystemExit, store.snapshot, path, name=second)
+
+            out = os.path.join(d, 'out.fch')
+            store.restore(first, out)
+            self.assertEqual(_load_file(out).compare(_fixture(edge=64)), [])
+            self.assertRaises(SystemExit, store.restore, second, out)
+            store.restore(second, out, overwrite=True)
+            with open(out, 'rb') as f:
+                self.assertEqual(f.read(), fh.toBytes())
+            store.restore(second, out + '.gz')
+            with BinReader(out + '.gz') as br:
+                self.assertEqual(br.read(-1), fh.toBytes())
+
+    def test_damaged(self):
+        with tempfile.TemporaryDirectory() as d:
+            store = FCHSnapshotStore(os.path.join(d, 'store'))
+            path = _write_file(d, 'a.fch', _fixture())
+            (name, count, size) = store.snapshot(path, name='a')
+            out = os.path.join(d, 'out.fch')
+            with open(out, 'wb') as f:
+                f.write(b'old')
+            # Damage the last chunk, the output isn't touched
+            (digest, size) = store.manifest(name)['Chunks'][-1]
+            with open(store._chunk_path(digest), 'r+b') as f:
+                f.write(b'\xff')
+            self.assertRaises(SystemExit, store.restore, name, out,
+                              overwrite=True)
+            with open(out, 'rb') as f:
+                self.assertEqual(f.read(), b'old')
+
+            # Files that don't parse are still stored
+            with open(path, 'wb') as f:
+                f.write(b'not an FCH file')
+            store.snapshot(path, name='b')
+            store.restore('b', out, overwrite=True)
+            with open(out, 'rb') as f:
+                self.assertEqual(f.read(), b'not an FCH file')
+
+
+@unittest.skipIf(sys.version_info < (3, 9), "The service needs python 3.9")
+class TestService(unittest.TestCase):
+    def setUp(self):
+        # Imported lazily, as in main.py
+        from FCHService import FCHService
+        self.tmp = tempfile.TemporaryDirectory()
+        self.d = self.tmp.name
+        self.fh = _fixture()
+        self.path = _write_file(self.d, 'a.fch', self.fh)
+        self.svc = FCHService(os.path.join(self.d, 'sock'), workers=1,
+                              cache_size=2)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _run(self, requests):
+        # Send all requests on one connection, answers are sorted by id
+        async def session():
+            svc = self.svc
+            await svc._start()
+            try:
+                (reader, writer) = await asyncio.open_unix_connection(
+                        svc.socket_path)
+                for (i, req) in enumerate(requests):
+                    if not isinstance(req, dict):
+                        writer.write(req + b'\n')
+                        continue
+                    writer.write(json.dumps(dict(req, id=i)).encode() +
+                                 b'\n')
+                writer.write_eof()
+                lines = []
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    lines.append(json.loads(line))
+                writer.close()
+                return lines
+            finally:
+                await svc._stop()
+        return sorted(asyncio.run(session()),
+                      key=lambda r: -1 if r['id'] is None else r['id'])
+
+    def test_requests(self):
+        m = self.fh.worlds.worlds[0].vis_data.pixel_data
+        resp = self._run([
+            {'op': 'info', 'path': self.path},
+            {'op': 'query', 'path': self.path, 'pixel': [3, 5]},
+            {'op': 'query', 'path': self.path,
+             'count_explored': [0, 0, 40, 40]},
+            {'op': 'query', 'path': self.path, 'crop': [2, 1, 4, 2]},
+            {'op': 'query', 'path': self.path, 'pixel': [3, 5],
+             'world_uid': 42},
+            {'op': 'query', 'path': self.path, 'crop': [38, 0, 4, 2]},
+            {'op': 'nope'},
+            b'not json',
+        ])
+        self.assertEqual([r['ok'] for r in resp],
+                         [False] + ([True] * 4) + ([False] * 3))
+        self.assertIn({'key': "Player Data/Player Name", 'value': "Viking"},
+                      resp[1]['result'])
+        self.assertEqual(resp[2]['result'], m.get(3, 5, flipped=True))
+        self.assertEqual(resp[3]['result'], sum([m.get(x, y)
+                         for x in range(40) for y in range(40)]))
+        self.assertEqual(resp[4]['result'], [
+            ''.join([str(m.get(x, y, flipped=True)) for x in range(2, 6)])
+            for y in (1, 2)])
+        self.assertEqual(resp[7]['error'], "Unknown op: nope")
+        # Every request was answered from one load
+        self.assertEqual(len(self.svc.cache), 1)
+
+    def test_patch(self):
+        out = os.path.join(self.d, 'b.fch')
+        resp = self._run([
+            {'op': 'patch', 'path': self.path, 'output': out,
+             'reveal': [['spawn', 200]], 'dedupe_markers': 1e6},
+        ])
+        self.assertTrue(resp[0]['ok'], resp)
+        self.assertEqual(resp[0]['result']['removed_markers'], 0)
+        fh = _load_file(out)
+        w = fh.worlds.worlds[0]
+        (x, y) = w.vis_data.worldToPixel(w.spawn_point)
+        self.assertEqual(w.vis_data.pixel_data.get(int(x), int(y)), 1)
+        # The source is left alone, and outputs aren't overwritten
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.fh.toBytes())
+        resp = self._run([
+            {'op': 'patch', 'path': self.path, 'output': out,
+             'hide': [['home', 10]]},
+        ])
+        self.assertFalse(resp[0]['ok'])
+        self.assertEqual(_load_file(out).compare(fh), [])
+
+
+class TestInMemory(unittest.TestCase):
+    def test_buffers(self):
+        fh = _fixture()
+        data = fh.toBytes()
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'a.fch')
+            with BinWriter(path) as wr:
+                fh.toBinary(wr)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), data)
+            with open(path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for buf in (data, bytearray(data), memoryview(data), mm):
+                    loaded = FCH_Root()
+                    loaded.fromBytes(buf)
+                    self.assertEqual(fh.compare(loaded), [])
+                    self.assertEqual(loaded.toBytes(), data)
+                    del loaded
+
+        bad = bytearray(data)
+        bad[100] ^= 1
+        self.assertRaises(SystemExit, FCH_Root().fromBytes, bad)
+        FCH_Root().fromBytes(bad, verify_checksum=False)
+
+    def test_read_view(self):
+        buf = bytearray(b'abcdefgh')
+        with BinReader(buf) as br:
+            self.assertTrue(br.seekable())
+            v = br.read_view(3)
+            self.assertIsInstance(v, memoryview)
+            # A view into buf, not a copy
+            buf[1] = ord('B')
+            self.assertEqual(bytes(v), b'aBc')
+            self.assertEqual(br.read(2), b'de')
+            br.skip(2)
+            self.assertEqual(br.read_view(10), b'h')
+            self.assertEqual(br.read(1), b'')
+            self.assertEqual(br.read(2, pos=2), b'cd')
+            self.assertEqual(br.tell(), 8)
+        with BinReader(io.BytesIO(b'abc')) as br:
+            self.assertEqual(br.read_view(2), b'ab')
+
+    def test_memory_stream(self):
+        ms = MemoryStream(memoryview(b'abcdefgh'))
+        self.assertEqual(ms.seek(-2, 2), 6)
+        self.assertEqual(ms.read(), b'gh')
+        self.assertEqual(ms.seek(-3, 1), 5)
+        self.assertEqual(ms.read(1), b'f')
+        # Past the end reads nothing, and doesn't move back
+        self.assertEqual(ms.seek(20), 20)
+        self.assertEqual(ms.read_view(4), b'')
+        self.assertEqual(ms.tell(), 20)
+        self.assertRaises(ValueError, ms.seek, -1)
+
+
+class TestDecodePlan(unittest.TestCase):
+    def test_fixed_size(self):
+        self.assertEqual(DecodePlan.get_plan(FCH_World, 33).fixed_size(), 60)
+        self.assertEqual(DecodePlan.get_plan(FCH_World, 29).fixed_size(), 47)
+        self.assertEqual(DecodePlan.get_plan(FCH_Skill, 2).fixed_size(), 12)
+        self.assertEqual(DecodePlan.get_plan(FCH_Skill, 1).fixed_size(), 8)
+        self.assertIsNone(DecodePlan.get_plan(FCH_InvItem, 103).fixed_size())
+        self.assertIs(DecodePlan.get_plan(FCH_Skill, 2),
+                      DecodePlan.get_plan(FCH_Skill, 2))
+
+    def test_records(self):
+        fh = _fixture()
+        records = [(FCH_InvItem, FCH_InvItem.BIN_FIELDS[-1][2],
+                    fh.player_data.inventory.items),
+                   (FCH_Skill, 2, fh.player_data.skill_list.skills),
+                   (FCH_WorldMarker, 4,
+                    fh.worlds.worlds[0].vis_data.marker_list.markers)]
+        for (cls, version, objs) in records:
+            data = b''.join([_to_binary(o) for o in objs])
+            plan = DecodePlan.get_plan(cls, version)
+            with BinReader(data) as br:
+                decoded = [plan.read(br, cls()) for o in objs]
+                self.assertEqual(br.tell(), len(data))
+            self.assertEqual(b''.join([_to_binary(o) for o in decoded]),
+                             data)
+            self.assertEqual([o.toJSON() for o in decoded],
+                             [o.toJSON() for o in objs])
+            with BinReader(data) as br:
+                listed = plan.read_list(br, cls, len(objs))
+            self.assertEqual([o.toJSON() for o in listed],
+                             [o.toJSON() for o in objs])
+
+    def test_read_list_short(self):
+        plan = DecodePlan.get_plan(FCH_Skill, 2)
+        with BinReader(bytes(12 * 3 - 1)) as br:
+            self.assertRaises(Exception, plan.read_list, br, FCH_Skill, 3)
+
+    def test_file_round_trip(self):
+        data = _fixture().toBytes()
+        fh = FCH_Root()
+        fh.fromBytes(data)
+        self.assertEqual(fh.toBytes(), data)
+        self.assertEqual(fh.player_data.inventory.items[2].name,
+                         "ShieldWood")
+        self.assertEqual(fh.worlds.worlds[0].vis_data.marker_list.markers[2]
+                         .symbol, "Boss")
+        self.assertFalse(fh.worlds.worlds[1].have_vis_data)
+
+
+class TestValidate(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.data = _fixture().toBytes()
+
+    def test_valid(self):
+        self.assertIsNone(FCHValidator().validate(self.data))
+
+    def test_checksum(self):
+        data = bytearray(self.data)
+        data[100] ^= 0x01
+        ret = FCHValidator().validate(data)
+        self.assertEqual(ret.message, "Checksum mismatch")
+        self.assertIsNone(FCHValidator(verify_checksum=False).validate(data))
+
+    def test_truncated(self):
+        for size in list(range(0, 64)) + \
+                list(range(64, len(self.data), 37)):
+            ret = FCHValidator().validate(self.data[:size])
+            self.assertIsNotNone(ret, size)
+            self.assertTrue(0 <= ret.offset <= size, (size, str(ret)))
+
+    def test_non_ascii(self):
+        data = bytearray(self.data)
+        data[data.find(b"Viking")] = 0xc3
+        ret = FCHValidator(verify_checksum=False).validate(data)
+        self.assertEqual(ret.message, "Player name isn't ASCII")
+
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as d:
+            good = os.path.join(d, "good.fch")
+            bad = os.path.join(d, "bad.fch")
+            with open(good, 'wb') as f:
+                f.write(self.data)
+            with open(bad, 'wb') as f:
+                f.write(self.data[:len(self.data) // 2])
+            self.assertIsNone(validate_file(good))
+            self.assertEqual(validate_file(bad)[0], 0)
+
+
+class TestSalvage(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.data = _fixture().toBytes()
+
+    def test_valid(self):
+        (fh, losses) = FCHSalvage().salvage(self.data)
+        self.assertEqual(losses, [])
+        self.assertEqual(fh.toBytes(), self.data)
+
+    def test_truncated(self):
+        for size in list(range(0, 64)) + \
+                list(range(64, len(self.data), 37)):
+            (fh, losses) = FCHSalvage().salvage(self.data[:size])
+            self.assertNotEqual(losses, [], size)
+            if fh is None:
+                continue
+            # Whatever was recovered makes a valid file
+            out = fh.toBytes()
+            self.assertIsNone(FCHValidator().validate(out), size)
+
+    def test_truncated_player_data(self):
+        # Cut in the skills: the worlds and the start of the player data
+        # make it
+        data = self.data[:len(self.data) - 68 - 10]
+        (fh, losses) = FCHSalvage().salvage(data)
+        self.assertEqual(len(fh.worlds.worlds), 2)
+        orig = FCH_Root()
+        orig.fromBytes(self.data)
+        self.assertEqual(fh.worlds.worlds[0].vis_data.pixel_data,
+                         orig.worlds.worlds[0].vis_data.pixel_data)
+        self.assertEqual(fh.player_data.name, "Viking")
+        self.assertEqual(len(fh.player_data.inventory.items), 3)
+        self.assertEqual(len(fh.player_data.skill_list.skills), 0)
+        self.assertIn("skill_list", losses[-1])
+
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as d:
+            good = os.path.join(d, "good.fch")
+            bad = os.path.join(d, "bad.fch")
+            outdir = os.path.join(d, "out")
+            os.mkdir(outdir)
+            with open(good, 'wb') as f:
+                f.write(self.data)
+            with open(bad, 'wb') as f:
+                f.write(self.data[:len(self.data) // 2])
+            self.assertEqual(salvage_file(good, outdir), ('ok', []))
+            (status, losses) = salvage_file(bad, outdir)
+            self.assertEqual(status, 'salvaged')
+            self.assertIsNone(validate_file(os.path.join(outdir, "bad.fch")))
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:ts=4:sw=4:et